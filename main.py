@@ -1,20 +1,38 @@
 import os
 import time
 import json
-from typing import List, Optional
+import asyncio
+from typing import Dict, List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException, status, File, UploadFile, Query
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, status, File, UploadFile, Query, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from updblaster import local_settings
 from updblaster.database import SessionLocal, engine
+from updblaster.async_database import AsyncSessionLocal
 from updblaster.models import Base
-from updblaster import schemas, crud
+from updblaster import schemas, crud, async_crud
 from updblaster.logger import logger
-from updblaster.simple_tools import main_tools
+from updblaster.simple_tools import main_tools, upload_sessions, download_tools, delta_tools, patch_store, chunk_store
+from updblaster.simple_tools.manifest_cache import manifest_cache, ManifestEntry
+from updblaster.simple_tools.eligibility import eligibility_index, compile_package_rules
+from updblaster.simple_tools.rollout import rollout_reaches, rollout_state
+from updblaster.simple_tools import coverage
+from updblaster.simple_tools.pagination import decode_cursor, paginate
+from updblaster.simple_tools.lookup_cache import lookup_cache, MISSING, PAYLOADS
+from updblaster.simple_tools.coherence import shared_generations
+from updblaster.simple_tools.version_notifier import packagelist_notifier
+from updblaster.simple_tools.single_flight import AsyncSingleFlight
+from updblaster.simple_tools.json_tools import RawJSONResponse, dumps, encoded_json_response
+from updblaster.simple_tools.compress_tools import EncodedBody, encode_variants
+from updblaster.simple_tools.file_engine import hot_file_cache
+from updblaster.simple_tools.download_scheduler import download_scheduler, schedule_download
+from updblaster.simple_tools.history_tools import history_buffer, counts_as_download, resolve_keys, adoption_rollups
 
 Base.metadata.create_all(bind=engine)
 
@@ -22,9 +40,108 @@ app = FastAPI()
 
 app.mount('/static', StaticFiles(directory=f'{local_settings.PACKAGES_FOLDER}/static'), name='static')
 
+# 客户端接口的并发请求合并：同一个(版本, place)的manifest只生成一次，规则索引只加载一次
+client_flights = AsyncSingleFlight()
+
+
+@app.on_event('startup')
+def migrate_legacy_data():
+    # 将旧版黑白名单字符串迁移到package_place_rules表，可重复执行
+    db = SessionLocal()
+    try:
+        crud.migrate_legacy_place_rules(db=db)
+        crud.migrate_history_columns(db=db)
+        crud.migrate_history_unique_key(db=db)
+    finally:
+        db.close()
+
+
+@app.on_event('startup')
+async def start_generation_watcher():
+    """
+    订阅者等待在本worker的事件循环上；其他worker更新packagelist版本后，由此任务在几十毫秒内唤醒它们
+    """
+    packagelist_notifier.bind(asyncio.get_running_loop())
+
+    async def watch():
+        while True:
+            shared_generations.check()
+            await asyncio.sleep(local_settings.COHERENCE_CHECK_INTERVAL_SECONDS)
+    app.state.generation_watcher = asyncio.create_task(watch())
+
+
+@app.on_event('shutdown')
+async def stop_generation_watcher():
+    app.state.generation_watcher.cancel()
+
+
+@app.on_event('startup')
+async def start_rollout_ticker():
+    """
+    按计划开放分批发布的下一批次，见`open_due_rollout_waves`
+    """
+    async def tick():
+        while True:
+            await asyncio.sleep(local_settings.ROLLOUT_CHECK_INTERVAL_SECONDS)
+            try:
+                await run_in_threadpool(open_due_rollout_waves)
+            except Exception as e:
+                logger.error(f'Open rollout waves failed, detail: {e}.')
+    app.state.rollout_ticker = asyncio.create_task(tick())
+
+
+@app.on_event('shutdown')
+async def stop_rollout_ticker():
+    app.state.rollout_ticker.cancel()
+
+
+@app.on_event('startup')
+async def start_history_flusher():
+    """
+    定期将内存中的下载/轮询计数批量写入history表，见`simple_tools/history_tools.py`
+    """
+    async def flush():
+        while True:
+            await asyncio.sleep(local_settings.HISTORY_FLUSH_INTERVAL_SECONDS)
+            await run_in_threadpool(flush_download_history)
+    app.state.history_flusher = asyncio.create_task(flush())
+
+
+@app.on_event('shutdown')
+async def stop_history_flusher():
+    app.state.history_flusher.cancel()
+    await run_in_threadpool(flush_download_history)
+
+
+def resolve_package_hashes(db: Session, package_hashes: set) -> Dict[str, tuple]:
+    """
+    按hash下载的包在写入时才解析为(package_name, package_version)，此时可能已有更新的版本，
+    数据库中找不到的旧版本再从保留的补丁基础版本中查找
+    """
+    versions = crud.retrieve_package_versions_by_hashes(db=db, package_hashes=package_hashes)
+    if package_hashes - versions.keys():
+        for db_package in crud.retrieve_packages_all(db=db):
+            for base in patch_store.list_bases(package_id=db_package.id):
+                versions.setdefault(base['package_hash'], (db_package.package_name, base['package_version']))
+    return versions
+
+
+def flush_download_history() -> int:
+    def write(counts) -> int:
+        db = SessionLocal()
+        try:
+            package_hashes = {key[2] for key in counts if key[0] is None}
+            versions = resolve_package_hashes(db=db, package_hashes=package_hashes) if package_hashes else {}
+            return crud.upsert_history_counts(db=db, counts=resolve_keys(counts=counts, versions=versions))
+        finally:
+            db.close()
+    return history_buffer.flush(writer=write)
+
 
 # Dependency
 def get_db():
+    # 其他worker写入之后，本worker在下一个请求时丢弃对应的本地缓存
+    shared_generations.check()
     db = SessionLocal()
     try:
         yield db
@@ -32,6 +149,15 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """
+    客户端热点接口使用的异步session，不占用线程池
+    """
+    shared_generations.check()
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # [TODO]: For login.
 # def get_cookie_or_token(
 #     websocket: WebSocket,
@@ -57,8 +183,12 @@ def add_place(place: schemas.PlaceCreate, db: Session = Depends(get_db)):
 
 
 @app.get('/places/', response_model=List[schemas.Place])
-def get_fuzzy_places(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
-                     q: Optional[str] = None):
+def get_fuzzy_places(response: Response, skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
+                     q: Optional[str] = None, cursor: Optional[str] = None):
+    """
+    - :param skip: 兼容旧的分页方式，深度分页请使用cursor
+    - :param cursor: 上一页返回的`X-Next-Cursor`，有下一页时才返回该header
+    """
     if q:
         fuzzy_c_places = crud.retrieve_places_by_fuzzy_code(db=db, place_code=q)
         fuzzy_n_places = crud.retrieve_places_by_fuzzy_name(db=db, place_name=q)
@@ -75,7 +205,10 @@ def get_fuzzy_places(skip: int = 0, limit: int = 100, db: Session = Depends(get_
         return fuzzy_db_places
 
     else:
-        db_places: List[schemas.Place] = crud.retrieve_places(db=db, skip=skip, limit=limit)
+        # 多取一行，用于判断是否还有下一页
+        db_places: List[schemas.Place] = paginate('places', crud.retrieve_places(
+            db=db, skip=skip, limit=limit + 1, after_id=decode_cursor('places', cursor)),
+            limit=limit, response=response)
 
         if db_places:
             logger.info('Get places done, without any query parameters.')
@@ -106,13 +239,14 @@ def update_place(place_id: int, place: schemas.PlaceCreate, db: Session = Depend
         raise HTTPException(status_code=404, detail=f"Place {place_id} not found")
 
     db_places = crud.update_place(place_id=place_id, place=place, db=db)
+    # manifest的下载地址中包含place_code
+    manifest_cache.invalidate()
     logger.debug(f'Place {place_id} successfully updated.')
     return db_places
 
 
 @app.delete('/places/{place_id}')
 def remove_place(place_id: int, db: Session = Depends(get_db)):
-    # [TODO]: 将Package中的valid_places与invalid_places的相关place.id删除
     db_place = crud.retrieve_place_by_place_id(place_id=place_id, db=db)
 
     if not db_place:
@@ -122,10 +256,223 @@ def remove_place(place_id: int, db: Session = Depends(get_db)):
 
     else:
         resp = crud.delete_place(db=db, place_id=place_id)
+        eligibility_index.remove_place(place_id=place_id)
+        manifest_cache.invalidate()
         logger.info(f'Place {place_id} successfully deleted.')
         return JSONResponse(content=jsonable_encoder(resp))
 
 
+def update_newpackagelist_version(db: Session, package_id: int, package_name: str, action: str):
+    """
+    在package变动之后，更新newpackagelist的版本并记录变更日志，旧版本的manifest缓存随之失效
+    :param db:
+    :param package_id:
+    :param package_name:
+    :param action: 'added', 'updated', 'published', 'rollout' or 'deleted'.
+    """
+    version = crud.retrieve_newpackagelist_desc(db=db)
+    if version:
+        new_version = f'{version.id + 1}'
+    else:
+        new_version = '1'
+    npl_dict = {'packagelist_version': new_version}
+    change = {'package_id': package_id, 'package_name': package_name, 'action': action}
+    crud.create_newpackagelist(db=db, npl_dict=npl_dict, changes=[change])
+    logger.info(f'After package {package_name} {action}, update the newpackagelist {new_version}.')
+
+    crud.compact_packagelist_changes(
+        db=db, before_version=int(new_version) - local_settings.PACKAGELIST_JOURNAL_KEEP_VERSIONS)
+
+    manifest_cache.invalidate()
+    packagelist_notifier.notify()
+
+
+def get_or_build_manifest(newpackagelist: schemas.PackagesList,
+                          db_place: schemas.Place,
+                          db: Session) -> Optional[ManifestEntry]:
+    """
+    每个place的manifest只包含可更新到该place的packages，
+    每个(packagelist版本, place)只生成一次json、zip及其hash，之后的请求直接使用内存中的结果
+    :return: None if no package is enabled for the place.
+    """
+    def builder() -> ManifestEntry:
+        db_packages = crud.retrieve_enabled_packages_by_place(db=db, place_id=db_place.id,
+                                                              place_code=db_place.place_code)
+        if not db_packages:
+            # 同样缓存"没有可更新的package"，避免每次请求都查询数据库
+            return ManifestEntry(resp_dict=None, zip_bytes=b'')
+
+        # 组装外层newpackagelist的数据，压缩成zip包
+        newpackagelist_dict = main_tools.assemble_newpackagelist_dict(newpackagelist=newpackagelist,
+                                                                      packages=db_packages)
+        # e.g.: http://127.0.0.1:21080/npl/downloads/<place_code>/<packagelist_version>/<hash[:16]>/newpackagelist.zip
+        packagelist_down_folder = (f'{local_settings.BASE_URL}/npl/downloads/{db_place.place_code}/'
+                                   f'{newpackagelist.packagelist_version}')
+        resp_dict, zip_bytes = main_tools.generate_zipped_json_then_resp(
+            newpackagelist_dict=newpackagelist_dict, packagelist_down_folder=packagelist_down_folder)
+        return ManifestEntry(resp_dict=resp_dict, zip_bytes=zip_bytes, resp_body=encode_variants(dumps(resp_dict)))
+
+    manifest = manifest_cache.get_or_build(key=(newpackagelist.packagelist_version, db_place.id), builder=builder)
+    return manifest if manifest.resp_dict else None
+
+
+def create_package_from_temp_file(db: Session,
+                                  temp_path: str,
+                                  file_name: str,
+                                  package_length: int,
+                                  package_hash: str,
+                                  package_name: str,
+                                  package_version: str,
+                                  package_run_cmd: Optional[str],
+                                  package_del_cmd: Optional[str],
+                                  package_path: str):
+    """
+    Create the package row for an uploaded temp file, then atomically publish the file.
+    Shared by the single request upload and the upload sessions, which call it through `run_in_threadpool`:
+    publishing reads and writes the whole file, see `publish_package_file`.
+    """
+    file_path = main_tools.package_object_path(package_hash=package_hash, file_name=file_name)
+
+    # e.g.: http://127.0.0.1:21080/packages/downloads/<package_hash>/happymj.zip
+    package_down_url = main_tools.package_object_down_url(package_hash=package_hash, file_name=file_name)
+
+    req_dict = main_tools.assemble_package_dict(pname=package_name,
+                                                pversion=package_version,
+                                                plength=str(package_length),
+                                                phash=package_hash,
+                                                pdownurl=package_down_url,
+                                                pcmd=package_run_cmd,
+                                                pdel=package_del_cmd,
+                                                ppath=package_path)
+    try:
+        db_package = crud.create_package(db=db, req_dict=req_dict)
+    except Exception:
+        main_tools.discard_temp_file(temp_path)
+        raise
+
+    # 数据库提交成功之后，才将临时文件原子地替换到正式路径
+    try:
+        publish_package_file(temp_path=temp_path, file_path=file_path, package_hash=package_hash)
+    except OSError as e:
+        logger.error(f'Publish file {file_path} failed, detail: {e}.')
+        main_tools.discard_temp_file(temp_path)
+        crud.delete_package(db=db, package_id=db_package.id)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f'Publish file {file_name} failed.')
+
+    retain_patch_base(db_package=db_package, file_path=file_path)
+
+    # 在创建package成功之后，更新newpackagelist的版本
+    eligibility_index.update_package(package=db_package)
+    update_newpackagelist_version(db=db, package_id=db_package.id, package_name=db_package.package_name,
+                                  action='added')
+    return db_package
+
+
+def publish_package_file(temp_path: str, file_path: str, package_hash: str):
+    """
+    启用chunk store时，包文件切分成去重的chunk保存，不再保留完整文件；否则原子地替换到正式路径
+    读写整个包文件，async接口须经`run_in_threadpool`调用，以免阻塞事件循环
+    """
+    if local_settings.CHUNK_STORE_ENABLED:
+        chunk_store.ingest_file(file_path=temp_path, package_hash=package_hash)
+        main_tools.discard_temp_file(temp_path)
+    else:
+        main_tools.publish_temp_file(temp_path=temp_path, file_path=file_path)
+
+
+def retain_patch_base(db_package: schemas.Package, file_path: str):
+    """
+    保留已发布的包文件，作为之后生成增量补丁的基础版本
+    """
+    try:
+        patch_store.retain_base(package_id=db_package.id, package_version=db_package.package_version,
+                                package_hash=db_package.package_hash, file_path=file_path)
+    except OSError as e:
+        logger.error(f'Retain patch base of package {db_package.id} failed, detail: {e}.')
+
+
+def generate_package_patches(package_id: int):
+    """
+    后台任务：从之前的若干个版本生成到当前版本的增量补丁
+    """
+    db = SessionLocal()
+    try:
+        db_package = crud.retrieve_package_by_package_id(db=db, package_id=package_id)
+        if not db_package:
+            return
+
+        to_hash = db_package.package_hash
+        os.makedirs(local_settings.PATCHES_FOLDER, exist_ok=True)
+        bases = patch_store.list_bases(package_id=package_id)[:local_settings.PATCH_BASE_VERSIONS + 1]
+        if to_hash not in {base['package_hash'] for base in bases}:
+            logger.error(f'Patch target of package {package_id} not found, skip generating patches.')
+            return
+
+        for base in bases:
+            from_hash = base['package_hash']
+            if from_hash == to_hash or crud.retrieve_package_patch(db=db, package_id=package_id,
+                                                                   from_hash=from_hash, to_hash=to_hash):
+                continue
+
+            patch_name = patch_store.patch_name(package_id=package_id, from_hash=from_hash, to_hash=to_hash)
+            temp_path = f'{patch_store.patch_path(patch_name)}{local_settings.UPLOAD_TEMP_PREFIX}{os.getpid()}'
+            try:
+                with patch_store.materialized_base(package_id=package_id, package_hash=to_hash) as target_path, \
+                        patch_store.materialized_base(package_id=package_id, package_hash=from_hash) as base_path:
+                    if not delta_tools.make_delta(base_path=base_path, base_hash=from_hash,
+                                                  target_path=target_path, target_hash=to_hash,
+                                                  patch_path=temp_path):
+                        continue
+                    # 生成之后先按客户端的方式验证一遍
+                    delta_tools.apply_delta(base_path=base_path, patch_path=temp_path)
+                patch_length = os.path.getsize(temp_path)
+                patch_hash = main_tools.get_package_hash(temp_path)
+                main_tools.publish_temp_file(temp_path=temp_path, file_path=patch_store.patch_path(patch_name))
+            except (OSError, delta_tools.DeltaError) as e:
+                logger.error(f'Generate patch {patch_name} failed, detail: {e}.')
+                main_tools.discard_temp_file(temp_path)
+                continue
+
+            crud.create_package_patch(db=db, patch_dict={'package_id': package_id,
+                                                         'from_version': base['package_version'],
+                                                         'from_hash': from_hash,
+                                                         'to_version': db_package.package_version,
+                                                         'to_hash': to_hash,
+                                                         'patch_name': patch_name,
+                                                         'patch_length': str(patch_length),
+                                                         'patch_hash': patch_hash})
+            logger.info(f'Generated patch {patch_name}: {base["package_version"]} -> {db_package.package_version}.')
+
+        # 过旧的基础版本及其补丁不再保留
+        removed_hashes = patch_store.prune_bases(package_id=package_id, keep=local_settings.PATCH_BASE_VERSIONS + 1)
+        if removed_hashes:
+            patch_names = crud.delete_package_patches_from(db=db, package_id=package_id, from_hashes=removed_hashes)
+            patch_store.remove_patch_files(patch_names)
+    finally:
+        db.close()
+
+    collect_storage_garbage()
+
+
+def collect_storage_garbage():
+    """
+    后台任务：删除不再被任何package或补丁基础版本引用的包文件和chunk
+    旧版本作为补丁基础版本保留期间，其下载地址仍然可用
+    """
+    db = SessionLocal()
+    try:
+        keep_hashes = set()
+        for db_package in crud.retrieve_packages_all(db=db):
+            keep_hashes.add(db_package.package_hash)
+            keep_hashes.update(base['package_hash'] for base in patch_store.list_bases(package_id=db_package.id))
+    finally:
+        db.close()
+    main_tools.remove_unreferenced_objects(keep_package_hashes=keep_hashes)
+    if local_settings.CHUNK_STORE_ENABLED:
+        chunk_store.collect_garbage(keep_package_hashes=keep_hashes)
+
+
 # ======================================================================================================================
 
 
@@ -158,59 +505,271 @@ async def add_package(package_name: str = Query(..., min_length=2, max_length=32
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f'The place code {package_name} is already existed.')
 
-    # [TODO]: 优化该上传前、上传中、上传中、上传效率等，参考相关文章
     start = time.time()
-    file_path = f'{local_settings.PACKAGES_FOLDER}/{file.filename}'
     try:
-        # 以下1行代码可能涉及性能问题，因为此处为web端上传的package文件，可能是以GB为单位的包
-        data = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(data)
+        # 分块流式写入临时文件，同时计算hash和size，内存占用只与UPLOAD_CHUNK_SIZE有关，与包大小无关
+        temp_path, package_length, package_hash = await main_tools.save_upload_file_to_temp(
+            upload_file=file, folder=local_settings.PACKAGES_FOLDER)
         logger.debug(f'Spending time for uploading: {time.time() - start}, file name: {file.filename}')
     except Exception as e:
         logger.error(f'Upload file error, detail: {e}.')
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f'Upload file error, detail: {e}.')
 
-    # Prepare for creating package instance.
-    # file_path = f'{local_settings.PACKAGES_FOLDER}/{file.filename}'
+    return await run_in_threadpool(create_package_from_temp_file,
+                                   db=db,
+                                   temp_path=temp_path,
+                                   file_name=file.filename,
+                                   package_length=package_length,
+                                   package_hash=package_hash,
+                                   package_name=package_name,
+                                   package_version=package_version,
+                                   package_run_cmd=package_run_cmd,
+                                   package_del_cmd=package_del_cmd,
+                                   package_path=package_path)
+
+
+@app.post('/packages/raw/', response_model=schemas.Package, summary='Upload a package as the raw body')
+async def add_package_raw(request: Request,
+                          package_name: str = Query(..., min_length=2, max_length=32),
+                          package_version: str = Query(..., min_length=1, max_length=16),
+                          package_run_cmd: Optional[str] = Query(None, min_length=2, max_length=512),
+                          package_del_cmd: Optional[str] = Query(None, min_length=2, max_length=512),
+                          package_path: str = Query(..., min_length=5),
+                          file_name: str = Query(..., min_length=1, max_length=128, regex=r'^[^/\\]+$'),
+                          db: Session = Depends(get_db)):
+    """
+    与`POST /packages/`相同，但请求体即为包文件的原始数据，不使用multipart：
+    multipart上传的文件在进入接口之前已被完整缓存到临时文件，这里直接流式写入一次
+    - :param file_name: 包文件名，e.g.: "happymj.zip"
+    """
+    if crud.retrieve_package_by_package_name(package_name=package_name, db=db):
+        logger.info(f'The package {package_name} is already existed.')
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'The package {package_name} is already existed.')
+
+    start = time.time()
+    try:
+        temp_path, package_length, package_hash = await main_tools.save_stream_to_temp(
+            stream=request.stream(), folder=local_settings.PACKAGES_FOLDER)
+        logger.debug(f'Spending time for uploading: {time.time() - start}, file name: {file_name}')
+    except Exception as e:
+        logger.error(f'Upload file error, detail: {e}.')
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Upload file error, detail: {e}.')
+    if not package_length:
+        main_tools.discard_temp_file(temp_path)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'The package file is empty.')
+
+    return await run_in_threadpool(create_package_from_temp_file,
+                                   db=db,
+                                   temp_path=temp_path,
+                                   file_name=file_name,
+                                   package_length=package_length,
+                                   package_hash=package_hash,
+                                   package_name=package_name,
+                                   package_version=package_version,
+                                   package_run_cmd=package_run_cmd,
+                                   package_del_cmd=package_del_cmd,
+                                   package_path=package_path)
+
+
+@app.post('/uploads/', response_model=schemas.UploadSession, summary='Create upload session')
+def create_upload_session(package_name: str = Query(..., min_length=2, max_length=32),
+                          package_version: str = Query(..., min_length=1, max_length=16),
+                          package_run_cmd: Optional[str] = Query(None, min_length=2, max_length=512),
+                          package_del_cmd: Optional[str] = Query(None, min_length=2, max_length=512),
+                          package_path: str = Query(..., min_length=5),
+                          file_name: str = Query(..., min_length=1, max_length=128, regex=r'^[^/\\]+$'),
+                          file_length: int = Query(..., gt=0),
+                          package_hash: str = Query(..., regex=r'^[0-9a-fA-F]{64}$'),
+                          chunk_size: int = Query(local_settings.UPLOAD_SESSION_CHUNK_SIZE, gt=0,
+                                                  le=local_settings.UPLOAD_SESSION_MAX_CHUNK_SIZE),
+                          db: Session = Depends(get_db)):
+    """
+    可续传的分块上传：创建session -> 以任意顺序并行PUT各个chunk -> 查询缺失的chunk -> finalize
+    - :param file_length: 整个包文件的字节数
+    - :param package_hash: 整个包文件的sha256，finalize时校验
+    - :param chunk_size: 除最后一块之外，每块的字节数
+    """
+    if crud.retrieve_package_by_package_name(package_name=package_name, db=db):
+        logger.info(f'The package {package_name} is already existed.')
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'The package {package_name} is already existed.')
+
+    session = upload_sessions.create_session({'package_name': package_name,
+                                              'package_version': package_version,
+                                              'package_run_cmd': package_run_cmd,
+                                              'package_del_cmd': package_del_cmd,
+                                              'package_path': package_path,
+                                              'file_name': file_name,
+                                              'file_length': file_length,
+                                              'package_hash': package_hash.lower(),
+                                              'chunk_size': chunk_size})
+    session['missing_chunks'] = upload_sessions.missing_chunks(session)
+    return session
+
+
+def get_upload_session_or_404(session_id: str) -> dict:
+    session = upload_sessions.load_session(session_id)
+    if not session:
+        logger.info(f'Upload session {session_id} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Upload session {session_id} not found.')
+    return session
 
-    # 以下2行代码可能涉及性能问题，因为此处为web端上传的package文件，可能是以GB为单位的包
-    package_length = os.path.getsize(filename=file_path)
-    package_hash = main_tools.get_package_hash(file_path)
 
-    # e.g.: http://127.0.0.1:21080/packages/downloads/happymj.zip
-    package_down_url = f'{local_settings.BASE_URL}/packages/downloads/{file.filename}'
+@app.get('/uploads/{session_id}', response_model=schemas.UploadSession)
+def get_upload_session(session_id: str):
+    session = get_upload_session_or_404(session_id)
+    session['missing_chunks'] = upload_sessions.missing_chunks(session)
+    return session
 
-    req_dict = main_tools.assemble_package_dict(pname=package_name,
-                                                pversion=package_version,
-                                                plength=str(package_length),
-                                                phash=package_hash,
-                                                pdownurl=package_down_url,
-                                                pcmd=package_run_cmd,
-                                                pdel=package_del_cmd,
-                                                ppath=package_path)
-    db_package = crud.create_package(db=db, req_dict=req_dict)
 
-    if db_package:
-        # 在创建package成功之后，更新newpackagelist的版本
-        version = crud.retrieve_newpackagelist_desc(db=db)
-        if version:
-            new_version = f'{version.id + 1}'
-            npl_dict = {'packagelist_version': new_version}
-            crud.create_newpackagelist(db=db, npl_dict=npl_dict)
-            logger.info(f'After create a package, update the newpackagelist {new_version}.')
-        else:
-            npl_dict = {'packagelist_version': '1'}
-            crud.create_newpackagelist(db=db, npl_dict=npl_dict)
-            logger.info(f'After create a package, update the newpackagelist 1.')
+@app.put('/uploads/{session_id}/chunks/{chunk_index}', response_model=schemas.UploadChunk)
+async def put_upload_chunk(session_id: str, chunk_index: int, request: Request,
+                           chunk_hash: Optional[str] = Query(None, regex=r'^[0-9a-fA-F]{64}$')):
+    """
+    请求体即为该chunk的原始数据
+    - :param chunk_index: 从0开始
+    - :param chunk_hash: 可选，该chunk的sha256，不一致则拒绝该chunk
+    """
+    session = get_upload_session_or_404(session_id)
+    try:
+        return await upload_sessions.save_chunk(session=session, index=chunk_index,
+                                                stream=request.stream(), chunk_hash=chunk_hash)
+    except upload_sessions.UploadSessionError as e:
+        logger.info(f'Upload session {session_id} rejected chunk {chunk_index}, detail: {e}')
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'{e}')
+    except upload_sessions.UploadSessionBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'{e}')
+
+
+@app.post('/uploads/{session_id}/finalize', response_model=schemas.Package)
+async def finalize_upload_session(session_id: str, db: Session = Depends(get_db)):
+    session = get_upload_session_or_404(session_id)
+
+    missing = upload_sessions.missing_chunks(session)
+    if missing:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Upload session {session_id} is missing chunks {missing}.')
+
+    lock_fd = upload_sessions.acquire_finalize_lock(session)
+    if lock_fd is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f'Upload session {session_id} is being finalized, or receiving chunks.')
+    try:
+        if crud.retrieve_package_by_package_name(package_name=session['package_name'], db=db):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f'The package {session["package_name"]} is already existed.')
+
+        temp_path, package_length, package_hash = await run_in_threadpool(
+            upload_sessions.assemble_chunks, session, local_settings.PACKAGES_FOLDER)
+
+        if package_length != session['file_length'] or package_hash != session['package_hash']:
+            main_tools.discard_temp_file(temp_path)
+            logger.info(f'Upload session {session_id} hash mismatched.')
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f'Upload session {session_id} hash mismatched, '
+                                       f'got {package_hash} with {package_length} bytes.')
+
+        db_package = await run_in_threadpool(create_package_from_temp_file,
+                                             db=db,
+                                             temp_path=temp_path,
+                                             file_name=session['file_name'],
+                                             package_length=package_length,
+                                             package_hash=package_hash,
+                                             package_name=session['package_name'],
+                                             package_version=session['package_version'],
+                                             package_run_cmd=session['package_run_cmd'],
+                                             package_del_cmd=session['package_del_cmd'],
+                                             package_path=session['package_path'])
+    finally:
+        upload_sessions.release_finalize_lock(lock_fd)
 
+    upload_sessions.remove_session(session_id)
+    logger.info(f'Upload session {session_id} finalized as package {db_package.id}.')
+    return db_package
+
+
+@app.delete('/uploads/{session_id}')
+def remove_upload_session(session_id: str):
+    get_upload_session_or_404(session_id)
+    upload_sessions.remove_session(session_id)
+    return JSONResponse(content={'id': session_id, 'object': 'upload_session', 'deleted': True})
+
+
+@app.put('/packages/{package_id}/file', response_model=schemas.Package, summary='Upload a new version')
+async def upload_package_version(package_id: int,
+                                 background_tasks: BackgroundTasks,
+                                 package_version: str = Query(..., min_length=1, max_length=16),
+                                 file: UploadFile = File(...),
+                                 db: Session = Depends(get_db)):
+    """
+    为已存在的package上传新版本的包文件，之后在后台生成从旧版本到新版本的增量补丁
+    - :param package_version: 新版本
+    - :param file: 新版本的包文件
+    """
+    db_package = crud.retrieve_package_by_package_id(db=db, package_id=package_id)
+    if not db_package:
+        logger.info(f'Package {package_id} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Package {package_id} not found.')
+
+    try:
+        temp_path, package_length, package_hash = await main_tools.save_upload_file_to_temp(
+            upload_file=file, folder=local_settings.PACKAGES_FOLDER)
+    except Exception as e:
+        logger.error(f'Upload file error, detail: {e}.')
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Upload file error, detail: {e}.')
+
+    if package_hash == db_package.package_hash:
+        main_tools.discard_temp_file(temp_path)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'The file is the same as the current version of package {package_id}.')
+
+    # 替换之前，保留当前版本的文件作为补丁的基础版本
+    old_file_path = main_tools.package_file_path(package_down_url=db_package.package_down_url,
+                                                 package_hash=db_package.package_hash)
+    if os.path.exists(old_file_path) or chunk_store.has_manifest(db_package.package_hash):
+        await run_in_threadpool(retain_patch_base, db_package=db_package, file_path=old_file_path)
+
+    # 新版本保存在新的路径，正在下载旧版本的客户端不受影响
+    # 先发布文件再更新数据库：文件发布失败时数据库仍指向旧版本；数据库更新失败时，
+    # 未被引用的新文件由`collect_storage_garbage`在保留期之后删除
+    file_path = main_tools.package_object_path(package_hash=package_hash, file_name=file.filename)
+    try:
+        await run_in_threadpool(publish_package_file, temp_path=temp_path, file_path=file_path,
+                                package_hash=package_hash)
+    except OSError as e:
+        logger.error(f'Publish file {file_path} failed, detail: {e}.')
+        main_tools.discard_temp_file(temp_path)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f'Publish file {file.filename} failed.')
+
+    db_package = crud.update_package_file(db=db, package_id=package_id,
+                                          package_version=package_version,
+                                          package_length=str(package_length),
+                                          package_hash=package_hash,
+                                          package_down_url=main_tools.package_object_down_url(
+                                              package_hash=package_hash, file_name=file.filename))
+
+    await run_in_threadpool(retain_patch_base, db_package=db_package, file_path=file_path)
+    update_newpackagelist_version(db=db, package_id=db_package.id, package_name=db_package.package_name,
+                                  action='updated')
+    background_tasks.add_task(generate_package_patches, package_id)
     return db_package
 
 
 @app.get("/packages/", response_model=List[schemas.Package])
-def get_fuzzy_packages(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
-                       q: Optional[str] = None):
+def get_fuzzy_packages(response: Response, skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
+                       q: Optional[str] = None, cursor: Optional[str] = None):
+    """
+    - :param skip: 兼容旧的分页方式，深度分页请使用cursor
+    - :param cursor: 上一页返回的`X-Next-Cursor`，有下一页时才返回该header
+    """
     if q:
         fuzzy_db_packages = crud.retrieve_packages_by_fuzzy_name(db=db, package_name=q)
         if fuzzy_db_packages:
@@ -220,7 +779,8 @@ def get_fuzzy_packages(skip: int = 0, limit: int = 100, db: Session = Depends(ge
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=f'No packages found by {q}.')
     else:
-        db_packages = crud.retrieve_packages_for_web(db, skip=skip, limit=limit)
+        db_packages = paginate('packages', crud.retrieve_packages_for_web(
+            db, skip=skip, limit=limit + 1, after_id=decode_cursor('packages', cursor)), limit=limit, response=response)
         if db_packages:
             logger.debug(f'Get packages done.')
             return db_packages
@@ -247,46 +807,174 @@ def publish_package(package_id: int,
                     package_run_cmd: Optional[str] = Query(None),
                     package_del_cmd: Optional[str] = Query(None),
                     package_path: str = Query(...),
+                    rollout_waves: Optional[int] = Query(None, ge=2, le=local_settings.ROLLOUT_MAX_WAVES),
+                    rollout_opened_waves: int = Query(1, ge=1),
+                    rollout_interval_seconds: Optional[int] = Query(None, ge=1),
                     db: Session = Depends(get_db)):
-    if not crud.retrieve_package_by_package_id(package_id=package_id, db=db):
+    """
+    发布package，可选分批发布：每个place按place_code的哈希固定属于某一批次，逐批开放，见`simple_tools/rollout.py`
+    - :param rollout_waves: 批次数，为空时对全部place同时生效；百分比发布时为100
+    - :param rollout_opened_waves: 立即开放的批次数，百分比发布时即为百分比
+    - :param rollout_interval_seconds: 每隔多少秒自动开放下一批次，为空时通过`PUT /packages/{package_id}/rollout`手动开放
+    """
+    db_package = crud.retrieve_package_by_package_id(package_id=package_id, db=db)
+    if not db_package:
         logger.error(f'Package {package_id} not found.')
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Package {package_id} not found.')
+    if rollout_waves is not None and rollout_opened_waves > rollout_waves:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Rollout opened waves {rollout_opened_waves} exceed waves {rollout_waves}.')
+    # 发布之前已可更新的places不受批次限制，重新发布不会使它们失去该package
+    exempt_places = rollout_exempt_places(db=db, db_package=db_package) if rollout_waves is not None else None
 
     logger.debug(f'==== run_cmd: {package_run_cmd} ====')
     logger.debug(f'==== del_cmd: {package_del_cmd} ====')
-    db_package = crud.update_package_to_publish(package_id=package_id,
-                                                package_version=package_version,
-                                                valid_places=valid_places,
-                                                invalid_places=invalid_places,
-                                                package_run_cmd=package_run_cmd,
-                                                package_del_cmd=package_del_cmd,
-                                                package_path=package_path,
-                                                db=db)
+    rollout_dict = None if rollout_waves is None else {'package_id': package_id,
+                                                       'package_version': package_version,
+                                                       'waves': rollout_waves,
+                                                       'opened_waves': rollout_opened_waves,
+                                                       'wave_interval_seconds': rollout_interval_seconds,
+                                                       'wave_opened_at': int(time.time()),
+                                                       'halted': False,
+                                                       'exempt_places': exempt_places}
+    # 规则与rollout一起提交，之后再一起更新索引，中途不会对所有允许的places生效
+    db_package, db_rollout = crud.update_package_to_publish(package_id=package_id,
+                                                            package_version=package_version,
+                                                            valid_places=valid_places,
+                                                            invalid_places=invalid_places,
+                                                            package_run_cmd=package_run_cmd,
+                                                            package_del_cmd=package_del_cmd,
+                                                            package_path=package_path,
+                                                            rollout_dict=rollout_dict,
+                                                            db=db)
+    eligibility_index.update_package(package=db_package, rollout=rollout_state(
+        db_rollout.waves, db_rollout.opened_waves, db_rollout.exempt_places) if db_rollout else None)
+    if db_rollout:
+        logger.info(f'Package {package_id} rolled out to {rollout_opened_waves}/{rollout_waves} waves.')
+
+    # 发布会改变manifest中的版本、命令、路径等，所以同样需要更新newpackagelist的版本
+    update_newpackagelist_version(db=db, package_id=db_package.id, package_name=db_package.package_name,
+                                  action='published')
     return db_package
 
 
+def rollout_exempt_places(db: Session, db_package: schemas.Package) -> str:
+    """
+    发布之前已可更新到的places，分批发布中的只算已开放到的
+    :return: e.g.: '1,2,3'
+    """
+    allow, deny = compile_package_rules(db_package.valid_places, db_package.invalid_places)
+    place_ids = allow - deny
+    db_rollout = crud.retrieve_package_rollout(db=db, package_id=db_package.id)
+    if db_rollout and place_ids:
+        place_codes = crud.retrieve_place_codes_by_place_ids(db=db, place_ids=place_ids)
+        place_ids = {place_id for place_id, place_code in place_codes.items()
+                     if rollout_reaches(db_rollout, place_id=place_id, place_code=place_code)}
+    return crud.join_places(place_ids)
+
+
+def apply_package_rollout(db: Session, package_id: int):
+    """
+    分批发布开放的范围变化之后，更新规则索引和newpackagelist的版本，新开放的places随之收到该package
+    """
+    db_rollout = crud.retrieve_package_rollout(db=db, package_id=package_id)
+    eligibility_index.update_rollout(package_id=package_id, rollout=rollout_state(
+        db_rollout.waves, db_rollout.opened_waves, db_rollout.exempt_places) if db_rollout else None)
+    db_package = crud.retrieve_package_by_package_id(db=db, package_id=package_id)
+    if db_package:
+        update_newpackagelist_version(db=db, package_id=package_id, package_name=db_package.package_name,
+                                      action='rollout')
+
+
+def open_due_rollout_waves():
+    """
+    后台任务：开放到期的下一批次。每个worker都会执行，由数据库的条件更新保证每个批次只开放一次
+    """
+    db = SessionLocal()
+    try:
+        now = int(time.time())
+        for package_id, opened_waves, waves in [(db_rollout.package_id, db_rollout.opened_waves, db_rollout.waves)
+                                                for db_rollout in crud.retrieve_due_package_rollouts(db=db, now=now)]:
+            if crud.open_package_rollout_waves(db=db, package_id=package_id, from_opened_waves=opened_waves,
+                                               opened_waves=opened_waves + 1, now=now):
+                logger.info(f'Rollout of package {package_id} opened wave {opened_waves + 1}/{waves}.')
+                apply_package_rollout(db=db, package_id=package_id)
+    finally:
+        db.close()
+
+
+def get_package_rollout_or_404(db: Session, package_id: int):
+    db_rollout = crud.retrieve_package_rollout(db=db, package_id=package_id)
+    if not db_rollout:
+        logger.info(f'Package {package_id} is not being rolled out.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Package {package_id} is not being rolled out.')
+    return db_rollout
+
+
+@app.get('/packages/{package_id}/rollout', response_model=schemas.PackageRollout)
+def get_package_rollout(package_id: int, db: Session = Depends(get_db)):
+    return get_package_rollout_or_404(db=db, package_id=package_id)
+
+
+@app.put('/packages/{package_id}/rollout', response_model=schemas.PackageRollout, summary='Open waves, halt or resume')
+def update_package_rollout(package_id: int,
+                           opened_waves: Optional[int] = Query(None, ge=0),
+                           halted: Optional[bool] = Query(None),
+                           db: Session = Depends(get_db)):
+    """
+    手动开放批次，或暂停/恢复自动开放
+    - :param opened_waves: 开放到第几批，可以减少以收回尚未开放的places，等于批次数时全部开放
+    - :param halted: True暂停自动开放，已开放的places保留该package；False恢复
+    """
+    db_rollout = get_package_rollout_or_404(db=db, package_id=package_id)
+    if opened_waves is not None and opened_waves > db_rollout.waves:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Opened waves {opened_waves} exceed waves {db_rollout.waves}.')
+
+    update_dict = {}
+    if halted is not None:
+        update_dict['halted'] = halted
+    if opened_waves is not None and opened_waves != db_rollout.opened_waves:
+        update_dict.update(opened_waves=opened_waves, wave_opened_at=int(time.time()))
+    if not update_dict:
+        return db_rollout
+
+    db_rollout = crud.update_package_rollout(db=db, package_id=package_id, update_dict=update_dict)
+    logger.info(f'Rollout of package {package_id} updated with {update_dict}.')
+    if 'opened_waves' in update_dict:
+        apply_package_rollout(db=db, package_id=package_id)
+    return db_rollout
+
+
+@app.delete('/packages/{package_id}/rollout', summary='Open to all places')
+def remove_package_rollout(package_id: int, db: Session = Depends(get_db)) -> json:
+    get_package_rollout_or_404(db=db, package_id=package_id)
+    crud.delete_package_rollout(db=db, package_id=package_id)
+    apply_package_rollout(db=db, package_id=package_id)
+    logger.info(f'Rollout of package {package_id} removed, open to all places.')
+    return JSONResponse(content={'id': f'{package_id}',
+                                 'object': 'rollout',
+                                 'delete': True})
+
+
 @app.delete('/packages/{package_id}')
-def remove_package(package_id: int, db: Session = Depends(get_db)) -> json:
+def remove_package(package_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)) -> json:
     db_package = crud.retrieve_package_by_package_id(db=db, package_id=package_id)
 
     if db_package:
+        package_name = db_package.package_name
+        patch_names = crud.retrieve_package_patch_names(db=db, package_id=package_id)
         resp = crud.delete_package(db=db, package_id=package_id)
+        eligibility_index.remove_package(package_id=package_id)
+        patch_store.remove_package_files(package_id=package_id, patch_names=patch_names)
         # [TODO]: Delete physical package.
         logger.info(f'Remove package {package_id} done.')
 
         # 在删除package成功之后，更新newpackagelist的版本，此后再返回
-        # [TODO]: 抽象方法
-        version = crud.retrieve_newpackagelist_desc(db=db)
-        if version:
-            new_version = f'{version.id + 1}'
-            npl_dict = {'packagelist_version': new_version}
-            crud.create_newpackagelist(db=db, npl_dict=npl_dict)
-            logger.info(f'After delete a package {package_id}, updated the newpackagelist {new_version}.')
-        else:
-            npl_dict = {'packagelist_version': '1'}
-            crud.create_newpackagelist(db=db, npl_dict=npl_dict)
-            logger.info(f'After delete a package {package_id}, updated the newpackagelist 1.')
+        update_newpackagelist_version(db=db, package_id=package_id, package_name=package_name, action='deleted')
+        background_tasks.add_task(collect_storage_garbage)
 
         return JSONResponse(jsonable_encoder(resp))
     else:
@@ -295,28 +983,164 @@ def remove_package(package_id: int, db: Session = Depends(get_db)) -> json:
                             detail=f'The package {package_id} to be deleted does not exist.')
 
 
+def package_file_response(file_path: str,
+                          file_name: str,
+                          request: Request,
+                          package_hash: Optional[str],
+                          extra_headers: dict):
+    """
+    :return: None if neither the package file nor its chunks exist.
+    """
+    resp = download_tools.conditional_file_response(file_path=file_path,
+                                                    file_name=file_name,
+                                                    request_headers=request.headers,
+                                                    package_hash=package_hash,
+                                                    extra_headers=extra_headers)
+    if resp is None and package_hash:
+        # 包文件保存在chunk store中，按chunk顺序直接流式拼接到响应里
+        manifest = chunk_store.load_manifest(package_hash)
+        if manifest:
+            resp = download_tools.conditional_reader_response(reader=chunk_store.read_range(manifest),
+                                                              file_size=manifest['package_length'],
+                                                              file_name=file_name,
+                                                              request_headers=request.headers,
+                                                              data_hash=package_hash,
+                                                              extra_headers=extra_headers)
+    return resp
+
+
 @app.get("/packages/downloads/{zip_file_name}")
-async def download_package(zip_file_name: str):
+def download_package(zip_file_name: str, request: Request, place_code: Optional[str] = None,
+                     db: Session = Depends(get_db)):
     """
     An API for downloading package.
+    支持断点续传与并行分段下载(Range/If-Range，包括多段)，以及基于package_hash的ETag/If-None-Match
+    旧的下载地址，新版本的包会覆盖同名文件，所以代理缓存每次都需要重新验证
+    下载数量超出限制时返回429/503及`Retry-After`，见`download_scheduler.py`
     :param zip_file_name:
+    :param place_code: 可选，用于在各place之间公平地分配下载带宽，没有时使用客户端地址
     :return: The downloaded packages are always with .zip
     """
     file_path = f'{local_settings.PACKAGES_FOLDER}/{zip_file_name}'
-    if os.path.exists(file_path):
-        logger.debug(f'The request package {zip_file_name} is ready for downloading.')
 
-        return FileResponse(file_path, filename=f'{zip_file_name}')
+    # 已上传的包用数据库中的package_hash作为强ETag；newpackagelist.zip等没有记录的文件则用文件状态作为弱ETag
+    package_down_url = f'{local_settings.BASE_URL}/packages/downloads/{zip_file_name}'
+    db_package = crud.retrieve_package_by_down_url(db=db, package_down_url=package_down_url)
+    package_hash = db_package.package_hash if db_package else None
 
-    else:
+    resp = package_file_response(file_path=file_path, file_name=zip_file_name, request=request,
+                                 package_hash=package_hash, extra_headers={'Cache-Control': 'no-cache'})
+    if resp is None:
         logger.info(f'The request package {zip_file_name} not found.')
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'The request package {zip_file_name} not found.')
 
+    logger.debug(f'The request package {zip_file_name} is ready for downloading, status {resp.status_code}.')
+    resp = schedule_download(resp, place_code=place_code, request=request)
+    if db_package and counts_as_download(resp.status_code, request.headers.get('range')):
+        history_buffer.record_download(place_code=place_code, package_name=db_package.package_name,
+                                       package_version=db_package.package_version)
+    return resp
+
+
+@app.get('/packages/{package_id}/chunks', response_model=schemas.PackageChunks)
+def get_package_chunks(package_id: int, db: Session = Depends(get_db)):
+    """
+    package当前版本的chunk清单，客户端只需下载本地没有的chunk，再按顺序拼接并校验package_hash
+    """
+    db_package = crud.retrieve_package_by_package_id(db=db, package_id=package_id)
+    if not db_package:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Package {package_id} not found.')
+
+    manifest = chunk_store.load_manifest(db_package.package_hash)
+    if not manifest:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Package {package_id} is not in the chunk store.')
+
+    return {'package_id': package_id,
+            'package_version': db_package.package_version,
+            'package_hash': manifest['package_hash'],
+            'package_length': manifest['package_length'],
+            'chunk_down_url': f'{local_settings.BASE_URL}/chunks/{{chunk_hash}}',
+            'chunks': manifest['chunks']}
+
+
+@app.get('/chunks/{chunk_hash}')
+def download_chunk(chunk_hash: str, request: Request, place_code: Optional[str] = None):
+    """
+    下载单个chunk，chunk以其sha256命名，ETag即为chunk_hash
+    """
+    resp = None
+    if main_tools.is_sha256_hex(chunk_hash):
+        resp = download_tools.conditional_file_response(
+            file_path=chunk_store.chunk_path(chunk_hash), file_name=chunk_hash, request_headers=request.headers,
+            package_hash=chunk_hash, extra_headers={'Cache-Control': local_settings.IMMUTABLE_CACHE_CONTROL})
+    if resp is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Chunk {chunk_hash} not found.')
+    return schedule_download(resp, place_code=place_code, request=request)
+
+
+@app.get("/packages/downloads/patches/{patch_name}")
+def download_package_patch(patch_name: str, request: Request, place_code: Optional[str] = None,
+                           db: Session = Depends(get_db)):
+    """
+    下载增量补丁，ETag为补丁的hash；补丁名包含前后两个版本的hash，内容不会改变
+    """
+    db_patch = crud.retrieve_package_patch_by_name(db=db, patch_name=patch_name)
+    resp = None
+    if db_patch:
+        resp = download_tools.conditional_file_response(
+            file_path=patch_store.patch_path(patch_name), file_name=patch_name, request_headers=request.headers,
+            package_hash=db_patch.patch_hash, extra_headers={'Cache-Control': local_settings.IMMUTABLE_CACHE_CONTROL})
+    if resp is None:
+        logger.info(f'The request patch {patch_name} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'The request patch {patch_name} not found.')
+    resp = schedule_download(resp, place_code=place_code, request=request)
+    if counts_as_download(resp.status_code, request.headers.get('range')):
+        # 补丁下载记为目标版本的下载
+        history_buffer.record_download(place_code=place_code, package_hash=db_patch.to_hash)
+    return resp
+
+
+@app.get("/packages/downloads/{package_hash}/{zip_file_name}")
+def download_package_object(package_hash: str, zip_file_name: str, request: Request,
+                            place_code: Optional[str] = None):
+    """
+    按package_hash寻址的下载地址，同一地址的内容永不改变，可以被代理/CDN长期缓存
+    ETag即为地址中的package_hash，不需要查询数据库
+    """
+    resp = None
+    if main_tools.is_sha256_hex(package_hash):
+        resp = package_file_response(
+            file_path=main_tools.package_object_path(package_hash=package_hash, file_name=zip_file_name),
+            file_name=zip_file_name, request=request, package_hash=package_hash,
+            extra_headers={'Cache-Control': local_settings.IMMUTABLE_CACHE_CONTROL})
+    if resp is None:
+        logger.info(f'The request package {package_hash}/{zip_file_name} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'The request package {zip_file_name} not found.')
+
+    logger.debug(f'The request package {package_hash}/{zip_file_name} is ready for downloading, '
+                 f'status {resp.status_code}.')
+    resp = schedule_download(resp, place_code=place_code, request=request)
+    if counts_as_download(resp.status_code, request.headers.get('range')):
+        history_buffer.record_download(place_code=place_code, package_hash=package_hash)
+    return resp
+
 
 @app.get('/npl/', response_model=List[schemas.PackagesList])
-def get_newpackagelists(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)) -> list:
-    db_newpackagelists = crud.retrieve_newpackagelists(db=db, skip=skip, limit=limit)
+def get_newpackagelists(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+                        db: Session = Depends(get_db)) -> list:
+    """
+    每次版本更新增加一行，按版本顺序分页
+    - :param skip: 兼容旧的分页方式，深度分页请使用cursor
+    - :param cursor: 上一页返回的`X-Next-Cursor`，有下一页时才返回该header
+    """
+    db_newpackagelists = paginate('npl', crud.retrieve_newpackagelists(
+        db=db, skip=skip, limit=limit + 1, after_id=decode_cursor('npl', cursor)), limit=limit, response=response)
 
     if not db_newpackagelists:
         logger.error(f'No newpackagelist found.')
@@ -327,87 +1151,587 @@ def get_newpackagelists(skip: int = 0, limit: int = 100, db: Session = Depends(g
     return db_newpackagelists
 
 
+@app.get('/npl/diff/', response_model=schemas.PackagesListDiff)
+def get_newpackagelist_diff(place_code: str, packagelist_version: str, db: Session = Depends(get_db)):
+    """
+    返回客户端当前packagelist版本到最新版本之间，该place的增量变更
+    - :param place_code:
+    - :param packagelist_version: 客户端当前的packagelist版本
+    - :return: 变更日志已被清理或版本无法识别时，返回全量(full=True)
+    """
+    db_place = crud.retrieve_place_by_place_code(db=db, place_code=place_code)
+    if not db_place:
+        logger.info(f'Place {place_code} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Place {place_code} not found.')
+
+    newpackagelist = crud.retrieve_newpackagelist_desc(db=db)
+    if not newpackagelist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No packagelist found.')
+
+    diff = {'packagelist_name': newpackagelist.packagelist_name,
+            'from_version': packagelist_version,
+            'to_version': newpackagelist.packagelist_version,
+            'full': False,
+            'changes': []}
+    if packagelist_version == newpackagelist.packagelist_version:
+        return diff
+
+    def package_payload(db_package) -> dict:
+        return main_tools.assemble_package_dict(pname=db_package.package_name,
+                                                pversion=db_package.package_version,
+                                                plength=db_package.package_length,
+                                                phash=db_package.package_hash,
+                                                pdownurl=db_package.package_down_url,
+                                                ppath=db_package.package_path,
+                                                pcmd=db_package.package_run_cmd,
+                                                pdel=db_package.package_del_cmd)
+
+    oldest_version = crud.retrieve_oldest_packagelist_change_version(db=db)
+    client_version = int(packagelist_version) if packagelist_version.isdigit() else None
+    if client_version is None or oldest_version is None or client_version + 1 < oldest_version \
+            or client_version > int(newpackagelist.packagelist_version):
+        # 无法计算增量，返回该place的全部packages
+        logger.info(f'Full packagelist for place {place_code} from version {packagelist_version}.')
+        diff['full'] = True
+        diff['changes'] = [{'action': 'upsert', 'package_name': db_package.package_name,
+                            'package': package_payload(db_package)}
+                           for db_package in crud.retrieve_enabled_packages_by_place(
+                               db=db, place_id=db_place.id, place_code=db_place.place_code)]
+        return diff
+
+    # 同一个package多次变更只保留最终状态，以当前数据判断是否仍可更新到该place
+    changed_names = list(dict.fromkeys(change.package_name for change in
+                                       crud.retrieve_packagelist_changes_since(db=db,
+                                                                               packagelist_version=client_version)))
+    enabled_packages = {db_package.package_name: db_package for db_package in
+                        crud.retrieve_enabled_packages_by_place(db=db, place_id=db_place.id,
+                                                                place_code=db_place.place_code,
+                                                                package_names=changed_names)}
+    for package_name in changed_names:
+        if package_name in enabled_packages:
+            diff['changes'].append({'action': 'upsert', 'package_name': package_name,
+                                    'package': package_payload(enabled_packages[package_name])})
+        else:
+            diff['changes'].append({'action': 'remove', 'package_name': package_name, 'package': None})
+
+    logger.debug(f'Packagelist diff for place {place_code}: {packagelist_version} -> '
+                 f'{newpackagelist.packagelist_version}, {len(diff["changes"])} changes.')
+    return diff
+
+
+@app.get('/npl/downloads/{place_code}/{packagelist_version}/{zip_file_name}')
+def download_newpackagelist(place_code: str, packagelist_version: str, zip_file_name: str, request: Request,
+                            db: Session = Depends(get_db)):
+    """
+    旧的下载地址，不包含manifest的hash，代理缓存每次都需要重新验证
+    """
+    return newpackagelist_response(place_code=place_code, packagelist_version=packagelist_version,
+                                   packagelist_hash=None, zip_file_name=zip_file_name, request=request, db=db)
+
+
+@app.get('/npl/downloads/{place_code}/{packagelist_version}/{packagelist_hash}/{zip_file_name}')
+def download_newpackagelist_snapshot(place_code: str, packagelist_version: str, packagelist_hash: str,
+                                     zip_file_name: str, request: Request, db: Session = Depends(get_db)):
+    """
+    地址中包含manifest的hash前缀，同一地址的内容永不改变，可以被代理/CDN长期缓存
+    """
+    return newpackagelist_response(place_code=place_code, packagelist_version=packagelist_version,
+                                   packagelist_hash=packagelist_hash, zip_file_name=zip_file_name,
+                                   request=request, db=db)
+
+
+def newpackagelist_response(place_code: str,
+                            packagelist_version: str,
+                            packagelist_hash: Optional[str],
+                            zip_file_name: str,
+                            request: Request,
+                            db: Session):
+    """
+    下载某place的newpackagelist.zip，内容来自内存中的manifest缓存，不读写文件
+    """
+    db_place = crud.retrieve_place_by_place_code(db=db, place_code=place_code)
+    newpackagelist = crud.retrieve_newpackagelist_desc(db=db)
+    if not db_place or not newpackagelist or zip_file_name != local_settings.ZIP_FILE_NAME \
+            or newpackagelist.packagelist_version != packagelist_version:
+        # 旧版本的manifest不再提供，客户端应重新请求`/updblaster/`获取最新的下载地址
+        logger.info(f'The request newpackagelist {place_code}/{packagelist_version} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'The request newpackagelist {place_code}/{packagelist_version} not found.')
+
+    manifest = get_or_build_manifest(newpackagelist=newpackagelist, db_place=db_place, db=db)
+    if not manifest:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No package found.')
+
+    data_hash = manifest.resp_dict['package_hash']
+    if packagelist_hash is None:
+        cache_control = 'no-cache'
+    elif data_hash.startswith(packagelist_hash) and len(packagelist_hash) >= 16:
+        cache_control = local_settings.IMMUTABLE_CACHE_CONTROL
+    else:
+        logger.info(f'The request newpackagelist {place_code}/{packagelist_version}/{packagelist_hash} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'The request newpackagelist {place_code}/{packagelist_version} not found.')
+
+    resp = download_tools.conditional_bytes_response(data=manifest.zip_bytes,
+                                                     file_name=zip_file_name,
+                                                     request_headers=request.headers,
+                                                     data_hash=data_hash,
+                                                     extra_headers={'Cache-Control': cache_control})
+    if counts_as_download(resp.status_code, request.headers.get('range')):
+        history_buffer.record_download(place_code=place_code, package_name=manifest.resp_dict['package_name'],
+                                       package_version=packagelist_version)
+    return resp
+
+
+def load_place_index(db: Session) -> coverage.PlaceIndex:
+    return coverage.PlaceIndex(crud.retrieve_place_codes_all(db=db))
+
+
+@app.get('/coverage/', response_model=schemas.CoverageMatrix, summary='Coverage of all places by all packages')
+def get_coverage(package_names: Optional[str] = None, expand: bool = False, db: Session = Depends(get_db)):
+    """
+    一次计算全部places × packages的可更新范围(黑白名单及分批发布)，不需要逐个place、package调用`/updblaster/`
+    - :param package_names: 可选，逗号分隔，只返回这些packages
+    - :param expand: 同时列出每个package可更新到的place_code，places很多时返回内容较大
+    - :return: places为全部place_code，每个package的bitmap中第i位对应places[i]
+    """
+    places = load_place_index(db=db)
+    db_packages = crud.retrieve_packages_all(db=db)
+    if package_names:
+        names = set(package_names.split(','))
+        db_packages = [db_package for db_package in db_packages if db_package.package_name in names]
+        rules = crud.retrieve_package_place_rules(db=db, package_ids=[db_package.id for db_package in db_packages])
+    else:
+        rules = crud.retrieve_package_place_rules_all(db=db)
+    rules = coverage.group_rules(rules)
+    rollouts = {package_id: rollout_state(waves, opened_waves, exempt_places) for
+                package_id, waves, opened_waves, exempt_places in crud.retrieve_package_rollouts_all(db=db)}
+
+    packages = []
+    for db_package in db_packages:
+        allow, deny = rules.get(db_package.id, ((), ()))
+        mask = places.coverage(allow, deny, rollouts.get(db_package.id))
+        package_coverage = {'package_id': db_package.id,
+                            'package_name': db_package.package_name,
+                            'count': coverage.count(mask),
+                            'bitmap': places.bitmap(mask)}
+        if expand:
+            package_coverage['place_codes'] = places.place_codes_of(mask)
+        packages.append(package_coverage)
+
+    # 不经过response_model逐项校验，places可能有数万个
+    return RawJSONResponse(content=dumps({'place_count': len(places),
+                                          'places': places.place_codes,
+                                          'packages': packages}))
+
+
+@app.post('/coverage/what-if/', response_model=schemas.CoverageWhatIfResult, summary='Preview a publish')
+def preview_coverage(query: schemas.CoverageWhatIf, db: Session = Depends(get_db)):
+    """
+    预览以新的黑白名单(及分批发布)发布之后的可更新范围，与当前范围比较，不做任何修改
+    - :return: added/removed为新增/失去该package的place_code
+    """
+    db_package = crud.retrieve_package_by_package_name(db=db, package_name=query.package_name)
+    if not db_package:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Package {query.package_name} not found.')
+    if query.rollout_waves is not None and not (2 <= query.rollout_waves <= local_settings.ROLLOUT_MAX_WAVES
+                                                and 1 <= query.rollout_opened_waves <= query.rollout_waves):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Invalid rollout {query.rollout_opened_waves}/{query.rollout_waves} waves.')
+
+    places = load_place_index(db=db)
+    allow, deny = coverage.group_rules(crud.retrieve_package_place_rules(db=db, package_ids=[db_package.id])).get(
+        db_package.id, ((), ()))
+    db_rollout = crud.retrieve_package_rollout(db=db, package_id=db_package.id)
+    current = places.coverage(allow, deny, rollout_state(db_rollout.waves, db_rollout.opened_waves,
+                                                         db_rollout.exempt_places) if db_rollout else None)
+    proposed = coverage.proposed_coverage(places, valid_places=query.valid_places,
+                                          invalid_places=query.invalid_places, current=current,
+                                          rollout_waves=query.rollout_waves,
+                                          rollout_opened_waves=query.rollout_opened_waves)
+    return RawJSONResponse(content=dumps({'package_name': db_package.package_name,
+                                          'place_count': len(places),
+                                          'current_count': coverage.count(current),
+                                          'proposed_count': coverage.count(proposed),
+                                          'added': places.place_codes_of(proposed & ~current),
+                                          'removed': places.place_codes_of(current & ~proposed),
+                                          'bitmap': places.bitmap(proposed)}))
+
+
+@app.get('/history/', response_model=List[schemas.History])
+def get_histories(package_name: Optional[str] = None,
+                  place_code: Optional[str] = None,
+                  skip: int = 0,
+                  limit: int = Query(100, le=1000),
+                  db: Session = Depends(get_db)):
+    """
+    各place下载/轮询各版本的记录，最多落后`HISTORY_FLUSH_INTERVAL_SECONDS`秒
+    - :param package_name: 可选，packagelist本身的记录为`packagelist`
+    - :param place_code: 可选，没有带上place_code的下载记录在''下
+    """
+    return crud.retrieve_histories(db=db, package_name=package_name, place_code=place_code, skip=skip, limit=limit)
+
+
+@app.get('/history/adoption/{package_name}', response_model=schemas.PackageAdoption)
+def get_package_adoption(package_name: str, db: Session = Depends(get_db)):
+    """
+    按版本汇总：下载或轮询过该版本的places数、当前(最近一次)为该版本的places数及下载/轮询次数
+    """
+    db_histories = crud.retrieve_histories_by_package_name(db=db, package_name=package_name)
+    if not db_histories:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No history of package {package_name} found.')
+    return {'package_name': package_name, 'versions': adoption_rollups(db_histories)}
+
+
+@app.get('/stats/downloads/', summary='Download scheduler statistics')
+def get_download_stats():
+    """
+    当前worker的下载数量、被拒绝(429/503)的次数、等待中的请求及已发送的字节数，以及尚未写入history表的计数
+    """
+    return JSONResponse(content=dict(download_scheduler.stats(), history=history_buffer.stats()))
+
+
+@app.get('/stats/caches/', summary='Cache statistics')
+def get_cache_stats():
+    """
+    各缓存的命中/未命中次数，用于确认客户端轮询没有访问数据库
+    """
+    shared_generations.check()
+    return JSONResponse(content={'lookup_cache': lookup_cache.stats(),
+                                 'manifest_cache': manifest_cache.stats(),
+                                 'client_flights': client_flights.stats(),
+                                 'hot_files': hot_file_cache.stats(),
+                                 'generations': shared_generations.generations()})
+
+
+async def get_or_build_manifest_async(newpackagelist: schemas.PackagesList,
+                                     db_place: schemas.Place) -> Optional[ManifestEntry]:
+    """
+    缓存命中时直接返回；未命中时在线程池中用同步session生成，生成过程不阻塞事件循环
+    同一个(版本, place)的并发请求只占用一个线程，其余请求等待其结果
+    """
+    key = (newpackagelist.packagelist_version, db_place.id)
+    manifest = manifest_cache.get(key)
+    if manifest is not None:
+        return manifest if manifest.resp_dict else None
+
+    def build() -> Optional[ManifestEntry]:
+        db = SessionLocal()
+        try:
+            return get_or_build_manifest(newpackagelist=newpackagelist, db_place=db_place, db=db)
+        finally:
+            db.close()
+    return await client_flights.do(('manifest',) + key, lambda: run_in_threadpool(build))
+
+
+async def resolve_packagelist_manifest(db: AsyncSession, place_code: str) -> ManifestEntry:
+    """
+    该place在最新packagelist版本的manifest，其中`resp_dict`为`newpackagelist.zip`下载信息
+    :raise HTTPException: 404 if the place, the packagelist or any enabled package is not found.
+    """
+    # 一次查询获取place及最新id的newpackagelist，也可以达到判断是否为空表的功能
+    db_place, newpackagelist = await async_crud.retrieve_place_and_newpackagelist_desc(db=db, place_code=place_code)
+    if not db_place:
+        logger.error(f'No place found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No place found.')
+
+    if not newpackagelist:
+        logger.error(f'No newpackagelist found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No packagelist found.')
+
+    # 版本未变化时直接使用缓存，不查询packages，也不生成zip
+    # [TODO]: 如果一个包都没有，部署器端无法识别，需要增加冗余方法
+    manifest = await get_or_build_manifest_async(newpackagelist=newpackagelist, db_place=db_place)
+    if not manifest:
+        logger.error(f'No package found for place {place_code}.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'No package found.')
+    return manifest
+
+
+def record_packagelist_poll(place_code: str, manifest: ManifestEntry):
+    """
+    packagelist本身按package记录，版本为packagelist版本
+    """
+    history_buffer.record_poll(place_code=place_code, package_name=manifest.resp_dict['package_name'],
+                               package_version=manifest.resp_dict['package_version'])
+
+
+async def resolve_packagelist_manifest_briefly(place_code: str) -> ManifestEntry:
+    """
+    订阅接口长时间保持连接，数据库session只在查询期间持有，不占用连接池
+    """
+    shared_generations.check()
+    async with AsyncSessionLocal() as db:
+        return await resolve_packagelist_manifest(db=db, place_code=place_code)
+
+
+@app.get('/npl/watch/', summary='Long-poll packagelist version')
+async def watch_newpackagelist(place_code: str,
+                               request: Request,
+                               packagelist_version: Optional[str] = None,
+                               timeout: float = Query(local_settings.NPL_WATCH_TIMEOUT_SECONDS, gt=0,
+                                                      le=local_settings.NPL_WATCH_MAX_TIMEOUT_SECONDS)):
+    """
+    长轮询：客户端带上本地的packagelist版本，版本变化时立即返回与`/updblaster/?package_name=packagelist`相同的内容，
+    超时仍未变化则返回304，客户端随即重新发起请求
+    - :param packagelist_version: 客户端当前的版本，为空时立即返回最新版本
+    - :param timeout: 最长等待秒数
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        generation = packagelist_notifier.generation
+        manifest = await resolve_packagelist_manifest_briefly(place_code=place_code)
+        if manifest.resp_dict['package_version'] != packagelist_version:
+            record_packagelist_poll(place_code=place_code, manifest=manifest)
+            return encoded_json_response(manifest.resp_body, request_headers=request.headers)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not await packagelist_notifier.wait(generation=generation, timeout=remaining):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+
+
+@app.get('/npl/events/', summary='Packagelist version events (SSE)')
+async def stream_newpackagelist_events(place_code: str, request: Request):
+    """
+    Server-Sent Events：连接后先推送当前版本，之后每次版本变化推送一个`packagelist`事件，
+    事件id为packagelist版本，断线重连时通过`Last-Event-ID`跳过已收到的版本
+    """
+    manifest = await resolve_packagelist_manifest_briefly(place_code=place_code)
+
+    async def events():
+        nonlocal manifest
+        last_version = request.headers.get('last-event-id')
+        while True:
+            generation = packagelist_notifier.generation
+            if manifest.resp_dict['package_version'] != last_version:
+                last_version = manifest.resp_dict['package_version']
+                record_packagelist_poll(place_code=place_code, manifest=manifest)
+                yield b'id: %s\nevent: packagelist\ndata: %s\n\n' % (last_version.encode(),
+                                                                    manifest.resp_body.identity)
+            if not await packagelist_notifier.wait(generation=generation,
+                                                   timeout=local_settings.NPL_SSE_HEARTBEAT_SECONDS):
+                yield ': keepalive\n\n'
+                continue
+            try:
+                manifest = await resolve_packagelist_manifest_briefly(place_code=place_code)
+            except HTTPException as e:
+                # place被删除或不再有可更新的package时结束推送，客户端重连时会得到对应的错误
+                logger.info(f'Packagelist events of place {place_code} ended: {e.detail}')
+                return
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def ensure_eligibility_loaded(db: AsyncSession):
+    """
+    查询期间如有发布或规则变化（本worker或其他worker），丢弃这次查询的结果重新查询，
+    否则索引会一直使用写入之前的快照，重新查询使用新的session，不会读到同一个事务快照
+    """
+    async def query(session: AsyncSession):
+        rules = await async_crud.retrieve_package_place_rules_all(db=session)
+        rollouts = [(package_id, rollout_state(waves, opened_waves, exempt_places)) for
+                    package_id, waves, opened_waves, exempt_places in
+                    await async_crud.retrieve_package_rollouts_all(db=session)]
+        return rules, rollouts
+
+    async def load():
+        generation = eligibility_index.generation
+        rules, rollouts = await query(db)
+        while True:
+            # 查询期间其他worker的写入
+            shared_generations.check()
+            if eligibility_index.ensure_loaded(loader=lambda: rules, rollout_loader=lambda: rollouts,
+                                               generation=generation):
+                return
+            generation = eligibility_index.generation
+            async with AsyncSessionLocal() as session:
+                rules, rollouts = await query(session)
+
+    if not eligibility_index.loaded:
+        await client_flights.do(('eligibility',), load)
+
+
+def assemble_client_package_dict(db_package: schemas.Package, db_patches: List[schemas.PackagePatch]) -> dict:
+    patches = [main_tools.assemble_patch_dict(from_version=db_patch.from_version,
+                                              from_hash=db_patch.from_hash,
+                                              patch_name=db_patch.patch_name,
+                                              plength=db_patch.patch_length,
+                                              phash=db_patch.patch_hash) for db_patch in db_patches]
+    return main_tools.assemble_package_dict(pname=db_package.package_name,
+                                            pversion=db_package.package_version,
+                                            plength=db_package.package_length,
+                                            phash=db_package.package_hash,
+                                            pdownurl=db_package.package_down_url,
+                                            ppath=db_package.package_path,  # [games]:\\blaster\\happymj\\
+                                            pcmd=db_package.package_run_cmd,
+                                            pdel=db_package.package_del_cmd,
+                                            ppatches=patches)
+
+
+def client_package_key(db_package: schemas.Package) -> tuple:
+    """
+    客户端数据用到的所有字段，保证请求中途发布的包不会缓存成旧的数据
+    """
+    return (db_package.id, db_package.package_hash, db_package.package_version, db_package.package_length,
+            db_package.package_down_url, db_package.package_path, db_package.package_run_cmd,
+            db_package.package_del_cmd)
+
+
+async def render_client_package(db: AsyncSession, db_package: schemas.Package) -> EncodedBody:
+    """
+    包的客户端数据只在发布时变化，每个版本只组装、编码、压缩一次，之后的请求直接返回缓存的bytes
+    """
+    async def loader():
+        db_patches = await async_crud.retrieve_package_patches_to(db=db, package_id=db_package.id,
+                                                                  to_hash=db_package.package_hash)
+        return encode_variants(dumps(assemble_client_package_dict(db_package=db_package, db_patches=db_patches)))
+    return await lookup_cache.get_or_load(PAYLOADS, client_package_key(db_package), loader)
+
+
+async def render_client_packages(db: AsyncSession, db_packages: List[schemas.Package]) -> Dict[int, bytes]:
+    """
+    同`render_client_package`，未缓存的包的patches通过一次`IN`查询获取
+    :return: package id -> payload, not compressed.
+    """
+    payloads, missing = {}, []
+    for db_package in db_packages:
+        payload = lookup_cache.get(PAYLOADS, client_package_key(db_package))
+        if payload is MISSING:
+            missing.append(db_package)
+        else:
+            payloads[db_package.id] = payload.identity
+    if not missing:
+        return payloads
+
+    generation = lookup_cache.generation(PAYLOADS)
+    db_patches = await async_crud.retrieve_packages_patches_to(
+        db=db, targets=[(db_package.id, db_package.package_hash) for db_package in missing])
+    for db_package in missing:
+        payload = encode_variants(dumps(assemble_client_package_dict(
+            db_package=db_package, db_patches=db_patches[(db_package.id, db_package.package_hash)])))
+        lookup_cache.put(PAYLOADS, client_package_key(db_package), payload, generation)
+        payloads[db_package.id] = payload.identity
+    return payloads
+
+
 @app.get("/updblaster/", summary='Main API')
-def resp_to_client(package_name: str, place_code: str, db: Session = Depends(get_db)) -> json:
+async def resp_to_client(package_name: str, place_code: str, request: Request,
+                         db: AsyncSession = Depends(get_async_db)) -> json:
     """
     Main API for communicating with client.
     可更新self_service, packagelist.json, <normal_package>
+    异步查询数据库，轮询请求不占用线程池
     - :param package_name: Package to be updated.
     - :param place_code: If this place_code is enabled to be updated.
-    - :param db: DB session.
-    - :return: A manual composed JSON response.
+    - :param db: Async DB session.
+    - :return: A manual composed JSON response, compressed according to `Accept-Encoding`.
     """
     if package_name == 'packagelist':
         """
-        如果是此字符串，则查询数据库的最新数据并更新`newpackagelist.json`，
-        将json文件压缩成zip包，生成下载URL，返回
+        如果是此字符串，则返回该place在最新packagelist版本的`newpackagelist.zip`下载信息，
+        其中只包含可更新到该place的packages，按(版本, place)缓存在内存中
         """
-        db_packages = crud.retrieve_packages_all(db=db)  # 不分页，获取所有packages
-        # [TODO]: 如果一个包都没有，部署器端无法识别，需要增加冗余方法
-        if not db_packages:
-            logger.error(f'No package found.')
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f'No package found.')
-
-        db_place = crud.retrieve_place_by_place_code(db=db, place_code=place_code)
-        if not db_place:
-            logger.error(f'No place found.')
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f'No place found.')
-
-        # 倒序获取最新id的行数据，也可以达到判断是否为空表的功能
-        newpackagelist: schemas.PackagesList = crud.retrieve_newpackagelist_desc(db=db)
-        if not newpackagelist:
-            logger.error(f'No newpackagelist found.')
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f'No packagelist found.')
-
-        # 组装外层newpackagelist的数据
-        newpackagelist_dict = main_tools.assemble_newpackagelist_dict(newpackagelist=newpackagelist,
-                                                                      packages=db_packages)
-
-        # 生成json文件并压缩成zip包
-        resp_dict = main_tools.generate_zipped_json_file_then_resp(newpackagelist_dict=newpackagelist_dict)
-        if not resp_dict:
-            logger.error(f'Internal error occurred when dealing with newpackagelist, json, zip, and resp_dict.')
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                detail=f'Internal error occurred.')
-
-        return JSONResponse(content=jsonable_encoder(resp_dict))
+        manifest = await resolve_packagelist_manifest(db=db, place_code=place_code)
+        record_packagelist_poll(place_code=place_code, manifest=manifest)
+        return encoded_json_response(manifest.resp_body, request_headers=request.headers)
 
     else:
         """
         请求: package_name != "packagelist"，则正常处理包请求
         """
-        db_package: schemas.Package = crud.retrieve_package_by_package_name(db, package_name=package_name)
+        # 一次查询同时获取package及place
+        db_package, db_place = await async_crud.retrieve_package_and_place(db=db, package_name=package_name,
+                                                                           place_code=place_code)
         if not db_package:
             logger.info(f'Package {package_name} not found.')
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=f'Package {package_name} not found.')
 
-        db_place: schemas.Place = crud.retrieve_place_by_place_code(db, place_code=place_code)
         if not db_place:
             logger.info(f'Place {place_code} not found.')
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                 detail=f'Place {place_code} not found.')
 
-        # 检查package是否在可更新范围内
-        if not main_tools.check_update_enabled(package=db_package, place=db_place):
+        # 检查package是否在可更新范围内，使用预先编译好的索引，不再逐次解析黑白名单字符串
+        await ensure_eligibility_loaded(db=db)
+        if not eligibility_index.is_enabled(package_id=db_package.id, place_id=db_place.id,
+                                            place_code=db_place.place_code):
             logger.info(f'The place {db_place.place_name} is forbidden to be updated.')
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail=f"This package {package_name} are not enabled to be updated.")
 
-        # 组装返回数据
-        resp_dict = main_tools.assemble_package_dict(pname=db_package.package_name,
-                                                     pversion=db_package.package_version,
-                                                     plength=db_package.package_length,
-                                                     phash=db_package.package_hash,
-                                                     pdownurl=db_package.package_down_url,
-                                                     ppath=db_package.package_path,  # [games]:\\blaster\\happymj\\
-                                                     pcmd=db_package.package_run_cmd,
-                                                     pdel=db_package.package_del_cmd)
-
-        return JSONResponse(content=jsonable_encoder(resp_dict))
+        # 返回数据已预先编码，旧版本到当前版本的增量补丁一并返回
+        history_buffer.record_poll(place_code=place_code, package_name=db_package.package_name,
+                                   package_version=db_package.package_version)
+        return encoded_json_response(await render_client_package(db=db, db_package=db_package),
+                                     request_headers=request.headers)
+
+
+@app.post('/updblaster/batch/', summary='Main API, many packages at once')
+async def resp_to_client_batch(query: schemas.ClientPackagesQuery, db: AsyncSession = Depends(get_async_db)) -> json:
+    """
+    一次请求检查一个place的多个包，代替逐个请求`/updblaster/`
+    只查询一次place，未缓存的packages及patches各通过一次`IN`查询获取
+    - :param query: place_code及客户端本地的包，可带上当前的package_version或package_hash
+    - :return: 按请求顺序返回每个包的状态:
+        - `update`: `package`中为与`/updblaster/`相同的内容
+        - `unchanged`: 客户端已是最新版本
+        - `forbidden`: 该place不在可更新范围内
+        - `not_found`: 没有该包
+    """
+    if len(query.packages) > local_settings.BATCH_MAX_PACKAGES:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'At most {local_settings.BATCH_MAX_PACKAGES} packages per request.')
+
+    db_place = await async_crud.retrieve_place_by_place_code(db=db, place_code=query.place_code)
+    if not db_place:
+        logger.info(f'Place {query.place_code} not found.')
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Place {query.place_code} not found.')
+
+    db_packages = await async_crud.retrieve_packages_by_package_names(
+        db=db, package_names=dict.fromkeys(client_package.package_name for client_package in query.packages))
+    await ensure_eligibility_loaded(db=db)
+
+    statuses, updates = [], {}
+    for client_package in query.packages:
+        db_package = db_packages[client_package.package_name]
+        if not db_package:
+            package_status = 'not_found'
+        elif not eligibility_index.is_enabled(package_id=db_package.id, place_id=db_place.id,
+                                            place_code=db_place.place_code):
+            package_status = 'forbidden'
+        elif client_package.package_hash == db_package.package_hash or (
+                client_package.package_hash is None and client_package.package_version == db_package.package_version):
+            package_status = 'unchanged'
+        else:
+            package_status = 'update'
+            updates[client_package.package_name] = db_package
+        if package_status in ('unchanged', 'update'):
+            history_buffer.record_poll(place_code=db_place.place_code, package_name=db_package.package_name,
+                                       package_version=db_package.package_version)
+        statuses.append((client_package.package_name, package_status))
+
+    # 只为需要更新的包获取patches，已编码的数据直接拼接到返回内容中
+    payloads = await render_client_packages(db=db, db_packages=list(updates.values()))
+    entries = []
+    for package_name, package_status in statuses:
+        entry = dumps({'package_name': package_name, 'status': package_status})
+        if package_status == 'update':
+            entry = entry[:-1] + b',"package":' + payloads[updates[package_name].id] + b'}'
+        entries.append(entry)
+
+    return RawJSONResponse(content=b'{"place_code":' + dumps(db_place.place_code) +
+                                   b',"packages":[' + b','.join(entries) + b']}')
 
 
 if __name__ == '__main__':
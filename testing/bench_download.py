@@ -0,0 +1,63 @@
+"""
+Throughput of the download responses, without the network: the ASGI `send` only counts the bytes.
+    python testing/bench_download.py
+
+- FileResponse: reads by 64 KiB through `anyio.open_file` (the previous path)
+- SendfileResponse: `os.pread` by `FILE_SEND_CHUNK_SIZE`, when the server offers no zero-copy send
+- MappedFileResponse: slices of a `HotFileCache` mapping, handed to the server without copying,
+  so its number is the overhead of the response only, the copy to the socket happens in the server
+"""
+import os
+import tempfile
+import time
+
+import anyio
+from fastapi.responses import FileResponse
+
+from updblaster.simple_tools.file_engine import HotFileCache, MappedFileResponse, SendfileResponse
+
+SIZES = {'patch 256 KiB': 256 * 1024, 'chunk 4 MiB': 4 * 1024 * 1024, 'package 64 MiB': 64 * 1024 * 1024}
+TOTAL_BYTES = 1024 * 1024 * 1024  # Sent per case.
+
+
+async def measure(make_response) -> float:
+    sent = 0
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal sent
+        if message['type'] == 'http.response.body':
+            sent += len(message['body'])
+
+    started = time.perf_counter()
+    while sent < TOTAL_BYTES:
+        await make_response()({'type': 'http', 'extensions': {}}, receive, send)
+    return sent / (time.perf_counter() - started) / 1024 / 1024
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as folder:
+        for name, size in SIZES.items():
+            file_path = os.path.join(folder, 'bench.zip')
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(size))
+            stat_result = os.stat(file_path)
+            cache = HotFileCache(max_bytes=size, max_file_size=size, admit_hits=1)
+            mapping = cache.get(file_path, stat_result)
+
+            cases = {'FileResponse': lambda: FileResponse(file_path, filename='bench.zip', stat_result=stat_result),
+                     'SendfileResponse': lambda: SendfileResponse(file_path=file_path, stat_result=stat_result,
+                                                                  file_name='bench.zip', headers={},
+                                                                  media_type='application/zip'),
+                     'MappedFileResponse': lambda: MappedFileResponse(mapping=cache.get(file_path, stat_result),
+                                                                      file_name='bench.zip', headers={},
+                                                                      media_type='application/zip')}
+            assert mapping is not None
+            for case, make_response in cases.items():
+                print(f'{name:>15} {case:>18}: {await measure(make_response):8.0f} MiB/s')
+
+
+if __name__ == '__main__':
+    anyio.run(main)
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark of the `/updblaster/` response encoding.
+    python testing/bench_json.py
+
+- generic: `assemble_package_dict` -> `jsonable_encoder` -> `JSONResponse`, on every request (the previous path)
+- stdlib/orjson: the payload is encoded once with `json_tools.dumps`
+- raw: every request only wraps the encoded bytes in `RawJSONResponse` (the current path)
+"""
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from updblaster.simple_tools import json_tools, main_tools
+
+NUMBER = 20000
+
+
+def assemble():
+    patches = [main_tools.assemble_patch_dict(from_version=str(version),
+                                              from_hash='%064x' % version,
+                                              patch_name=f'happymj_{version}_9.patch',
+                                              plength='123456',
+                                              phash='%064x' % (version + 100)) for version in range(6, 9)]
+    return main_tools.assemble_package_dict(pname='happymj',
+                                            pversion='9',
+                                            plength='52428800',
+                                            phash='%064x' % 9,
+                                            pdownurl='http://127.0.0.1:21080/packages/downloads/%064x/happymj.zip' % 9,
+                                            ppath='[games]:\\blaster\\happymj\\',
+                                            pcmd='start.bat',
+                                            pdel='',
+                                            ppatches=patches)
+
+
+def stdlib_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+if __name__ == '__main__':
+    resp_dict = assemble()
+    body = json_tools.dumps(resp_dict)
+    assert JSONResponse(content=jsonable_encoder(resp_dict)).body == body == stdlib_dumps(resp_dict)
+
+    cases = {'generic': lambda: JSONResponse(content=jsonable_encoder(assemble())),
+             'stdlib': lambda: stdlib_dumps(resp_dict),
+             'raw': lambda: json_tools.RawJSONResponse(content=body)}
+    if json_tools.orjson is not None:
+        cases['orjson'] = lambda: json_tools.orjson.dumps(resp_dict)
+
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=NUMBER, repeat=3))
+        print(f'{name:>8}: {seconds / NUMBER * 1e6:8.2f} us per response')
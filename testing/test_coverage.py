@@ -0,0 +1,109 @@
+import base64
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from updblaster.simple_tools import coverage
+from updblaster.simple_tools.coverage import PlaceIndex, proposed_coverage
+from updblaster.simple_tools.eligibility import compile_package_rules
+from updblaster.simple_tools.main_tools import check_update_enabled
+from updblaster.simple_tools.rollout import rollout_state
+
+PLACES = [SimpleNamespace(id=place_id, place_code=f'place-{place_id}') for place_id in range(1, 301)]
+
+
+@pytest.fixture
+def places():
+    # Not in id order, the bits follow the order of the index.
+    shuffled = list(PLACES)
+    random.Random(24).shuffle(shuffled)
+    return PlaceIndex((place.id, place.place_code) for place in shuffled)
+
+
+def join(place_ids) -> str:
+    return ','.join(str(place_id) for place_id in sorted(place_ids))
+
+
+def package(valid_places, invalid_places):
+    return SimpleNamespace(valid_places=valid_places, invalid_places=invalid_places)
+
+
+def rollout(waves, opened_waves, exempt_places=None):
+    return SimpleNamespace(waves=waves, opened_waves=opened_waves, exempt_places=exempt_places)
+
+
+def expected_mask(places: PlaceIndex, db_package, db_rollout=None) -> int:
+    """
+    The coverage, one `check_update_enabled` per place.
+    """
+    return places.mask(place.id for place in PLACES if check_update_enabled(db_package, place, db_rollout))
+
+
+def current_mask(places: PlaceIndex, db_package, db_rollout=None) -> int:
+    allow, deny = compile_package_rules(db_package.valid_places, db_package.invalid_places)
+    return places.coverage(allow, deny, rollout_state(db_rollout.waves, db_rollout.opened_waves,
+                                                      db_rollout.exempt_places) if db_rollout else None)
+
+
+ALLOW_ALL = join(range(1, 301))
+RULES = [
+    (ALLOW_ALL, None),
+    (ALLOW_ALL, join(range(1, 301, 7))),
+    (join(range(50, 250)) + ',999', join(range(100, 120)) + ',abc'),
+    ('', None),
+    (None, ALLOW_ALL),
+]
+ROLLOUTS = [None, rollout(10, 0), rollout(10, 3), rollout(100, 25), rollout(10, 10), rollout(4, 7),
+            rollout(10, 1, exempt_places=join(range(1, 301, 3))), rollout(10, 0, exempt_places='5,6,7,1000')]
+
+
+@pytest.mark.parametrize('db_rollout', ROLLOUTS)
+@pytest.mark.parametrize('valid_places, invalid_places', RULES)
+def test_coverage_matches_check_update_enabled(places, valid_places, invalid_places, db_rollout):
+    db_package = package(valid_places, invalid_places)
+    mask = current_mask(places, db_package, db_rollout)
+    assert mask == expected_mask(places, db_package, db_rollout)
+    assert coverage.count(mask) == sum(check_update_enabled(db_package, place, db_rollout) for place in PLACES)
+    assert sorted(places.place_codes_of(mask)) == sorted(
+        place.place_code for place in PLACES if check_update_enabled(db_package, place, db_rollout))
+
+
+def test_waves_grow_monotonically(places):
+    db_package = package(ALLOW_ALL, None)
+    masks = [current_mask(places, db_package, rollout(10, opened_waves)) for opened_waves in range(11)]
+    assert masks[0] == 0
+    assert 0 < coverage.count(masks[3]) < len(PLACES)
+    assert masks[-1] == places.mask(place.id for place in PLACES)
+    for smaller, larger in zip(masks, masks[1:]):
+        assert smaller & ~larger == 0
+
+
+@pytest.mark.parametrize('rollout_waves, rollout_opened_waves', [(None, 1), (10, 1), (10, 4), (100, 30), (5, 5)])
+@pytest.mark.parametrize('current_rules, current_rollout', [
+    ((join(range(1, 101)), None), None),
+    ((ALLOW_ALL, join(range(1, 301, 2))), rollout(10, 5, exempt_places='2,4,6')),
+    ((None, None), None),
+])
+def test_proposed_coverage_matches_publish(places, current_rules, current_rollout, rollout_waves,
+                                           rollout_opened_waves):
+    """
+    The proposed coverage is what `check_update_enabled` gives after the publish, the places enabled before it
+    being exempt from the new rollout, see `main.rollout_exempt_places`.
+    """
+    current = current_mask(places, package(*current_rules), current_rollout)
+    new_package = package(join(range(20, 280)), join(range(60, 70)))
+    proposed = proposed_coverage(places, new_package.valid_places, new_package.invalid_places, current=current,
+                                 rollout_waves=rollout_waves, rollout_opened_waves=rollout_opened_waves)
+
+    exempt_places = join(place.id for place in PLACES if check_update_enabled(package(*current_rules), place,
+                                                                               current_rollout))
+    new_rollout = rollout(rollout_waves, rollout_opened_waves, exempt_places) if rollout_waves is not None else None
+    assert proposed == expected_mask(places, new_package, new_rollout)
+
+
+def test_bitmap_bit_order(places):
+    place_ids = [places.place_ids[0], places.place_ids[9]]
+    bitmap = base64.b64decode(places.bitmap(places.mask(place_ids)))
+    assert len(bitmap) == (len(PLACES) + 7) // 8
+    assert bitmap[0] == 0b1 and bitmap[1] == 0b10 and not any(bitmap[2:])
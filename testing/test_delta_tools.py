@@ -0,0 +1,136 @@
+import hashlib
+import os
+import random
+import struct
+import zipfile
+
+import pytest
+
+from updblaster import local_settings
+from updblaster.simple_tools import delta_tools
+from updblaster.simple_tools.delta_tools import DeltaError, apply_delta, make_delta
+
+
+def sha256_of(path) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def random_bytes(rng: random.Random, size: int) -> bytes:
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def write_zip(path, members: dict):
+    # Stored members, so an unchanged member keeps the same bytes in the new zip.
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name, data in members.items():
+            zf.writestr(zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0)), data)
+
+
+def make_and_apply(tmp_path, base_path, target_path):
+    patch_path = str(tmp_path / 'patch.delta')
+    out_path = str(tmp_path / 'rebuilt')
+    target_hash = sha256_of(target_path)
+    assert make_delta(base_path=str(base_path), base_hash=sha256_of(base_path), target_path=str(target_path),
+                      target_hash=target_hash, patch_path=patch_path)
+    assert apply_delta(base_path=str(base_path), patch_path=patch_path, out_path=out_path) == target_hash
+    with open(out_path, 'rb') as rebuilt, open(target_path, 'rb') as target:
+        assert rebuilt.read() == target.read()
+    return patch_path
+
+
+def operations(patch_path):
+    ops = []
+    with open(patch_path, 'rb') as patch:
+        patch.seek(delta_tools.HEADER.size)
+        while True:
+            op = patch.read(1)
+            if not op:
+                return ops
+            if op == b'C':
+                patch.seek(16, os.SEEK_CUR)
+            else:
+                length, = struct.unpack('>Q', patch.read(8))
+                patch.seek(length, os.SEEK_CUR)
+            ops.append(op)
+
+
+@pytest.fixture
+def rng():
+    return random.Random(20201017)
+
+
+def test_zip_members_round_trip(tmp_path, rng):
+    members = {f'res/{index}.bin': random_bytes(rng, 20000) for index in range(8)}
+    base_path = tmp_path / 'base.zip'
+    write_zip(base_path, members)
+
+    # One member changed, one added, and the others moved.
+    members['res/3.bin'] = random_bytes(rng, 20000)
+    members = {'new.bin': random_bytes(rng, 3000), **members}
+    target_path = tmp_path / 'target.zip'
+    write_zip(target_path, members)
+
+    patch_path = make_and_apply(tmp_path, base_path, target_path)
+    # The unchanged members are copied from the base, not inserted.
+    assert os.path.getsize(patch_path) < os.path.getsize(target_path) * 0.4
+    assert b'C' in operations(patch_path)
+
+
+def test_blocks_round_trip(tmp_path, rng):
+    block_size = local_settings.PATCH_BLOCK_SIZE
+    base = random_bytes(rng, block_size * 6 + 1234)
+    base_path = tmp_path / 'base.bin'
+    base_path.write_bytes(base)
+
+    # Blocks are at fixed offsets, so only the block with the change differs, and the shorter tail.
+    target = bytearray(base[:-1000])
+    target[block_size * 2 + 10] ^= 0xff
+    target_path = tmp_path / 'target.bin'
+    target_path.write_bytes(bytes(target))
+
+    patch_path = make_and_apply(tmp_path, base_path, target_path)
+    assert os.path.getsize(patch_path) < block_size * 2 + 1000
+    assert operations(patch_path) == [b'C', b'I', b'C', b'I']
+
+
+def test_unrelated_files_not_worth_it(tmp_path, rng):
+    base_path = tmp_path / 'base.bin'
+    base_path.write_bytes(random_bytes(rng, 100000))
+    target_path = tmp_path / 'target.bin'
+    target_path.write_bytes(random_bytes(rng, 100000))
+    patch_path = tmp_path / 'patch.delta'
+    assert not make_delta(base_path=str(base_path), base_hash=sha256_of(base_path), target_path=str(target_path),
+                          target_hash=sha256_of(target_path), patch_path=str(patch_path))
+    assert not patch_path.exists()
+
+
+def test_bad_base_rejected(tmp_path, rng):
+    block_size = local_settings.PATCH_BLOCK_SIZE
+    base = random_bytes(rng, block_size * 4)
+    base_path = tmp_path / 'base.bin'
+    base_path.write_bytes(base)
+    target_path = tmp_path / 'target.bin'
+    target_path.write_bytes(base + b'appended')
+    patch_path = make_and_apply(tmp_path, base_path, target_path)
+
+    other_base = bytearray(base)
+    other_base[block_size] ^= 0x01
+    other_base_path = tmp_path / 'other_base.bin'
+    other_base_path.write_bytes(bytes(other_base))
+    with pytest.raises(DeltaError):
+        apply_delta(base_path=str(other_base_path), patch_path=patch_path)
+
+    truncated_base_path = tmp_path / 'truncated_base.bin'
+    truncated_base_path.write_bytes(base[:block_size])
+    with pytest.raises(DeltaError):
+        apply_delta(base_path=str(truncated_base_path), patch_path=patch_path)
+
+
+def test_not_a_patch_rejected(tmp_path):
+    base_path = tmp_path / 'base.bin'
+    base_path.write_bytes(b'base')
+    patch_path = tmp_path / 'patch.delta'
+    patch_path.write_bytes(b'\0' * delta_tools.HEADER.size)
+    with pytest.raises(DeltaError):
+        apply_delta(base_path=str(base_path), patch_path=str(patch_path))
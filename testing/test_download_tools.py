@@ -0,0 +1,194 @@
+import os
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from updblaster.simple_tools import download_tools
+from updblaster.simple_tools.download_tools import RangeNotSatisfiable, parse_range_header
+
+DATA = bytes(range(256)) * 4  # 1024 bytes
+DATA_HASH = 'a' * 64
+
+app = FastAPI()
+
+
+@app.get('/bytes/')
+def get_bytes(request: Request):
+    return download_tools.conditional_bytes_response(data=DATA, file_name='happymj.zip',
+                                                     request_headers=request.headers, data_hash=DATA_HASH)
+
+
+@app.get('/file/')
+def get_file(request: Request, path: str, hashed: bool = True):
+    return download_tools.conditional_file_response(file_path=path, file_name='happymj.zip',
+                                                    request_headers=request.headers,
+                                                    package_hash=DATA_HASH if hashed else None)
+
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def file_path(tmp_path):
+    path = tmp_path / 'happymj.zip'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-499', [(0, 499)]),
+    ('bytes=500-', [(500, 1023)]),
+    ('bytes=-500', [(524, 1023)]),
+    ('bytes=-5000', [(0, 1023)]),
+    ('bytes=1000-5000', [(1000, 1023)]),
+    ('bytes=0-0,-1', [(0, 0), (1023, 1023)]),
+    ('bytes=0-10, 5-20,21-30', [(0, 30)]),
+    ('bytes=100-199,0-9', [(0, 9), (100, 199)]),
+    ('BYTES=0-1', [(0, 1)]),
+    ('bytes=0-1,2000-', [(0, 1)]),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1024) == expected
+
+
+@pytest.mark.parametrize('header', ['items=0-1', 'bytes=', 'bytes=5-1', 'bytes=a-b', 'bytes=1', 'bytes=--1',
+                                    'bytes=-', 'bytes=+1-2',
+                                    'bytes=' + ','.join(['0-1'] * (download_tools.MAX_RANGES + 1))])
+def test_parse_range_header_invalid_is_ignored(header):
+    assert parse_range_header(header, 1024) is None
+
+
+@pytest.mark.parametrize('header, file_size', [('bytes=1024-', 1024), ('bytes=-0', 1024), ('bytes=0-', 0),
+                                               ('bytes=-1', 0)])
+def test_parse_range_header_not_satisfiable(header, file_size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(header, file_size)
+
+
+def test_etag_matches():
+    etag = download_tools.make_etag(DATA_HASH)
+    assert download_tools.etag_matches('*', etag)
+    assert download_tools.etag_matches(f'"x", {etag}', etag)
+    assert download_tools.etag_matches(f'W/{etag}', etag)
+    assert not download_tools.etag_matches('"x"', etag)
+    weak = 'W/"400-1"'
+    assert download_tools.etag_matches('"400-1"', weak)
+
+
+def test_if_range_matches():
+    etag = download_tools.make_etag(DATA_HASH)
+    last_modified = 'Sat, 17 Oct 2026 00:00:00 GMT'
+    assert download_tools.if_range_matches(etag, etag, last_modified)
+    assert not download_tools.if_range_matches('"x"', etag, last_modified)
+    assert download_tools.if_range_matches(last_modified, etag, last_modified)
+    # A weak ETag never satisfies If-Range.
+    assert not download_tools.if_range_matches('W/"400-1"', 'W/"400-1"', last_modified)
+    assert not download_tools.if_range_matches('"400-1"', 'W/"400-1"', last_modified)
+
+
+def test_full_response():
+    resp = client.get('/bytes/')
+    assert resp.status_code == 200
+    assert resp.content == DATA
+    assert resp.headers['etag'] == f'"{DATA_HASH}"'
+    assert resp.headers['accept-ranges'] == 'bytes'
+
+
+def test_not_modified():
+    resp = client.get('/bytes/', headers={'If-None-Match': f'"{DATA_HASH}"'})
+    assert resp.status_code == 304
+    assert resp.content == b''
+    assert resp.headers['etag'] == f'"{DATA_HASH}"'
+
+
+def test_single_range():
+    resp = client.get('/bytes/', headers={'Range': 'bytes=10-19'})
+    assert resp.status_code == 206
+    assert resp.content == DATA[10:20]
+    assert resp.headers['content-range'] == 'bytes 10-19/1024'
+    assert resp.headers['content-length'] == '10'
+
+
+def test_range_not_satisfiable():
+    resp = client.get('/bytes/', headers={'Range': 'bytes=2000-'})
+    assert resp.status_code == 416
+    assert resp.headers['content-range'] == 'bytes */1024'
+
+
+def test_invalid_range_gives_full_content():
+    resp = client.get('/bytes/', headers={'Range': 'bytes=9-1'})
+    assert resp.status_code == 200
+    assert resp.content == DATA
+
+
+def parse_multipart(resp):
+    media_type, _, boundary = resp.headers['content-type'].partition('; boundary=')
+    assert media_type == 'multipart/byteranges'
+    parts = []
+    for part in resp.content.split(f'--{boundary}'.encode())[1:-1]:
+        head, _, body = part.partition(b'\r\n\r\n')
+        headers = dict(line.split(': ', 1) for line in head.decode('latin-1').strip().split('\r\n'))
+        parts.append((headers['Content-Range'], body[:-2]))  # Without the CRLF before the next boundary.
+    assert resp.content.endswith(f'--{boundary}--\r\n'.encode())
+    return parts
+
+
+def test_multipart_ranges():
+    resp = client.get('/bytes/', headers={'Range': 'bytes=0-4,100-109,-3'})
+    assert resp.status_code == 206
+    assert int(resp.headers['content-length']) == len(resp.content)
+    assert parse_multipart(resp) == [('bytes 0-4/1024', DATA[0:5]),
+                                     ('bytes 100-109/1024', DATA[100:110]),
+                                     ('bytes 1021-1023/1024', DATA[1021:])]
+
+
+def test_overlapping_ranges_are_merged_into_one_part():
+    resp = client.get('/bytes/', headers={'Range': 'bytes=0-9,5-14'})
+    assert resp.status_code == 206
+    assert resp.headers['content-range'] == 'bytes 0-14/1024'
+    assert resp.content == DATA[:15]
+
+
+def test_if_range():
+    matching = client.get('/bytes/', headers={'Range': 'bytes=0-9', 'If-Range': f'"{DATA_HASH}"'})
+    assert matching.status_code == 206
+    assert matching.content == DATA[:10]
+    changed = client.get('/bytes/', headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert changed.status_code == 200
+    assert changed.content == DATA
+
+
+def test_file_ranges(file_path):
+    # The second request of the file is served from the hot file mapping.
+    for _ in range(2):
+        resp = client.get('/file/', params={'path': file_path}, headers={'Range': 'bytes=1000-'})
+        assert resp.status_code == 206
+        assert resp.content == DATA[1000:]
+        assert resp.headers['content-range'] == 'bytes 1000-1023/1024'
+        resp = client.get('/file/', params={'path': file_path})
+        assert resp.status_code == 200
+        assert resp.content == DATA
+    resp = client.get('/file/', params={'path': file_path}, headers={'Range': 'bytes=1024-'})
+    assert resp.status_code == 416
+
+
+def test_file_if_range_by_date_and_weak_etag(file_path):
+    resp = client.get('/file/', params={'path': file_path, 'hashed': False})
+    etag, last_modified = resp.headers['etag'], resp.headers['last-modified']
+    assert etag.startswith('W/')
+    assert client.get('/file/', params={'path': file_path, 'hashed': False},
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    by_date = client.get('/file/', params={'path': file_path, 'hashed': False},
+                         headers={'Range': 'bytes=0-9', 'If-Range': last_modified})
+    assert by_date.status_code == 206
+    by_weak_etag = client.get('/file/', params={'path': file_path, 'hashed': False},
+                              headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert by_weak_etag.status_code == 200
+    assert by_weak_etag.content == DATA
+
+
+def test_missing_file(tmp_path):
+    assert download_tools.conditional_file_response(file_path=os.path.join(tmp_path, 'missing.zip'),
+                                                    file_name='missing.zip', request_headers={}) is None
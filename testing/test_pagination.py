@@ -0,0 +1,49 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException, Response
+
+from updblaster.simple_tools.pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor, paginate
+
+
+def rows(*ids):
+    return [SimpleNamespace(id=row_id) for row_id in ids]
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('places', 1234)
+    assert '=' not in cursor
+    assert decode_cursor('places', cursor) == 1234
+    assert decode_cursor('places', None) is None
+
+
+@pytest.mark.parametrize('cursor', [
+    encode_cursor('packages', 1234),  # Cursor of another listing.
+    'not a cursor',
+    '!!!',
+    'é',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+    base64.urlsafe_b64encode(b'places:').decode(),
+    base64.urlsafe_b64encode(b'places:-1').decode(),
+    base64.urlsafe_b64encode(b'places:12a').decode(),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as exc_info:
+        decode_cursor('places', cursor)
+    assert exc_info.value.status_code == 400
+
+
+def test_next_page():
+    response = Response()
+    page = paginate('npl', rows(1, 2, 3), limit=2, response=response)
+    assert [row.id for row in page] == [1, 2]
+    assert decode_cursor('npl', response.headers[NEXT_CURSOR_HEADER]) == 2
+
+
+@pytest.mark.parametrize('ids', [(1, 2), (1,), ()])
+def test_last_page(ids):
+    response = Response()
+    page = paginate('npl', rows(*ids), limit=2, response=response)
+    assert [row.id for row in page] == list(ids)
+    assert NEXT_CURSOR_HEADER not in response.headers
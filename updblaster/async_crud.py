@@ -0,0 +1,222 @@
+"""
+Async versions of the read-side crud functions, used by the client-facing hot path.
+Write operations stay in `crud.py`.
+
+Lookups read through `lookup_cache` and return pydantic snapshots instead of ORM instances,
+the write functions in `crud.py` invalidate them.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Place, Package, PackagePlaceRule, PackageRollout, PackagePatch, PackageList
+from . import schemas
+from .logger import logger
+from .simple_tools.lookup_cache import lookup_cache, MISSING, PLACES, PACKAGES, PATCHES, PACKAGELISTS
+
+LATEST = 'latest'
+
+
+def _snapshot(schema, db_obj):
+    return schema.from_orm(db_obj) if db_obj is not None else None
+
+
+# Place
+async def retrieve_place_by_place_code(db: AsyncSession, place_code: str) -> Optional[schemas.Place]:
+    async def loader():
+        logger.debug(f'RETRIEVE a place by `place_code` {place_code}.')
+        db_place = (await db.execute(select(Place).filter(Place.place_code == place_code).limit(1))).scalars().first()
+        return _snapshot(schemas.Place, db_place)
+    return await lookup_cache.get_or_load(PLACES, place_code, loader)
+
+
+# Package
+async def retrieve_package_by_package_name(db: AsyncSession, package_name: str) -> Optional[schemas.Package]:
+    async def loader():
+        logger.debug(f'RETRIEVE a package by `package_name` {package_name}.')
+        db_package = (await db.execute(select(Package).filter(Package.package_name == package_name).limit(1))) \
+            .scalars().first()
+        return _snapshot(schemas.Package, db_package)
+    return await lookup_cache.get_or_load(PACKAGES, package_name, loader)
+
+
+async def retrieve_packages_by_package_names(db: AsyncSession,
+                                             package_names: Iterable[str]) -> Dict[str, Optional[schemas.Package]]:
+    """
+    未缓存的package通过一次`IN`查询获取
+    :return: package_name -> package, None if the package does not exist.
+    """
+    packages, missing = {}, []
+    for package_name in package_names:
+        package = lookup_cache.get(PACKAGES, package_name)
+        if package is MISSING:
+            missing.append(package_name)
+        else:
+            packages[package_name] = package
+    if not missing:
+        return packages
+
+    generation = lookup_cache.generation(PACKAGES)
+    logger.debug(f'RETRIEVE {len(missing)} packages by `package_name`.')
+    db_packages = (await db.execute(select(Package).filter(Package.package_name.in_(missing)))).scalars().all()
+    found = {db_package.package_name: _snapshot(schemas.Package, db_package) for db_package in db_packages}
+    for package_name in missing:
+        packages[package_name] = found.get(package_name)
+        lookup_cache.put(PACKAGES, package_name, packages[package_name], generation)
+    return packages
+
+
+async def retrieve_package_and_place(db: AsyncSession,
+                                     package_name: str,
+                                     place_code: str) -> Tuple[Optional[schemas.Package], Optional[schemas.Place]]:
+    """
+    都在缓存中时不查询数据库，都不在缓存中时一次查询同时获取package及place
+    :return: (None, None) if the package does not exist, (package, None) if the place does not exist.
+    """
+    package = lookup_cache.get(PACKAGES, package_name)
+    place = lookup_cache.get(PLACES, place_code)
+    if package is not MISSING or place is not MISSING:
+        # 只缺一个时单独查询，同一个key的并发查询合并为一次
+        if package is MISSING:
+            package = await retrieve_package_by_package_name(db=db, package_name=package_name)
+        elif place is MISSING and package:
+            place = await retrieve_place_by_place_code(db=db, place_code=place_code)
+        return (package, place) if package else (None, None)
+
+    package_generation = lookup_cache.generation(PACKAGES)
+    place_generation = lookup_cache.generation(PLACES)
+
+    async def loader():
+        logger.debug(f'RETRIEVE a package by `package_name` {package_name} and a place by `place_code` {place_code}.')
+        row = (await db.execute(select(Package, Place)
+                                .outerjoin(Place, Place.place_code == place_code)
+                                .filter(Package.package_name == package_name)
+                                .limit(1))).first()
+        if not row:
+            lookup_cache.put(PACKAGES, package_name, None, package_generation)
+            return None, None
+
+        db_package, db_place = _snapshot(schemas.Package, row[0]), _snapshot(schemas.Place, row[1])
+        lookup_cache.put(PACKAGES, package_name, db_package, package_generation)
+        lookup_cache.put(PLACES, place_code, db_place, place_generation)
+        return db_package, db_place
+    return await lookup_cache.shared(('package_and_place', package_name, place_code,
+                                      package_generation, place_generation), loader)
+
+
+# Package place rules
+async def retrieve_package_place_rules_all(db: AsyncSession):
+    """
+    :return: (package_id, place_id, allowed) rows.
+    """
+    logger.debug(f'RETRIEVE all package place rules.')
+    return (await db.execute(select(PackagePlaceRule.package_id,
+                                    PackagePlaceRule.place_id,
+                                    PackagePlaceRule.allowed))).all()
+
+
+# Package rollouts
+async def retrieve_package_rollouts_all(db: AsyncSession):
+    """
+    :return: (package_id, waves, opened_waves, exempt_places) rows.
+    """
+    logger.debug(f'RETRIEVE all package rollouts.')
+    return (await db.execute(select(PackageRollout.package_id,
+                                    PackageRollout.waves,
+                                    PackageRollout.opened_waves,
+                                    PackageRollout.exempt_places))).all()
+
+
+# Package patches
+async def retrieve_package_patches_to(db: AsyncSession, package_id: int, to_hash: str) -> List[schemas.PackagePatch]:
+    async def loader():
+        logger.debug(f'RETRIEVE patches of package {package_id} to {to_hash}.')
+        db_patches = (await db.execute(select(PackagePatch)
+                                       .filter(PackagePatch.package_id == package_id,
+                                               PackagePatch.to_hash == to_hash)
+                                       .order_by(PackagePatch.id.desc()))).scalars().all()
+        return tuple(_snapshot(schemas.PackagePatch, db_patch) for db_patch in db_patches)
+    return list(await lookup_cache.get_or_load(PATCHES, (package_id, to_hash), loader))
+
+
+async def retrieve_packages_patches_to(db: AsyncSession,
+                                       targets: Iterable[Tuple[int, str]]) -> Dict[Tuple[int, str],
+                                                                                   List[schemas.PackagePatch]]:
+    """
+    未缓存的patches通过一次`IN`查询获取
+    :param targets: (package_id, to_hash) pairs.
+    """
+    patches, missing = {}, []
+    for target in targets:
+        cached = lookup_cache.get(PATCHES, target)
+        if cached is MISSING:
+            missing.append(target)
+        else:
+            patches[target] = list(cached)
+    if not missing:
+        return patches
+
+    generation = lookup_cache.generation(PATCHES)
+    logger.debug(f'RETRIEVE patches of {len(missing)} packages.')
+    db_patches = (await db.execute(select(PackagePatch)
+                                   .filter(PackagePatch.package_id.in_({package_id for package_id, _ in missing}),
+                                           PackagePatch.to_hash.in_({to_hash for _, to_hash in missing}))
+                                   .order_by(PackagePatch.id.desc()))).scalars().all()
+    found = {target: [] for target in missing}
+    for db_patch in db_patches:
+        target = (db_patch.package_id, db_patch.to_hash)
+        if target in found:
+            found[target].append(_snapshot(schemas.PackagePatch, db_patch))
+    for target, target_patches in found.items():
+        lookup_cache.put(PATCHES, target, tuple(target_patches), generation)
+        patches[target] = target_patches
+    return patches
+
+
+# Packagelist
+async def retrieve_newpackagelist_desc(db: AsyncSession) -> Optional[schemas.PackagesList]:
+    async def loader():
+        logger.debug(f'RETRIEVE a latest newpackagelist by desc')
+        db_package_list = (await db.execute(select(PackageList).order_by(PackageList.id.desc()).limit(1))) \
+            .scalars().first()
+        return _snapshot(schemas.PackagesList, db_package_list)
+    return await lookup_cache.get_or_load(PACKAGELISTS, LATEST, loader)
+
+
+async def retrieve_place_and_newpackagelist_desc(db: AsyncSession, place_code: str) -> Tuple[
+        Optional[schemas.Place], Optional[schemas.PackagesList]]:
+    """
+    都在缓存中时不查询数据库，都不在缓存中时一次查询同时获取place及最新的newpackagelist
+    :return: (None, None) if the place does not exist, (place, None) if there is no newpackagelist yet.
+    """
+    place = lookup_cache.get(PLACES, place_code)
+    newpackagelist = lookup_cache.get(PACKAGELISTS, LATEST)
+    if place is not MISSING or newpackagelist is not MISSING:
+        # 版本更新后所有place同时轮询，place都已缓存，只有一个请求查询最新的newpackagelist
+        if newpackagelist is MISSING and place:
+            newpackagelist = await retrieve_newpackagelist_desc(db=db)
+        elif place is MISSING:
+            place = await retrieve_place_by_place_code(db=db, place_code=place_code)
+        return (place, newpackagelist) if place else (None, None)
+
+    place_generation = lookup_cache.generation(PLACES)
+    packagelist_generation = lookup_cache.generation(PACKAGELISTS)
+
+    async def loader():
+        logger.debug(f'RETRIEVE a place by `place_code` {place_code} and the latest newpackagelist.')
+        latest_id = select(func.max(PackageList.id)).scalar_subquery()
+        row = (await db.execute(select(Place, PackageList)
+                                .outerjoin(PackageList, PackageList.id == latest_id)
+                                .filter(Place.place_code == place_code)
+                                .limit(1))).first()
+        if not row:
+            lookup_cache.put(PLACES, place_code, None, place_generation)
+            return None, None
+
+        db_place, db_package_list = _snapshot(schemas.Place, row[0]), _snapshot(schemas.PackagesList, row[1])
+        lookup_cache.put(PLACES, place_code, db_place, place_generation)
+        lookup_cache.put(PACKAGELISTS, LATEST, db_package_list, packagelist_generation)
+        return db_place, db_package_list
+    return await lookup_cache.shared(('place_and_newpackagelist', place_code,
+                                      place_generation, packagelist_generation), loader)
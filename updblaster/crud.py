@@ -1,8 +1,27 @@
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from sqlalchemy import Integer, String, cast, func, inspect, select, text, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.orm import Session
 
-from .models import Place, Package, PackageList, History
+from .models import Place, Package, PackagePlaceRule, PackageRollout, PackagePatch, PackageList, PackageListChange, \
+    History
 from . import schemas
 from .logger import logger
+from .simple_tools.eligibility import compile_package_rules
+from .simple_tools.rollout import rollout_reaches
+from .simple_tools.history_tools import HistoryCounts, to_datetime
+from .simple_tools.lookup_cache import lookup_cache, PLACES, PACKAGES, PATCHES, PACKAGELISTS
+
+
+def paginate_by_id(query, id_column, skip: int, limit: int, after_id: Optional[int] = None):
+    """
+    按id排序分页：有after_id时使用主键索引定位(keyset)，深度分页不再随skip线性变慢；否则兼容offset
+    """
+    query = query.order_by(id_column)
+    if after_id is not None:
+        return query.filter(id_column > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
 
 
 # Place
@@ -11,14 +30,18 @@ def create_place(db: Session, place: schemas.PlaceCreate):
     db.add(db_place)
     db.commit()
     db.refresh(db_place)
+    lookup_cache.invalidate(PLACES)
     logger.debug(f'CREATE a place with {place.dict()}.')
 
     return db_place
 
 
-def retrieve_places(db: Session, skip: int, limit: int):
-    logger.debug(f'RETRIEVE paginated places, {skip} - {limit}.')
-    return db.query(Place).offset(skip).limit(limit).all()
+def retrieve_places(db: Session, skip: int, limit: int, after_id: Optional[int] = None):
+    """
+    :param after_id: Keyset pagination, the places after this id instead of `skip`.
+    """
+    logger.debug(f'RETRIEVE paginated places, {skip} - {limit} after {after_id}.')
+    return paginate_by_id(db.query(Place), Place.id, skip=skip, limit=limit, after_id=after_id)
 
 
 def retrieve_place_by_place_id(db: Session, place_id: int):
@@ -36,6 +59,19 @@ def retrieve_place_by_place_name(db: Session, place_name: str):
     return db.query(Place).filter(Place.place_name == place_name).first()
 
 
+def retrieve_place_codes_by_place_ids(db: Session, place_ids: Iterable[int]) -> Dict[int, str]:
+    logger.debug(f'RETRIEVE place codes by `place_id`s.')
+    return dict(db.query(Place.id, Place.place_code).filter(Place.id.in_(list(place_ids))).all())
+
+
+def retrieve_place_codes_all(db: Session) -> List[tuple]:
+    """
+    :return: (place_id, place_code) rows, by id.
+    """
+    logger.debug(f'RETRIEVE all place codes.')
+    return db.query(Place.id, Place.place_code).order_by(Place.id).all()
+
+
 def retrieve_places_by_fuzzy_code(db: Session, place_code: str):
     """
     模糊查找by place_code
@@ -70,6 +106,7 @@ def update_place(db: Session, place_id: int, place: schemas.PlaceCreate):
     #     db_place.package_path = place.package_path
     db.commit()
     db.refresh(db_place)
+    lookup_cache.invalidate(PLACES)
     logger.debug(f'UPDATE a place {place_id}.')
     return db_place
 
@@ -77,9 +114,19 @@ def update_place(db: Session, place_id: int, place: schemas.PlaceCreate):
 def delete_place(db: Session, place_id: int):
     # [TODO]: 后期采用伪删除
     # [TODO]: 删除返回"204 NO CONTENT"，GET查询返回"410 GONE"???
+    # 同时删除该place相关的黑白名单，并更新受影响的package中的兼容副本
+    package_ids = [row.package_id for row in
+                   db.query(PackagePlaceRule.package_id).filter(PackagePlaceRule.place_id == place_id).distinct()]
+    db.query(PackagePlaceRule).filter(PackagePlaceRule.place_id == place_id).delete(synchronize_session=False)
+    if package_ids:
+        for db_package in db.query(Package).filter(Package.id.in_(package_ids)):
+            allow, deny = compile_package_rules(db_package.valid_places, db_package.invalid_places)
+            db_package.valid_places = join_places(allow - {place_id})
+            db_package.invalid_places = join_places(deny - {place_id})
     db.query(Place).filter(Place.id == place_id).delete()
     db.commit()
-    logger.debug(f'DELETE a place {place_id}.')
+    lookup_cache.invalidate(PLACES, PACKAGES)
+    logger.debug(f'DELETE a place {place_id}, and its rules of packages {package_ids}.')
     return {"id": f"{place_id}",
             "object": "place",
             "deleted": True}
@@ -94,11 +141,12 @@ def create_package(db: Session, req_dict: dict):
     db.add(db_package)
     db.commit()
     db.refresh(db_package)
+    lookup_cache.invalidate(PACKAGES)
     logger.debug(f'CREATE a package with {req_dict}.')
     return db_package
 
 
-def retrieve_packages_for_web(db: Session, skip: int, limit: int):
+def retrieve_packages_for_web(db: Session, skip: int, limit: int, after_id: Optional[int] = None):
     """
     获取packages与获取places不同，获取places比较简单，只设置偏移及分页limit即可。
     而获取packages涉及到web分页获取，或后台获取全部来生成newpackagelist.json
@@ -106,12 +154,13 @@ def retrieve_packages_for_web(db: Session, skip: int, limit: int):
     :param db:
     :param skip:
     :param limit:
+    :param after_id: Keyset pagination, the packages after this id instead of `skip`.
     :return:
     """
     # if skip and
     # db.query(Package).slice()
-    logger.debug(f'RETRIEVE paginated packages {skip} - {limit}.')
-    return db.query(Package).offset(skip).limit(limit).all()
+    logger.debug(f'RETRIEVE paginated packages {skip} - {limit} after {after_id}.')
+    return paginate_by_id(db.query(Package), Package.id, skip=skip, limit=limit, after_id=after_id)
 
 
 def retrieve_packages_all(db: Session, start: int = None, stop: int = None):
@@ -125,7 +174,7 @@ def retrieve_packages_all(db: Session, start: int = None, stop: int = None):
     # if skip and
     # db.query(Package).slice()
     logger.debug(f'RETRIEVE all packages for backend usage: {start} - {stop}.')
-    return db.query(Package).slice(start, stop).all()
+    return db.query(Package).order_by(Package.id).slice(start, stop).all()
 
 
 def retrieve_package_by_package_id(db: Session, package_id: int):
@@ -138,6 +187,11 @@ def retrieve_package_by_package_name(db: Session, package_name: str):
     return db.query(Package).filter(Package.package_name == package_name).first()
 
 
+def retrieve_package_by_down_url(db: Session, package_down_url: str):
+    logger.debug(f'RETRIEVE a package by `package_down_url` {package_down_url}.')
+    return db.query(Package).filter(Package.package_down_url == package_down_url).first()
+
+
 def retrieve_packages_by_fuzzy_name(db: Session, package_name: str):
     logger.debug(f'RETRIEVE packages by fuzzy `package_name` {package_name}.')
     return db.query(Package).filter(Package.package_name.ilike(f'{package_name}%')).all()
@@ -150,11 +204,19 @@ def update_package_to_publish(package_id: int,
                               package_run_cmd: str,
                               package_del_cmd: str,
                               package_path: str,
-                              db: Session):
+                              db: Session,
+                              rollout_dict: Optional[dict] = None):
+    """
+    规则与分批发布在同一个事务中写入，提交之前不会对所有place生效
+    :param rollout_dict: 替换该package的rollout，为空时删除
+    :return: (package, rollout or None)
+    """
     db_package: schemas.PackageUpdate = db.query(Package).filter(Package.id == package_id).first()
     db_package.package_version = package_version
     db_package.valid_places = valid_places
     db_package.invalid_places = invalid_places
+    allow, deny = compile_package_rules(valid_places, invalid_places)
+    replace_package_place_rules(db=db, package_id=package_id, allow=allow, deny=deny)
     # if package_run_cmd:
     #     db_package.package_run_cmd = package_run_cmd
     # else:
@@ -162,16 +224,44 @@ def update_package_to_publish(package_id: int,
     db_package.package_run_cmd = package_run_cmd
     db_package.package_del_cmd = package_del_cmd
     db_package.package_path = package_path
+    db.query(PackageRollout).filter(PackageRollout.package_id == package_id).delete(synchronize_session=False)
+    db_rollout = PackageRollout(**rollout_dict) if rollout_dict is not None else None
+    if db_rollout is not None:
+        db.add(db_rollout)
 
     db.commit()
     db.refresh(db_package)
-    logger.debug(f'UPDATE a package {package_id}.')
+    if db_rollout is not None:
+        db.refresh(db_rollout)
+    lookup_cache.invalidate(PACKAGES)
+    logger.debug(f'UPDATE a package {package_id}, rollout {rollout_dict}.')
+    return db_package, db_rollout
+
+
+def update_package_file(db: Session, package_id: int, package_version: str, package_length: str,
+                        package_hash: str, package_down_url: str):
+    """
+    上传了新版本的包文件之后更新
+    """
+    db_package = db.query(Package).filter(Package.id == package_id).first()
+    db_package.package_version = package_version
+    db_package.package_length = package_length
+    db_package.package_hash = package_hash
+    db_package.package_down_url = package_down_url
+    db.commit()
+    db.refresh(db_package)
+    lookup_cache.invalidate(PACKAGES, PATCHES)
+    logger.debug(f'UPDATE the file of package {package_id} to version {package_version}.')
     return db_package
 
 
 def delete_package(db: Session, package_id: int):
+    db.query(PackagePatch).filter(PackagePatch.package_id == package_id).delete(synchronize_session=False)
+    db.query(PackagePlaceRule).filter(PackagePlaceRule.package_id == package_id).delete(synchronize_session=False)
+    db.query(PackageRollout).filter(PackageRollout.package_id == package_id).delete(synchronize_session=False)
     db.query(Package).filter(Package.id == package_id).delete()
     db.commit()
+    lookup_cache.invalidate(PACKAGES, PATCHES)
     logger.debug(f'DELETE a package {package_id}')
     return {'id': f'{package_id}',
             'object': 'package',
@@ -181,20 +271,419 @@ def delete_package(db: Session, package_id: int):
 # ==============================================================================
 
 
-def create_newpackagelist(db: Session, npl_dict: dict):
+# Package place rules
+def join_places(place_ids) -> str:
+    """
+    :param place_ids: e.g.: {3, 1, 2}
+    :return: e.g.: '1,2,3'
+    """
+    return ','.join(str(place_id) for place_id in sorted(place_ids))
+
+
+def replace_package_place_rules(db: Session, package_id: int, allow: FrozenSet[int], deny: FrozenSet[int]):
+    """
+    Replace all rules of the package, committed by the caller.
+    """
+    db.query(PackagePlaceRule).filter(PackagePlaceRule.package_id == package_id).delete(synchronize_session=False)
+    db.add_all([PackagePlaceRule(package_id=package_id, place_id=place_id, allowed=True) for place_id in allow] +
+               [PackagePlaceRule(package_id=package_id, place_id=place_id, allowed=False) for place_id in deny])
+    logger.debug(f'REPLACE rules of package {package_id}, allow {len(allow)}, deny {len(deny)}.')
+
+
+def retrieve_package_place_rules_all(db: Session):
+    """
+    :return: (package_id, place_id, allowed) rows.
+    """
+    logger.debug(f'RETRIEVE all package place rules.')
+    return db.query(PackagePlaceRule.package_id, PackagePlaceRule.place_id, PackagePlaceRule.allowed).all()
+
+
+def retrieve_package_place_rules(db: Session, package_ids: List[int]):
+    """
+    :return: (package_id, place_id, allowed) rows of the packages.
+    """
+    logger.debug(f'RETRIEVE rules of packages {package_ids}.')
+    return db.query(PackagePlaceRule.package_id, PackagePlaceRule.place_id, PackagePlaceRule.allowed) \
+        .filter(PackagePlaceRule.package_id.in_(package_ids)).all()
+
+
+def retrieve_enabled_packages_by_place(db: Session, place_id: int, place_code: str,
+                                       package_names: Optional[List[str]] = None) -> List[Package]:
+    """
+    可更新到该place的全部packages，一次索引查询，分批发布中的packages只包含已开放到该place的
+    :param db:
+    :param place_id:
+    :param place_code: The wave of the place is given by its code, see `simple_tools/rollout.py`.
+    :param package_names: Optional, only these packages.
+    :return:
+    """
+    logger.debug(f'RETRIEVE enabled packages for place {place_id}.')
+    denied = select(PackagePlaceRule.package_id).where(PackagePlaceRule.place_id == place_id,
+                                                       PackagePlaceRule.allowed.is_(False))
+    query = db.query(Package, PackageRollout) \
+        .join(PackagePlaceRule, PackagePlaceRule.package_id == Package.id) \
+        .outerjoin(PackageRollout, PackageRollout.package_id == Package.id) \
+        .filter(PackagePlaceRule.place_id == place_id,
+                PackagePlaceRule.allowed.is_(True),
+                Package.id.notin_(denied))
+    if package_names is not None:
+        query = query.filter(Package.package_name.in_(package_names))
+    return [db_package for db_package, db_rollout in query.order_by(Package.id).all()
+            if rollout_reaches(db_rollout, place_id=place_id, place_code=place_code)]
+
+
+def migrate_legacy_place_rules(db: Session) -> int:
+    """
+    将旧版`valid_places`/`invalid_places`字符串迁移到`package_place_rules`表，可重复执行：
+    已有规则的package会被跳过。MySQL中旧的VARCHAR(1024)列会被扩展为TEXT。
+    :return: Number of migrated packages.
+    """
+    bind = db.get_bind()
+    if bind.dialect.name == 'mysql':
+        columns = {column['name']: column['type'] for column in inspect(bind).get_columns('packages')}
+        for name in ('valid_places', 'invalid_places'):
+            if name in columns and 'VARCHAR' in str(columns[name]).upper():
+                db.execute(text(f'ALTER TABLE packages MODIFY {name} TEXT'))
+                logger.info(f'MIGRATE column packages.{name} to TEXT.')
+
+    migrated = 0
+    for db_package in db.query(Package).filter(Package.id.notin_(select(PackagePlaceRule.package_id))):
+        allow, deny = compile_package_rules(db_package.valid_places, db_package.invalid_places)
+        if allow or deny:
+            replace_package_place_rules(db=db, package_id=db_package.id, allow=allow, deny=deny)
+            migrated += 1
+    db.commit()
+    if migrated:
+        logger.info(f'MIGRATE legacy place rules of {migrated} packages.')
+    return migrated
+
+
+# ==============================================================================
+
+
+# Package rollouts
+def retrieve_package_rollout(db: Session, package_id: int):
+    logger.debug(f'RETRIEVE the rollout of package {package_id}.')
+    return db.query(PackageRollout).filter(PackageRollout.package_id == package_id).first()
+
+
+def retrieve_package_rollouts_all(db: Session):
+    """
+    :return: (package_id, waves, opened_waves, exempt_places) rows.
+    """
+    logger.debug(f'RETRIEVE all package rollouts.')
+    return db.query(PackageRollout.package_id, PackageRollout.waves, PackageRollout.opened_waves,
+                    PackageRollout.exempt_places).all()
+
+
+def retrieve_due_package_rollouts(db: Session, now: int) -> List[PackageRollout]:
+    """
+    未暂停、未全部开放、且距上次开放已超过间隔的rollouts
+    """
+    logger.debug(f'RETRIEVE rollouts due at {now}.')
+    return db.query(PackageRollout).filter(
+        PackageRollout.halted.is_(False),
+        PackageRollout.wave_interval_seconds.isnot(None),
+        PackageRollout.opened_waves < PackageRollout.waves,
+        PackageRollout.wave_opened_at + PackageRollout.wave_interval_seconds <= now).all()
+
+
+def update_package_rollout(db: Session, package_id: int, update_dict: dict):
+    db.query(PackageRollout).filter(PackageRollout.package_id == package_id).update(update_dict,
+                                                                                  synchronize_session=False)
+    db.commit()
+    logger.debug(f'UPDATE the rollout of package {package_id} with {update_dict}.')
+    return retrieve_package_rollout(db=db, package_id=package_id)
+
+
+def open_package_rollout_waves(db: Session, package_id: int, from_opened_waves: int, opened_waves: int,
+                               now: int) -> bool:
+    """
+    条件更新：只有opened_waves仍为from_opened_waves时才更新，多个worker同时开放同一批次时只有一个成功
+    :return: Whether this call opened the waves.
+    """
+    updated = db.query(PackageRollout) \
+        .filter(PackageRollout.package_id == package_id, PackageRollout.opened_waves == from_opened_waves) \
+        .update({'opened_waves': opened_waves, 'wave_opened_at': now}, synchronize_session=False)
+    db.commit()
+    logger.debug(f'UPDATE the rollout of package {package_id} from {from_opened_waves} to {opened_waves} waves, '
+                 f'{"done" if updated else "skipped"}.')
+    return bool(updated)
+
+
+def delete_package_rollout(db: Session, package_id: int) -> bool:
+    deleted = db.query(PackageRollout).filter(PackageRollout.package_id == package_id) \
+        .delete(synchronize_session=False)
+    db.commit()
+    logger.debug(f'DELETE the rollout of package {package_id}.')
+    return bool(deleted)
+
+
+# ==============================================================================
+
+
+# Package patches
+def create_package_patch(db: Session, patch_dict: dict):
+    db_patch = PackagePatch(**patch_dict)
+    db.add(db_patch)
+    db.commit()
+    db.refresh(db_patch)
+    lookup_cache.invalidate(PATCHES)
+    logger.debug(f'CREATE a package patch with {patch_dict}.')
+    return db_patch
+
+
+def retrieve_package_patch(db: Session, package_id: int, from_hash: str, to_hash: str):
+    logger.debug(f'RETRIEVE a patch of package {package_id}: {from_hash} -> {to_hash}.')
+    return db.query(PackagePatch).filter(PackagePatch.package_id == package_id,
+                                         PackagePatch.to_hash == to_hash,
+                                         PackagePatch.from_hash == from_hash).first()
+
+
+def retrieve_package_patches_to(db: Session, package_id: int, to_hash: str):
+    logger.debug(f'RETRIEVE patches of package {package_id} to {to_hash}.')
+    return db.query(PackagePatch).filter(PackagePatch.package_id == package_id,
+                                         PackagePatch.to_hash == to_hash).order_by(PackagePatch.id.desc()).all()
+
+
+def retrieve_package_patch_by_name(db: Session, patch_name: str):
+    logger.debug(f'RETRIEVE a patch by `patch_name` {patch_name}.')
+    return db.query(PackagePatch).filter(PackagePatch.patch_name == patch_name).first()
+
+
+def delete_package_patches_from(db: Session, package_id: int, from_hashes: List[str]) -> List[str]:
+    """
+    :return: Names of the deleted patches, whose files should be removed.
+    """
+    db_patches = db.query(PackagePatch).filter(PackagePatch.package_id == package_id,
+                                               PackagePatch.from_hash.in_(from_hashes)).all()
+    patch_names = [db_patch.patch_name for db_patch in db_patches]
+    for db_patch in db_patches:
+        db.delete(db_patch)
+    db.commit()
+    lookup_cache.invalidate(PATCHES)
+    logger.debug(f'DELETE patches of package {package_id}: {patch_names}.')
+    return patch_names
+
+
+def retrieve_package_patch_names(db: Session, package_id: int) -> List[str]:
+    return [row.patch_name for row in
+            db.query(PackagePatch.patch_name).filter(PackagePatch.package_id == package_id)]
+
+
+# ==============================================================================
+
+
+def create_newpackagelist(db: Session, npl_dict: dict, changes: Optional[List[dict]] = None):
+    """
+    :param db:
+    :param npl_dict:
+    :param changes: Journal rows of this version, committed together with the new version.
+    :return:
+    """
     db_package_list = PackageList(**npl_dict)
     db.add(db_package_list)
+    for change in changes or []:
+        db.add(PackageListChange(packagelist_version=int(npl_dict['packagelist_version']), **change))
     db.commit()
+    lookup_cache.invalidate(PACKAGELISTS)
     db.refresh(db_package_list)
     logger.debug(f'CREATE newpackagelist with {npl_dict}.')
     return db_package_list
 
 
-def retrieve_newpackagelists(db: Session, skip: int, limit: int):
-    logger.debug(f'RETRIEVE paginated newpackagelist {skip} - {limit}.')
-    return db.query(PackageList).offset(skip).limit(limit).all()
+def retrieve_newpackagelists(db: Session, skip: int, limit: int, after_id: Optional[int] = None):
+    """
+    :param after_id: Keyset pagination, the versions after this id instead of `skip`.
+    """
+    logger.debug(f'RETRIEVE paginated newpackagelist {skip} - {limit} after {after_id}.')
+    return paginate_by_id(db.query(PackageList), PackageList.id, skip=skip, limit=limit, after_id=after_id)
 
 
 def retrieve_newpackagelist_desc(db: Session):
     logger.debug(f'RETRIEVE a latest newpackagelist by desc')
     return db.query(PackageList).order_by(PackageList.id.desc()).first()
+
+
+def retrieve_packagelist_changes_since(db: Session, packagelist_version: int):
+    logger.debug(f'RETRIEVE packagelist changes since {packagelist_version}.')
+    return db.query(PackageListChange) \
+        .filter(PackageListChange.packagelist_version > packagelist_version) \
+        .order_by(PackageListChange.packagelist_version, PackageListChange.id) \
+        .all()
+
+
+def retrieve_oldest_packagelist_change_version(db: Session) -> Optional[int]:
+    logger.debug(f'RETRIEVE the oldest packagelist change version.')
+    row = db.query(PackageListChange.packagelist_version).order_by(PackageListChange.packagelist_version).first()
+    return row.packagelist_version if row else None
+
+
+def compact_packagelist_changes(db: Session, before_version: int) -> int:
+    """
+    删除早于before_version的变更日志，比它更旧的客户端将收到全量manifest
+    """
+    deleted = db.query(PackageListChange) \
+        .filter(PackageListChange.packagelist_version < before_version) \
+        .delete(synchronize_session=False)
+    db.commit()
+    if deleted:
+        logger.debug(f'DELETE {deleted} packagelist changes before {before_version}.')
+    return deleted
+
+
+# ==============================================================================
+
+
+# History
+def migrate_history_columns(db: Session) -> List[str]:
+    """
+    为旧的history表补充`last_download`、`poll_count`、`last_poll`列，可重复执行
+    :return: Added columns.
+    """
+    bind = db.get_bind()
+    columns = {column['name'] for column in inspect(bind).get_columns('history')}
+    added = []
+    for name, ddl in (('last_download', 'DATETIME NULL'),
+                      ('poll_count', 'INTEGER DEFAULT 0'),
+                      ('last_poll', 'DATETIME NULL')):
+        if name not in columns:
+            db.execute(text(f'ALTER TABLE history ADD COLUMN {name} {ddl}'))
+            added.append(name)
+    db.commit()
+    if added:
+        logger.info(f'MIGRATE columns {added} of history.')
+    return added
+
+
+def retrieve_package_versions_by_hashes(db: Session, package_hashes: Iterable[str]) -> Dict[str, tuple]:
+    """
+    当前版本及补丁两端的版本
+    :return: package hash -> (package_name, package_version)
+    """
+    package_hashes = list(package_hashes)
+    logger.debug(f'RETRIEVE package versions of {len(package_hashes)} hashes.')
+    versions = {}
+    for package_name, from_hash, from_version, to_hash, to_version in db.query(
+            Package.package_name, PackagePatch.from_hash, PackagePatch.from_version,
+            PackagePatch.to_hash, PackagePatch.to_version) \
+            .join(Package, Package.id == PackagePatch.package_id) \
+            .filter(PackagePatch.from_hash.in_(package_hashes) | PackagePatch.to_hash.in_(package_hashes)):
+        versions[from_hash] = (package_name, from_version)
+        versions[to_hash] = (package_name, to_version)
+    for package_name, package_version, package_hash in db.query(
+            Package.package_name, Package.package_version, Package.package_hash) \
+            .filter(Package.package_hash.in_(package_hashes)):
+        versions[package_hash] = (package_name, package_version)
+    return versions
+
+
+def migrate_history_unique_key(db: Session) -> int:
+    """
+    为旧的history表加上(package_name, package_version, place_code)唯一索引，可重复执行：
+    之前并发写入产生的重复行先合并到id最小的一行
+    :return: Number of merged rows.
+    """
+    bind = db.get_bind()
+    key_columns = ['package_name', 'package_version', 'place_code']
+    inspector = inspect(bind)
+    if any(index.get('unique') and index['column_names'] == key_columns
+           for index in inspector.get_indexes('history')) or \
+            any(constraint['column_names'] == key_columns
+                for constraint in inspector.get_unique_constraints('history')):
+        return 0
+
+    merged = 0
+    for key in db.query(History.package_name, History.package_version, History.place_code) \
+            .group_by(History.package_name, History.package_version, History.place_code) \
+            .having(func.count(History.id) > 1).all():
+        db_histories = db.query(History).filter(History.package_name == key[0], History.package_version == key[1],
+                                                History.place_code == key[2]).order_by(History.id).all()
+        kept = db_histories[0]
+        for db_history in db_histories[1:]:
+            kept.download_count = str(int(kept.download_count or 0) + int(db_history.download_count or 0))
+            kept.poll_count = (kept.poll_count or 0) + (db_history.poll_count or 0)
+            kept.last_download = max(filter(None, (kept.last_download, db_history.last_download)), default=None)
+            kept.last_poll = max(filter(None, (kept.last_poll, db_history.last_poll)), default=None)
+            db.delete(db_history)
+            merged += 1
+    db.flush()
+    db.execute(text('CREATE UNIQUE INDEX uq_history_key ON history (package_name, package_version, place_code)'))
+    db.commit()
+    logger.info(f'MIGRATE unique key of history, {merged} duplicated rows merged.')
+    return merged
+
+
+def history_upsert_statement(dialect_name: str):
+    """
+    `INSERT ... ON DUPLICATE KEY UPDATE` / `ON CONFLICT DO UPDATE`，在数据库中累加，不读取旧值
+    :return: None if the dialect has no upsert.
+    """
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(History)
+        new = stmt.inserted
+    elif dialect_name in ('postgresql', 'sqlite'):
+        stmt = (postgresql if dialect_name == 'postgresql' else sqlite).insert(History)
+        new = stmt.excluded
+    else:
+        return None
+    values = {'download_count': cast(cast(History.download_count, Integer) + cast(new.download_count, Integer),
+                                     String(10240)),
+              'poll_count': func.coalesce(History.poll_count, 0) + new.poll_count,
+              'last_download': func.coalesce(new.last_download, History.last_download),
+              'last_poll': func.coalesce(new.last_poll, History.last_poll)}
+    if dialect_name == 'mysql':
+        return stmt.on_duplicate_key_update(**values)
+    return stmt.on_conflict_do_update(index_elements=[History.package_name, History.package_version,
+                                                      History.place_code],
+                                      set_=values)
+
+
+def upsert_history_counts(db: Session, counts: Dict[tuple, HistoryCounts], batch_size: int = 500) -> int:
+    """
+    将缓冲的计数累加到已有的行，没有时插入，一次提交
+    累加在数据库中完成，多个worker同时写入同一行时不会丢失计数，也不会插入重复的行
+    :param counts: (package_name, package_version, place_code) -> `history_tools.HistoryCounts`
+    :return: Number of rows written.
+    """
+    rows = [{'package_name': package_name,
+             'package_version': package_version,
+             'place_code': place_code,
+             'download_count': str(item.downloads),
+             'poll_count': item.polls,
+             'last_download': to_datetime(item.last_download),
+             'last_poll': to_datetime(item.last_poll)} for (package_name, package_version, place_code), item in
+            counts.items()]
+    stmt = history_upsert_statement(db.get_bind().dialect.name)
+    if stmt is not None:
+        for start in range(0, len(rows), batch_size):
+            db.execute(stmt, rows[start:start + batch_size])
+    else:
+        for row in rows:
+            if not db.execute(update(History).where(History.package_name == row['package_name'],
+                                                    History.package_version == row['package_version'],
+                                                    History.place_code == row['place_code'])
+                              .values(download_count=cast(cast(History.download_count, Integer) +
+                                                          int(row['download_count']), String(10240)),
+                                      poll_count=func.coalesce(History.poll_count, 0) + row['poll_count'],
+                                      last_download=func.coalesce(row['last_download'], History.last_download),
+                                      last_poll=func.coalesce(row['last_poll'], History.last_poll))).rowcount:
+                db.add(History(**row))
+    db.commit()
+    logger.debug(f'UPSERT {len(counts)} history rows.')
+    return len(counts)
+
+
+def retrieve_histories(db: Session, package_name: Optional[str], place_code: Optional[str], skip: int, limit: int):
+    logger.debug(f'RETRIEVE paginated histories of {package_name} {place_code} {skip} - {limit}.')
+    query = db.query(History)
+    if package_name:
+        query = query.filter(History.package_name == package_name)
+    if place_code:
+        query = query.filter(History.place_code == place_code)
+    return query.order_by(History.id).offset(skip).limit(limit).all()
+
+
+def retrieve_histories_by_package_name(db: Session, package_name: str):
+    logger.debug(f'RETRIEVE all histories of {package_name}.')
+    return db.query(History).filter(History.package_name == package_name).all()
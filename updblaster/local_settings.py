@@ -3,6 +3,89 @@ from pathlib import Path
 # Constants for updating the packagelist.json itself.
 JSON_FILE_NAME = 'newpackagelist.json'
 ZIP_FILE_NAME = 'newpackagelist.zip'
+MANIFEST_ZIP_COMPRESS_LEVEL = 9  # Deflate level of newpackagelist.zip, 0-9.
+
+# JSON responses compressed once when encoded, then picked by `Accept-Encoding`, see `simple_tools/compress_tools.py`.
+RESPONSE_ENCODINGS = ('zstd', 'gzip')  # In order of preference, zstd needs `pip install zstandard`.
+RESPONSE_GZIP_LEVEL = 9
+RESPONSE_ZSTD_LEVEL = 19
+RESPONSE_COMPRESS_MIN_SIZE = 512  # Smaller bodies are not worth the header.
+
+# Uploads are streamed to disk by chunks of this size, so memory usage does not grow with the package size.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4 MiB
+UPLOAD_TEMP_PREFIX = '.uploading-'
+
+# Resumable upload sessions, see `simple_tools/upload_sessions.py`.
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024  # Default size of every chunk except the last one.
+UPLOAD_SESSION_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_EXPIRE_SECONDS = 24 * 60 * 60  # Unfinished sessions older than this are purged.
+
+# Per-place packagelist manifests kept in memory, the least recently used ones are evicted first.
+MANIFEST_CACHE_SIZE = 4096
+
+# Read-through cache of place/package/packagelist lookups on the client hot path, see `simple_tools/lookup_cache.py`.
+LOOKUP_CACHE_SIZE = 4096
+LOOKUP_CACHE_TTL_SECONDS = 60
+
+# Packagelist version subscriptions, see `/npl/watch/` and `/npl/events/`.
+NPL_WATCH_TIMEOUT_SECONDS = 60  # Default long-poll timeout.
+NPL_WATCH_MAX_TIMEOUT_SECONDS = 300
+NPL_SSE_HEARTBEAT_SECONDS = 30  # Comment lines keeping idle SSE connections through proxies.
+COHERENCE_CHECK_INTERVAL_SECONDS = 0.05  # How often every worker checks the versions bumped by other workers.
+
+# Batch client API, see `/updblaster/batch/`.
+BATCH_MAX_PACKAGES = 256
+
+# Staged rollouts of published packages, see `simple_tools/rollout.py`.
+ROLLOUT_MAX_WAVES = 100  # Percentage mode.
+ROLLOUT_CHECK_INTERVAL_SECONDS = 30  # How often every worker opens the waves that are due.
+
+# Download engine, see `simple_tools/file_engine.py`.
+FILE_SEND_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+HOT_FILE_MAX_SIZE = 8 * 1024 * 1024  # Larger files are always sent from disk.
+HOT_FILE_CACHE_BYTES = 256 * 1024 * 1024  # Mapped, so shared with the page cache of the other workers.
+HOT_FILE_ADMIT_HITS = 2  # A file is mapped on its n-th request, files requested once are not worth it.
+# e.g. '/protected', an nginx `internal` location aliasing `PACKAGES_FOLDER`, nginx then sends the files itself.
+X_ACCEL_REDIRECT_LOCATION = None
+
+# Download admission and pacing, see `simple_tools/download_scheduler.py`.
+# `DOWNLOAD_MAX_ACTIVE` and the egress budget are shared by all the workers of the host, the per place limits are
+# per worker.
+DOWNLOAD_SCHEDULER_ENABLED = True
+DOWNLOAD_MAX_ACTIVE = 64
+DOWNLOAD_PLACE_MAX_ACTIVE = 4  # A place is identified by `?place_code=` of the download URL, or the client address.
+DOWNLOAD_EGRESS_BYTES_PER_SECOND = 0  # Budget of the host, 0 for unlimited.
+DOWNLOAD_PLACE_BYTES_PER_SECOND = 0  # 0 for unlimited.
+DOWNLOAD_MIN_BYTES_PER_SECOND = 1024 * 1024  # With a budget, no more downloads than budget / this are admitted.
+DOWNLOAD_RETRY_AFTER_SECONDS = 5  # Estimated download duration, until durations are measured.
+DOWNLOAD_MAX_RETRY_AFTER_SECONDS = 300
+
+# Write-behind accounting of the downloads and polls into the `history` table, see `simple_tools/history_tools.py`.
+HISTORY_ENABLED = True
+HISTORY_FLUSH_INTERVAL_SECONDS = 10  # Every worker writes its counters in one transaction this often.
+HISTORY_BUFFER_MAX_KEYS = 100000  # (package, version, place) counters per worker, new ones are dropped when full.
+
+# How many packagelist versions of change journal are kept for incremental manifests.
+PACKAGELIST_JOURNAL_KEEP_VERSIONS = 1000
+
+# Binary delta patches between package versions, see `simple_tools/delta_tools.py`.
+PATCH_BASE_VERSIONS = 3  # Patches are generated from this many previous versions.
+PATCH_BLOCK_SIZE = 64 * 1024  # Block size for non-zip files.
+PATCH_MAX_RATIO = 0.8  # A patch larger than this ratio of the package is not worth downloading.
+
+# Content-defined chunk store, see `simple_tools/chunk_store.py`.
+# When enabled, package files are kept as deduplicated chunks instead of standalone files.
+CHUNK_STORE_ENABLED = False
+CHUNK_MIN_SIZE = 1024 * 1024  # 1 MiB
+CHUNK_MAX_SIZE = 8 * 1024 * 1024  # 8 MiB
+CHUNK_ANCHORS = (b'PK\x03\x04', b'\xa5\x5a')  # Zip member header, and a 2 bytes anchor for ~64 KiB after min.
+
+# Package files and chunks not referenced by any package or patch base are removed, unless younger than this,
+# they may belong to an upload in progress.
+STORAGE_GC_GRACE_SECONDS = 60 * 60
+
+# Content- or version-addressed URLs never change their content, so proxies and CDNs may cache them forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 DEBUG = True
 if DEBUG:
@@ -13,3 +96,13 @@ else:
     # Formal ENV
     BASE_URL = 'http://update.zhzhiyu.com:80'
     PACKAGES_FOLDER = '/opt/packages'  # Folder in Aliyun ECS cloud server: Ubuntu 20.04, root user.
+
+UPLOAD_SESSIONS_FOLDER = f'{PACKAGES_FOLDER}/uploads'
+PATCHES_FOLDER = f'{PACKAGES_FOLDER}/patches'
+PATCH_BASES_FOLDER = f'{PACKAGES_FOLDER}/patches/bases'
+CHUNKS_FOLDER = f'{PACKAGES_FOLDER}/chunks'
+OBJECTS_FOLDER = f'{PACKAGES_FOLDER}/objects'  # Package files, see `main_tools.package_object_path`.
+# Cache generations shared by all uvicorn workers on the host, see `simple_tools/coherence.py`.
+COHERENCE_FILE = f'{PACKAGES_FOLDER}/run/cache_generations'
+# Active downloads and egress budget shared by all uvicorn workers on the host, see `simple_tools/download_scheduler.py`.
+DOWNLOAD_LIMITS_FILE = f'{PACKAGES_FOLDER}/run/download_limits'
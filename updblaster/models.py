@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, Index, UniqueConstraint
 from sqlalchemy.sql import func
 
 from .database import Base
@@ -41,11 +41,67 @@ class Package(Base):
     package_del_cmd = Column(String(256), nullable=True, default='', comment='删除命令')
     created = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
     # last_updated = Column(DateTime(timezone=True), onupdate=func.now(), comment="最后更新时间")
-    valid_places = Column(String(1024), default='', comment='白名单')
-    invalid_places = Column(String(1024), default='', comment='黑名单')
+    # 黑白名单以`package_place_rules`表为准，以下两列仅为兼容API而保留的逗号分隔的副本
+    valid_places = Column(Text, default='', comment='白名单')
+    invalid_places = Column(Text, default='', comment='黑名单')
     package_path = Column(String(512), nullable=False, comment='Customized Path')
 
 
+class PackagePlaceRule(Base):
+    """
+    Package的黑白名单，每个(package, place)一行，与Package、Place同样不建立外键关系
+    """
+    __tablename__ = 'package_place_rules'
+    __table_args__ = (
+        UniqueConstraint('package_id', 'place_id', 'allowed', name='uq_package_place_rules'),
+        Index('ix_package_place_rules_place_package', 'place_id', 'package_id'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    package_id = Column(Integer, nullable=False, comment='Package id')
+    place_id = Column(Integer, nullable=False, comment='Place id')
+    allowed = Column(Boolean, nullable=False, comment='True为白名单，False为黑名单')
+
+
+class PackageRollout(Base):
+    """
+    Package的分批发布，每个package至多一行，没有此行时按黑白名单对全部place生效，见`simple_tools/rollout.py`
+    """
+    __tablename__ = 'package_rollouts'
+
+    id = Column(Integer, primary_key=True, index=True)
+    package_id = Column(Integer, unique=True, nullable=False, index=True, comment='Package id')
+    package_version = Column(String(256), nullable=False, comment='发布的Package版本')
+    waves = Column(Integer, nullable=False, comment='批次数，百分比发布为100')
+    opened_waves = Column(Integer, nullable=False, comment='已开放的批次数')
+    wave_interval_seconds = Column(Integer, nullable=True, comment='自动开放下一批次的间隔秒数，为空时手动开放')
+    wave_opened_at = Column(Integer, nullable=False, comment='最近一次开放批次的时间戳')
+    halted = Column(Boolean, nullable=False, default=False, comment='暂停，不再开放新的批次')
+    exempt_places = Column(Text, default='', comment='发布前已可更新的places，不受批次限制')
+    created = Column(DateTime(timezone=True), server_default=func.now(), comment='创建时间')
+
+
+class PackagePatch(Base):
+    """
+    从旧版本(from_hash)到新版本(to_hash)的二进制增量补丁
+    """
+    __tablename__ = 'package_patches'
+    __table_args__ = (
+        Index('ix_package_patches_package_to_hash', 'package_id', 'to_hash'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    package_id = Column(Integer, nullable=False, comment='Package id')
+    from_version = Column(String(256), nullable=False, comment='旧版本')
+    from_hash = Column(String(256), nullable=False, comment='旧版本哈希值')
+    to_version = Column(String(256), nullable=False, comment='新版本')
+    to_hash = Column(String(256), nullable=False, comment='新版本哈希值')
+    patch_name = Column(String(256), unique=True, nullable=False, index=True, comment='补丁文件名')
+    patch_length = Column(String(1024), nullable=False, comment='补丁大小')
+    patch_hash = Column(String(256), nullable=False, comment='补丁哈希值')
+    created = Column(DateTime(timezone=True), server_default=func.now(), comment='创建时间')
+
+
 class PackageList(Base):
     __tablename__ = 'packagelist'
 
@@ -56,12 +112,36 @@ class PackageList(Base):
     # last_updated = Column(DateTime(timezone=True), onupdate=func.now(), comment="最后更新时间")
 
 
+class PackageListChange(Base):
+    """
+    packagelist的变更日志，每次版本更新记录一行，用于向客户端返回增量
+    """
+    __tablename__ = 'packagelist_changes'
+
+    id = Column(Integer, primary_key=True, index=True)
+    packagelist_version = Column(Integer, nullable=False, index=True, comment='变更后的packagelist版本')
+    package_id = Column(Integer, nullable=False, comment='Package id')
+    package_name = Column(String(256), nullable=False, comment='Package名称')
+    action = Column(String(16), nullable=False, comment='added, updated, published, rollout, deleted')
+    created = Column(DateTime(timezone=True), server_default=func.now(), comment='创建时间')
+
+
 class History(Base):
+    """
+    每个(package, 版本, place)一行，由`simple_tools/history_tools.py`定期批量写入
+    """
     __tablename__ = 'history'
+    __table_args__ = (
+        # 多个worker并发写入同一行时原子地累加，见`crud.upsert_history_counts`
+        UniqueConstraint('package_name', 'package_version', 'place_code', name='uq_history_key'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     package_name = Column(String(256), nullable=False, index=True, comment='Package名称')
     package_version = Column(String(256), nullable=False, index=True, comment='Package版本')
     place_code = Column(String(256), nullable=False, index=True, comment='Place识别码')
     download_count = Column(String(10240), default='0', comment='同版本下载次数')
-    # last_download = Column(DateTime(timezone=True), onupdate=func.now(), comment='最后下载时间')
+    # 以下各列在写入时设置，旧的history表由`crud.migrate_history_columns`补充
+    last_download = Column(DateTime(timezone=True), nullable=True, comment='最后下载时间')
+    poll_count = Column(Integer, default=0, comment='同版本轮询次数')
+    last_poll = Column(DateTime(timezone=True), nullable=True, comment='最后轮询时间')
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 
@@ -54,6 +54,68 @@ class Package(PackageBase):
         orm_mode = True
 
 
+class PackageRollout(BaseModel):
+    """
+    wave_interval_seconds为None时手动开放批次，opened_waves >= waves时已全部开放
+    """
+    package_id: int
+    package_version: str
+    waves: int
+    opened_waves: int
+    wave_interval_seconds: Optional[int]
+    wave_opened_at: int
+    halted: bool
+    exempt_places: Optional[str]
+    created: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class PackagePatch(BaseModel):
+    package_id: int
+    from_version: str
+    from_hash: str
+    to_version: str
+    to_hash: str
+    patch_name: str
+    patch_length: str
+    patch_hash: str
+
+    class Config:
+        orm_mode = True
+
+
+class PackageChunk(BaseModel):
+    chunk_hash: str
+    offset: int
+    length: int
+
+
+class PackageChunks(BaseModel):
+    package_id: int
+    package_version: str
+    package_hash: str
+    package_length: int
+    chunk_down_url: str  # Template, replace {chunk_hash}.
+    chunks: List[PackageChunk] = []
+
+
+# Batch client API
+class ClientPackage(BaseModel):
+    """
+    客户端本地的包，package_hash优先于package_version判断是否已是最新
+    """
+    package_name: str
+    package_version: Optional[str]
+    package_hash: Optional[str]
+
+
+class ClientPackagesQuery(BaseModel):
+    place_code: str
+    packages: List[ClientPackage] = []
+
+
 # Controller
 class PackagesListBase(BaseModel):
     """
@@ -75,6 +137,65 @@ class PackagesList(PackagesListBase):
         orm_mode = True
 
 
+class PackagesListChange(BaseModel):
+    """
+    action: 'upsert'时package为完整的包信息，'remove'时package为None
+    """
+    action: str
+    package_name: str
+    package: Optional[dict]
+
+
+class PackagesListDiff(BaseModel):
+    """
+    full为True时表示变更日志已被清理，changes中为全部可更新的packages，客户端应整体替换
+    """
+    packagelist_name: str
+    from_version: str
+    to_version: str
+    full: bool
+    changes: List[PackagesListChange] = []
+
+
+# Coverage
+class PackageCoverage(BaseModel):
+    """
+    bitmap: base64，第i位(第i // 8字节的第i % 8位)对应`CoverageMatrix.places[i]`
+    """
+    package_id: int
+    package_name: str
+    count: int
+    bitmap: str
+    place_codes: Optional[List[str]]
+
+
+class CoverageMatrix(BaseModel):
+    place_count: int
+    places: List[str]
+    packages: List[PackageCoverage] = []
+
+
+class CoverageWhatIf(BaseModel):
+    """
+    预览以这些参数发布之后的可更新范围，参数同`PUT /packages/{package_id}`
+    """
+    package_name: str
+    valid_places: str
+    invalid_places: Optional[str]
+    rollout_waves: Optional[int]
+    rollout_opened_waves: int = 1
+
+
+class CoverageWhatIfResult(BaseModel):
+    package_name: str
+    place_count: int
+    current_count: int
+    proposed_count: int
+    added: List[str] = []
+    removed: List[str] = []
+    bitmap: str
+
+
 # History
 class HistoryBase(BaseModel):
     package_name: str
@@ -89,7 +210,48 @@ class HistoryCreate(HistoryBase):
 class History(HistoryBase):
     id: int
     download_count: str
-    last_download: datetime
+    poll_count: Optional[int]
+    last_download: Optional[datetime]
+    last_poll: Optional[datetime]
 
     class Config:
         orm_mode = True
+
+
+class HistoryAdoption(BaseModel):
+    """
+    places: 下载或轮询过该版本的places；current_places: 最近一次下载或轮询为该版本的places
+    """
+    package_version: str
+    places: int
+    current_places: int
+    download_count: int
+    poll_count: int
+    last_download: Optional[datetime]
+
+
+class PackageAdoption(BaseModel):
+    package_name: str
+    versions: List[HistoryAdoption] = []
+
+
+# Upload session
+class UploadChunk(BaseModel):
+    index: int
+    length: int
+    sha256: str
+
+
+class UploadSession(BaseModel):
+    """
+    用于分块、可续传的上传，finalize之后才创建Package
+    """
+    session_id: str
+    package_name: str
+    package_version: str
+    file_name: str
+    file_length: int
+    package_hash: str
+    chunk_size: int
+    total_chunks: int
+    missing_chunks: List[int] = []
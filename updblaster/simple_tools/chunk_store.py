@@ -0,0 +1,232 @@
+"""
+Content-addressed chunk store with cross-version deduplication, enabled by `CHUNK_STORE_ENABLED`.
+
+    CHUNKS_FOLDER/<chunk_hash[:2]>/<chunk_hash>           A unique chunk, named by its sha256.
+    CHUNKS_FOLDER/manifests/<package_hash>.json          Ordered chunks of a package file.
+
+Package files are cut at fixed byte anchors, not at rolling hash (Rabin, gear) boundaries: after `CHUNK_MIN_SIZE`
+bytes, a chunk ends right before the next occurrence of one of `CHUNK_ANCHORS`, or at `CHUNK_MAX_SIZE`.
+`PK\\x03\\x04` starts every zip member, so an unchanged member gives the same chunks wherever it moved in a new
+version of the package, which is what a rolling hash would give for the zip packages, at `bytes.find` speed
+instead of a Python loop per byte. Inside a large changed member, the boundaries only resynchronize at the next
+`\\xa5\\x5a`, on average every 64 KiB of random (compressed) data.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+from updblaster.simple_tools import main_tools
+
+import bisect
+import hashlib
+import json
+import os
+import time
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+MANIFESTS_FOLDER_NAME = 'manifests'
+
+
+class Chunker:
+    """
+    Streaming anchor chunker: feed any sized data, get complete chunks.
+    """
+    def __init__(self,
+                 min_size: int = local_settings.CHUNK_MIN_SIZE,
+                 max_size: int = local_settings.CHUNK_MAX_SIZE,
+                 anchors: Tuple[bytes, ...] = local_settings.CHUNK_ANCHORS):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._anchors = anchors
+        self._buffer = bytearray()
+        # Anchors before this offset of the buffer have been searched already.
+        self._searched = 0
+
+    def _find_boundary(self) -> Optional[int]:
+        start = max(self._min_size, self._searched)
+        end = min(len(self._buffer), self._max_size)
+        boundary = None
+        for anchor in self._anchors:
+            position = self._buffer.find(anchor, start, end + len(anchor) - 1)
+            if 0 <= position < end and (boundary is None or position < boundary):
+                boundary = position
+        if boundary is not None:
+            return boundary
+        if len(self._buffer) >= self._max_size:
+            return self._max_size
+        # An anchor may be cut in half by the end of the buffer, search its beginning again next time.
+        self._searched = max(start, len(self._buffer) - max(len(anchor) for anchor in self._anchors) + 1)
+        return None
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self._buffer += data
+        chunks = []
+        while len(self._buffer) > self._min_size:
+            boundary = self._find_boundary()
+            if boundary is None:
+                break
+            chunks.append(bytes(self._buffer[:boundary]))
+            del self._buffer[:boundary]
+            self._searched = 0
+        return chunks
+
+    def flush(self) -> List[bytes]:
+        chunks = []
+        while self._buffer:
+            boundary = self._find_boundary() if len(self._buffer) > self._min_size else None
+            boundary = boundary or len(self._buffer)
+            chunks.append(bytes(self._buffer[:boundary]))
+            del self._buffer[:boundary]
+            self._searched = 0
+        return chunks
+
+
+def chunk_path(chunk_hash: str) -> str:
+    return f'{local_settings.CHUNKS_FOLDER}/{chunk_hash[:2]}/{chunk_hash}'
+
+
+def manifest_path(package_hash: str) -> str:
+    return f'{local_settings.CHUNKS_FOLDER}/{MANIFESTS_FOLDER_NAME}/{package_hash}.json'
+
+
+def has_manifest(package_hash: str) -> bool:
+    return os.path.exists(manifest_path(package_hash))
+
+
+def _store_chunk(data: bytes) -> Tuple[str, bool]:
+    """
+    :return: (chunk_hash, whether it was stored already)
+    """
+    chunk_hash = hashlib.sha256(data).hexdigest()
+    path = chunk_path(chunk_hash)
+    if os.path.exists(path):
+        # Deduplicated. Refresh the mtime so a concurrent garbage collection keeps it.
+        os.utime(path)
+        return chunk_hash, True
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    main_tools.write_file_atomically(path, data)
+    return chunk_hash, False
+
+
+def ingest_file(file_path: str, package_hash: str) -> dict:
+    """
+    Split the file into chunks, store the new ones, then write the manifest.
+    :return: Manifest dict.
+    """
+    chunker = Chunker()
+    chunks = []
+    offset = 0
+    stored_before = 0
+
+    def store(datas: Iterable[bytes]):
+        nonlocal offset, stored_before
+        for data in datas:
+            chunk_hash, existed = _store_chunk(data)
+            stored_before += existed
+            chunks.append({'chunk_hash': chunk_hash, 'offset': offset, 'length': len(data)})
+            offset += len(data)
+
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(local_settings.UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            store(chunker.feed(data))
+    store(chunker.flush())
+
+    manifest = {'package_hash': package_hash, 'package_length': offset, 'chunks': chunks}
+    os.makedirs(os.path.dirname(manifest_path(package_hash)), exist_ok=True)
+    main_tools.write_file_atomically(manifest_path(package_hash), json.dumps(manifest).encode())
+    logger.info(f'Ingested {package_hash} into {len(chunks)} chunks, {stored_before} of them deduplicated.')
+    return manifest
+
+
+def load_manifest(package_hash: str) -> Optional[dict]:
+    try:
+        with open(manifest_path(package_hash)) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def read_range(manifest: dict):
+    """
+    :return: A `download_tools.RangeReader` streaming the chunks straight from the store.
+    """
+    chunks = manifest['chunks']
+    offsets = [chunk['offset'] for chunk in chunks]
+
+    def reader(start: int, end: int) -> Iterator[bytes]:
+        index = bisect.bisect_right(offsets, start) - 1
+        position = start
+        while position <= end and index < len(chunks):
+            chunk = chunks[index]
+            with open(chunk_path(chunk['chunk_hash']), 'rb') as f:
+                f.seek(position - chunk['offset'])
+                remaining = min(end + 1, chunk['offset'] + chunk['length']) - position
+                while remaining > 0:
+                    data = f.read(min(local_settings.UPLOAD_CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError(f'Chunk {chunk["chunk_hash"]} is truncated.')
+                    remaining -= len(data)
+                    position += len(data)
+                    yield data
+            index += 1
+    return reader
+
+
+def materialize(package_hash: str, file_path: str):
+    """
+    Rebuild the whole package file from its chunks.
+    """
+    manifest = load_manifest(package_hash)
+    if manifest is None:
+        raise FileNotFoundError(manifest_path(package_hash))
+    with open(file_path, 'wb') as f:
+        for data in read_range(manifest)(0, manifest['package_length'] - 1):
+            f.write(data)
+
+
+def collect_garbage(keep_package_hashes: Set[str]) -> Tuple[int, int]:
+    """
+    Remove manifests not in `keep_package_hashes`, then chunks not referenced by any kept manifest.
+    Manifests and chunks younger than `STORAGE_GC_GRACE_SECONDS` are always kept, they may belong to a package
+    committed after `keep_package_hashes` was queried, or to an upload in progress.
+    :return: (removed manifests, removed chunks)
+    """
+    manifests_folder = f'{local_settings.CHUNKS_FOLDER}/{MANIFESTS_FOLDER_NAME}'
+    if not os.path.isdir(manifests_folder):
+        return 0, 0
+
+    removed_manifests = 0
+    live_chunks = set()
+    deadline = time.time() - local_settings.STORAGE_GC_GRACE_SECONDS
+    for name in os.listdir(manifests_folder):
+        package_hash, ext = os.path.splitext(name)
+        if ext != '.json':
+            continue
+        path = f'{manifests_folder}/{name}'
+        try:
+            if package_hash not in keep_package_hashes and os.path.getmtime(path) < deadline:
+                os.remove(path)
+                removed_manifests += 1
+                continue
+        except OSError:
+            continue
+        manifest = load_manifest(package_hash) or {'chunks': []}
+        live_chunks.update(chunk['chunk_hash'] for chunk in manifest['chunks'])
+
+    removed_chunks = 0
+    for prefix in os.listdir(local_settings.CHUNKS_FOLDER):
+        folder = f'{local_settings.CHUNKS_FOLDER}/{prefix}'
+        if prefix == MANIFESTS_FOLDER_NAME or not os.path.isdir(folder):
+            continue
+        for chunk_hash in os.listdir(folder):
+            path = f'{folder}/{chunk_hash}'
+            try:
+                if chunk_hash not in live_chunks and os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    removed_chunks += 1
+            except OSError:
+                continue
+
+    logger.info(f'Chunk store garbage collected {removed_manifests} manifests and {removed_chunks} chunks.')
+    return removed_manifests, removed_chunks
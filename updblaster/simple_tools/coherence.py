@@ -0,0 +1,134 @@
+"""
+Cross-worker cache coherence without an external broker.
+
+Every uvicorn worker keeps its own in-process caches. A small file shared by all workers of the host holds
+one 64 bits generation counter per cache slot, and is memory mapped, so reading it costs no syscall:
+    - a write bumps the counters of the slots it changed (under `flock`), after invalidating its own caches;
+    - every request compares the counters with the ones it saw last, and drops the local caches of changed slots.
+So the other workers see a write on their very next request.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+COUNTER = struct.Struct('<Q')
+
+# Slot names, in file order. New slots must be appended.
+SLOTS = ('places', 'packages', 'patches', 'packagelists', 'manifests', 'eligibility')
+
+
+class SharedMemoryFile:
+    """
+    A small file memory mapped by every worker of the host, written under `flock`.
+    """
+    def __init__(self, file_path: str, size: int):
+        self.file_path = file_path
+        self._size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self.mm = None
+
+    def ensure_mapped(self) -> bool:
+        """
+        :return: True if just mapped by this process.
+        """
+        # Workers may be forked after import, every process maps the file by itself.
+        if self._pid == os.getpid():
+            return False
+        with self._lock:
+            if self._pid == os.getpid():
+                return False
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < self._size:
+                    os.ftruncate(fd, self._size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            self.mm = mmap.mmap(fd, self._size)
+            self._pid = os.getpid()
+            return True
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclusive across the workers, and the threads of this worker.
+        """
+        self.ensure_mapped()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self.mm
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class SharedGenerations:
+    def __init__(self, file_path: str = local_settings.COHERENCE_FILE, slots=SLOTS):
+        self._offsets = {slot: index * COUNTER.size for index, slot in enumerate(slots)}
+        self._file = SharedMemoryFile(file_path, len(slots) * COUNTER.size)
+        self._seen: Dict[str, int] = {}
+        self._handlers: Dict[str, List[Callable[[], None]]] = {slot: [] for slot in slots}
+
+    def _ensure_mapped(self):
+        if self._file.ensure_mapped():
+            self._seen = {slot: self._read(slot) for slot in self._offsets}
+
+    def _read(self, slot: str) -> int:
+        return COUNTER.unpack_from(self._file.mm, self._offsets[slot])[0]
+
+    def register(self, slot: str, handler: Callable[[], None]):
+        """
+        :param handler: Drops the local caches of `slot`, called when another worker bumped it.
+        """
+        self._handlers[slot].append(handler)
+
+    def publish(self, *slots: str):
+        """
+        Bump the counters after a write, the local caches must have been invalidated already.
+        """
+        try:
+            self._ensure_mapped()
+            with self._file.locked() as mm:
+                for slot in slots:
+                    generation = self._read(slot) + 1
+                    COUNTER.pack_into(mm, self._offsets[slot], generation)
+                    # Only skip our own bump, a concurrent bump of another worker is still handled by `check`.
+                    if generation == self._seen.get(slot, 0) + 1:
+                        self._seen[slot] = generation
+        except OSError as e:
+            logger.error(f'Publish cache generations {slots} failed, detail: {e}.')
+
+    def check(self):
+        """
+        Called on every request, drops the local caches changed by other workers.
+        """
+        try:
+            self._ensure_mapped()
+        except OSError as e:
+            logger.error(f'Map cache generations file {self._file.file_path} failed, detail: {e}.')
+            return
+        for slot in self._offsets:
+            generation = self._read(slot)
+            if generation != self._seen[slot]:
+                self._seen[slot] = generation
+                logger.debug(f'Cache slot {slot} changed by another worker, generation {generation}.')
+                for handler in self._handlers[slot]:
+                    handler()
+
+    def generations(self) -> Dict[str, int]:
+        self._ensure_mapped()
+        return {slot: self._read(slot) for slot in self._offsets}
+
+
+shared_generations = SharedGenerations()
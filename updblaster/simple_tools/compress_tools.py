@@ -0,0 +1,88 @@
+"""
+Compressed variants of the cached JSON responses, picked by the `Accept-Encoding` of every request.
+
+The payloads are compressed once when encoded, see `encode_variants`, and cached together with the plain bytes,
+so a request only chooses the variant, nothing is compressed per request.
+gzip is always available, zstd when `zstandard` is installed (`pip install zstandard`).
+"""
+from updblaster import local_settings
+from updblaster.logger import logger
+
+import gzip
+from typing import Dict, NamedTuple, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # Optional
+    zstandard = None
+
+
+def _gzip(data: bytes) -> bytes:
+    # mtime=0, the same body always gives the same bytes.
+    return gzip.compress(data, compresslevel=local_settings.RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def _zstd(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=local_settings.RESPONSE_ZSTD_LEVEL).compress(data)
+
+
+COMPRESSORS = {'gzip': _gzip}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = _zstd
+
+ENCODINGS = tuple(encoding for encoding in local_settings.RESPONSE_ENCODINGS if encoding in COMPRESSORS)
+
+
+class EncodedBody(NamedTuple):
+    identity: bytes
+    variants: Dict[str, bytes]  # Content coding -> compressed bytes, only the ones smaller than `identity`.
+
+
+def encode_variants(body: bytes) -> EncodedBody:
+    variants = {}
+    if len(body) >= local_settings.RESPONSE_COMPRESS_MIN_SIZE:
+        for encoding in ENCODINGS:
+            compressed = COMPRESSORS[encoding](body)
+            if len(compressed) < len(body):
+                variants[encoding] = compressed
+    return EncodedBody(identity=body, variants=variants)
+
+
+def parse_accept_encoding(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """
+    e.g.: 'gzip, zstd;q=0.5, *;q=0' -> {'gzip': 1.0, 'zstd': 0.5, '*': 0.0}
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    logger.debug(f'Bad Accept-Encoding quality {value}.')
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def negotiate(encoded: EncodedBody, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """
+    :return: (body, content coding), the content coding is None for the plain body.
+    """
+    if not encoded.variants or not accept_encoding:
+        return encoded.identity, None
+    qualities = parse_accept_encoding(accept_encoding)
+    best, best_quality = None, 0.0
+    # The first one of `ENCODINGS` wins among equal qualities.
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if encoding in encoded.variants and quality > best_quality:
+            best, best_quality = encoding, quality
+    if best is None:
+        return encoded.identity, None
+    return encoded.variants[best], best
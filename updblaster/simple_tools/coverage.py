@@ -0,0 +1,105 @@
+"""
+Coverage of the whole fleet: which places every package could be updated to, in one computation.
+
+Every place gets a bit, in the order of `PlaceIndex`, and every package a mask of its places, as a Python int:
+    coverage = allow & ~deny [& (opened waves | exempt places)]
+so a package costs a few operations on `places / 8` bytes, instead of one `check_update_enabled` per place.
+The masks are serialized as base64 bitmaps, bit i (byte i // 8, bit i % 8) being the place i.
+"""
+import base64
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from updblaster.simple_tools.eligibility import compile_package_rules
+from updblaster.simple_tools.rollout import RolloutState, place_wave
+
+
+class PlaceIndex:
+    def __init__(self, places: Iterable[Tuple[int, str]]):
+        """
+        :param places: (place_id, place_code), in the order of the bits.
+        """
+        self.place_ids: List[int] = []
+        self.place_codes: List[str] = []
+        for place_id, place_code in places:
+            self.place_ids.append(place_id)
+            self.place_codes.append(place_code)
+        self.positions: Dict[int, int] = {place_id: i for i, place_id in enumerate(self.place_ids)}
+        # waves -> wave of every place
+        self._waves: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.place_ids)
+
+    def mask(self, place_ids: Iterable[int]) -> int:
+        """
+        :param place_ids: The unknown (e.g. removed) places are ignored.
+        """
+        bits = bytearray((len(self.place_ids) + 7) // 8)
+        for place_id in place_ids:
+            i = self.positions.get(place_id)
+            if i is not None:
+                bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, 'little')
+
+    def rollout_mask(self, rollout: RolloutState) -> int:
+        """
+        :return: The places reached by the rollout.
+        """
+        if rollout.completed:
+            return (1 << len(self.place_ids)) - 1
+        waves = self._waves.get(rollout.waves)
+        if waves is None:
+            waves = self._waves[rollout.waves] = [place_wave(place_code, rollout.waves)
+                                                  for place_code in self.place_codes]
+        bits = bytearray((len(self.place_ids) + 7) // 8)
+        for i, wave in enumerate(waves):
+            if wave < rollout.opened_waves:
+                bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, 'little') | self.mask(rollout.exempt_places)
+
+    def coverage(self, allow: Iterable[int], deny: Iterable[int], rollout: Optional[RolloutState] = None) -> int:
+        mask = self.mask(allow) & ~self.mask(deny)
+        if rollout is not None:
+            mask &= self.rollout_mask(rollout)
+        return mask
+
+    def bitmap(self, mask: int) -> str:
+        return base64.b64encode(mask.to_bytes((len(self.place_ids) + 7) // 8, 'little')).decode('ascii')
+
+    def place_codes_of(self, mask: int) -> List[str]:
+        place_codes = []
+        for byte_index, byte in enumerate(mask.to_bytes((len(self.place_ids) + 7) // 8, 'little')):
+            while byte:
+                low = byte & -byte
+                place_codes.append(self.place_codes[(byte_index << 3) + low.bit_length() - 1])
+                byte ^= low
+        return place_codes
+
+
+def count(mask: int) -> int:
+    return bin(mask).count('1')
+
+
+def group_rules(rules: Iterable[Tuple[int, int, bool]]) -> Dict[int, Tuple[List[int], List[int]]]:
+    """
+    :param rules: (package_id, place_id, allowed) rows.
+    :return: package id -> (allowed place ids, denied place ids)
+    """
+    grouped: Dict[int, Tuple[List[int], List[int]]] = {}
+    for package_id, place_id, allowed in rules:
+        grouped.setdefault(package_id, ([], []))[0 if allowed else 1].append(place_id)
+    return grouped
+
+
+def proposed_coverage(places: PlaceIndex, valid_places: Optional[str], invalid_places: Optional[str],
+                      current: int, rollout_waves: Optional[int] = None, rollout_opened_waves: int = 1) -> int:
+    """
+    The coverage a publish with these rules would give, see `main.publish_package`.
+    :param current: The current coverage, exempt from the rollout.
+    """
+    allow, deny = compile_package_rules(valid_places, invalid_places)
+    mask = places.coverage(allow, deny)
+    if rollout_waves is not None:
+        mask &= places.rollout_mask(RolloutState(waves=rollout_waves, opened_waves=rollout_opened_waves,
+                                                 exempt_places=frozenset())) | current
+    return mask
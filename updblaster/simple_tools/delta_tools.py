@@ -0,0 +1,174 @@
+"""
+Binary delta patches between two versions of a package.
+
+Patch format (all integers are unsigned 64 bits big-endian):
+    b'UBDELTA1' | target length | target sha256 (32 bytes) | base sha256 (32 bytes)
+    then a sequence of operations:
+    b'C' | base offset | length       Copy bytes from the base file.
+    b'I' | length | data              Insert literal bytes.
+Applying the patch to the base file gives the target file byte by byte, so its sha256 is the `package_hash`.
+
+Packages are zip files: when both files are zips, every member (local header + data) is a segment,
+so unchanged members are copied from the base wherever they moved. Other files are cut into fixed blocks.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import hashlib
+import os
+import struct
+import zipfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b'UBDELTA1'
+HEADER = struct.Struct('>8sQ32s32s')
+COPY = struct.Struct('>cQQ')
+INSERT = struct.Struct('>cQ')
+
+# Segments: (offset, length)
+Segment = Tuple[int, int]
+
+
+class DeltaError(Exception):
+    pass
+
+
+def _zip_segments(file_path: str, file_size: int) -> Optional[List[Segment]]:
+    """
+    Cut a zip file at the local header offset of every member, the central directory is the last segment.
+    :return: None if it is not a zip file.
+    """
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            offsets = sorted({info.header_offset for info in zf.infolist()})
+            start_dir = getattr(zf, 'start_dir', file_size)
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+    bounds = [0] + offsets + [start_dir, file_size]
+    bounds = sorted(set(bound for bound in bounds if 0 <= bound <= file_size))
+    return [(start, end - start) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _block_segments(file_size: int) -> List[Segment]:
+    block_size = local_settings.PATCH_BLOCK_SIZE
+    return [(offset, min(block_size, file_size - offset)) for offset in range(0, file_size, block_size)]
+
+
+def _segments(file_path: str) -> List[Segment]:
+    file_size = os.path.getsize(file_path)
+    return _zip_segments(file_path, file_size) or _block_segments(file_size)
+
+
+def _iter_segment_hashes(f: BinaryIO, segments: List[Segment]) -> Iterator[Tuple[Segment, bytes]]:
+    for offset, length in segments:
+        f.seek(offset)
+        sha256 = hashlib.sha256()
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(local_settings.UPLOAD_CHUNK_SIZE, remaining))
+            if not data:
+                raise DeltaError(f'Unexpected end of file at {offset + length - remaining}.')
+            sha256.update(data)
+            remaining -= len(data)
+        yield (offset, length), sha256.digest()
+
+
+def _copy_bytes(src: BinaryIO, dst: BinaryIO, offset: int, length: int, sha256=None):
+    src.seek(offset)
+    remaining = length
+    while remaining > 0:
+        data = src.read(min(local_settings.UPLOAD_CHUNK_SIZE, remaining))
+        if not data:
+            raise DeltaError(f'Unexpected end of file at {offset + length - remaining}.')
+        if dst is not None:
+            dst.write(data)
+        if sha256 is not None:
+            sha256.update(data)
+        remaining -= len(data)
+
+
+def make_delta(base_path: str, base_hash: str, target_path: str, target_hash: str, patch_path: str) -> bool:
+    """
+    :return: False if the patch is not worth it, i.e. larger than PATCH_MAX_RATIO of the target,
+             in which case nothing is left at `patch_path`.
+    """
+    target_size = os.path.getsize(target_path)
+
+    with open(base_path, 'rb') as base:
+        base_index: Dict[bytes, Segment] = {}
+        for segment, digest in _iter_segment_hashes(base, _segments(base_path)):
+            base_index.setdefault(digest, segment)
+
+    # Plan the operations first, consecutive copies and inserts are merged.
+    operations: List[Tuple[str, int, int]] = []  # ('C', base offset, length) or ('I', target offset, length)
+    with open(target_path, 'rb') as target:
+        for (offset, length), digest in _iter_segment_hashes(target, _segments(target_path)):
+            matched = base_index.get(digest)
+            if matched and matched[1] == length:
+                last = operations[-1] if operations else None
+                if last and last[0] == 'C' and last[1] + last[2] == matched[0]:
+                    operations[-1] = ('C', last[1], last[2] + length)
+                else:
+                    operations.append(('C', matched[0], length))
+            else:
+                last = operations[-1] if operations else None
+                if last and last[0] == 'I' and last[1] + last[2] == offset:
+                    operations[-1] = ('I', last[1], last[2] + length)
+                else:
+                    operations.append(('I', offset, length))
+
+    insert_size = sum(length for op, _, length in operations if op == 'I')
+    patch_size = HEADER.size + insert_size + COPY.size * len(operations)
+    if patch_size > target_size * local_settings.PATCH_MAX_RATIO:
+        logger.info(f'Delta {base_path} -> {target_path} not worth it: {patch_size} / {target_size} bytes.')
+        return False
+
+    with open(target_path, 'rb') as target, open(patch_path, 'wb') as patch:
+        patch.write(HEADER.pack(MAGIC, target_size, bytes.fromhex(target_hash), bytes.fromhex(base_hash)))
+        for op, offset, length in operations:
+            if op == 'C':
+                patch.write(COPY.pack(b'C', offset, length))
+            else:
+                patch.write(INSERT.pack(b'I', length))
+                _copy_bytes(target, patch, offset, length)
+
+    logger.info(f'Delta {base_path} -> {target_path}: {patch_size} / {target_size} bytes, '
+                f'{len(operations)} operations.')
+    return True
+
+
+def apply_delta(base_path: str, patch_path: str, out_path: Optional[str] = None) -> str:
+    """
+    Rebuild the target from the base and the patch, the same as the client does.
+    :param out_path: None to only verify the patch without writing.
+    :return: sha256 of the rebuilt target.
+    :raise DeltaError: The patch is broken or does not match the base.
+    """
+    sha256 = hashlib.sha256()
+    with open(base_path, 'rb') as base, open(patch_path, 'rb') as patch:
+        magic, target_size, target_hash, _ = HEADER.unpack(patch.read(HEADER.size))
+        if magic != MAGIC:
+            raise DeltaError(f'{patch_path} is not a delta patch.')
+
+        out = open(out_path, 'wb') if out_path else None
+        try:
+            while True:
+                op = patch.read(1)
+                if not op:
+                    break
+                if op == b'C':
+                    offset, length = struct.unpack('>QQ', patch.read(16))
+                    _copy_bytes(base, out, offset, length, sha256)
+                elif op == b'I':
+                    length, = struct.unpack('>Q', patch.read(8))
+                    _copy_bytes(patch, out, patch.tell(), length, sha256)
+                else:
+                    raise DeltaError(f'Unknown operation {op!r} in {patch_path}.')
+        finally:
+            if out:
+                out.close()
+
+    if sha256.digest() != target_hash:
+        raise DeltaError(f'{patch_path} rebuilt a wrong target.')
+    return sha256.hexdigest()
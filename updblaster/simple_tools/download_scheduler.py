@@ -0,0 +1,376 @@
+"""
+Admission and pacing of the package downloads, so a big release does not saturate the uplink.
+
+- Every download takes a slot, bounded globally (`DOWNLOAD_MAX_ACTIVE`, and by the egress budget:
+  no more downloads than `DOWNLOAD_EGRESS_BYTES_PER_SECOND / DOWNLOAD_MIN_BYTES_PER_SECOND`) and per place.
+- A download over the limits is rejected at once with a `Retry-After`, instead of a stalled connection:
+  429 when its place has too many downloads, 503 when the server is busy.
+- The rejected requests form a virtual round-robin queue across places: the `Retry-After` of a place's
+  n-th waiting request counts, for every place, up to n waiting requests ahead of it. So a place
+  with many clients waits longer, it does not push back the places with few.
+- The body is paced by token buckets, one global and one per place.
+
+A place is identified by the `place_code` query parameter of the download URL, or by the client address.
+The global limits (`DOWNLOAD_MAX_ACTIVE` and the egress bucket) are shared by all the uvicorn workers of the host,
+through a memory mapped file written under `flock`, see `SharedDownloadLimits`. The per place limits and the
+waiting queue are per worker.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import asyncio
+import math
+import os
+import struct
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import Deque, Dict, Optional, Tuple
+
+import anyio
+from fastapi import HTTPException, status
+from fastapi.responses import Response
+
+from updblaster.simple_tools.coherence import SharedMemoryFile
+
+
+class TokenBucket:
+    """
+    Reservations may go into debt, the caller sleeps until its bytes are covered, so callers are served in order.
+    """
+    def __init__(self, rate: float, burst: float):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        """
+        :return: Seconds to wait before sending `amount` bytes.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+
+def make_bucket(rate: int) -> Optional[TokenBucket]:
+    return TokenBucket(rate=rate, burst=rate) if rate > 0 else None
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedDownloadLimits:
+    """
+    The global active downloads and egress token bucket, shared by the workers of the host.
+
+        header: egress tokens (double), updated at (double, `time.monotonic`, the same clock for all processes),
+                initialized (u64)
+        slots:  (pid, active downloads) (u64, u64) per worker
+
+    Every worker counts its downloads in its own slot, the slots of dead workers are reclaimed,
+    so a crashed worker does not hold its downloads forever.
+    """
+    HEADER = struct.Struct('<ddQ')
+    SLOT = struct.Struct('<QQ')
+
+    def __init__(self, file_path: str = local_settings.DOWNLOAD_LIMITS_FILE, slots: int = 256):
+        self._slots = slots
+        self._file = SharedMemoryFile(file_path, self.HEADER.size + slots * self.SLOT.size)
+        # (pid, slot index) of this process
+        self._slot = (None, 0)
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER.size + index * self.SLOT.size
+
+    def _reap(self, mm) -> int:
+        """
+        Reclaim the slots of dead workers.
+        :return: Active downloads of the live workers.
+        """
+        active = 0
+        for index in range(self._slots):
+            pid, slot_active = self.SLOT.unpack_from(mm, self._offset(index))
+            if not pid:
+                continue
+            if pid != os.getpid() and not _process_alive(pid):
+                self.SLOT.pack_into(mm, self._offset(index), 0, 0)
+                continue
+            active += slot_active
+        return active
+
+    def _own_slot(self, mm) -> int:
+        pid, index = self._slot
+        if pid == os.getpid():
+            return index
+        self._reap(mm)
+        free = None
+        for index in range(self._slots):
+            slot_pid, _ = self.SLOT.unpack_from(mm, self._offset(index))
+            if slot_pid == os.getpid():
+                free = index
+                break
+            if not slot_pid and free is None:
+                free = index
+        if free is None:
+            raise OSError(f'No free slot in {self._file.file_path}.')
+        self.SLOT.pack_into(mm, self._offset(free), os.getpid(), 0)
+        self._slot = (os.getpid(), free)
+        return free
+
+    def _add_active(self, mm, delta: int):
+        index = self._own_slot(mm)
+        pid, active = self.SLOT.unpack_from(mm, self._offset(index))
+        self.SLOT.pack_into(mm, self._offset(index), pid, max(0, active + delta))
+
+    def active(self) -> int:
+        with self._file.locked() as mm:
+            return self._reap(mm)
+
+    def acquire(self, max_active: int) -> bool:
+        """
+        :return: False if `max_active` downloads are active on the host already.
+        """
+        with self._file.locked() as mm:
+            self._own_slot(mm)
+            if self._reap(mm) >= max_active:
+                return False
+            self._add_active(mm, 1)
+            return True
+
+    def release(self):
+        with self._file.locked() as mm:
+            self._add_active(mm, -1)
+
+    def reserve(self, amount: int, rate: float, burst: float) -> float:
+        """
+        The same as `TokenBucket.reserve`, on the shared bucket.
+        """
+        with self._file.locked() as mm:
+            tokens, updated, initialized = self.HEADER.unpack_from(mm, 0)
+            now = time.monotonic()
+            tokens = min(burst, tokens + (now - updated) * rate) if initialized else burst
+            tokens -= amount
+            self.HEADER.pack_into(mm, 0, tokens, now, 1)
+            return 0.0 if tokens >= 0 else -tokens / rate
+
+
+class Ticket:
+    def __init__(self, scheduler: 'DownloadScheduler', place_key: str, place_bucket: Optional[TokenBucket],
+                 shared: bool = True):
+        self.scheduler = scheduler
+        self.shared = shared
+        self.place_key = place_key
+        self.place_bucket = place_bucket
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+
+class DownloadScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._place_active: Dict[str, int] = {}
+        self._place_buckets: Dict[str, TokenBucket] = {}
+        self._shared = SharedDownloadLimits()
+        # place key -> deadlines of its waiting (rejected, expected to retry) requests.
+        self._waiting: Dict[str, Deque[float]] = {}
+        # Exponentially weighted average of the download durations, in seconds.
+        self._average_duration = float(local_settings.DOWNLOAD_RETRY_AFTER_SECONDS)
+        self._counters = {'admitted': 0, 'rejected_place': 0, 'rejected_busy': 0, 'completed': 0, 'bytes_sent': 0}
+
+    @staticmethod
+    def max_active() -> int:
+        max_active = local_settings.DOWNLOAD_MAX_ACTIVE
+        if local_settings.DOWNLOAD_EGRESS_BYTES_PER_SECOND > 0 and local_settings.DOWNLOAD_MIN_BYTES_PER_SECOND > 0:
+            max_active = min(max_active, max(1, local_settings.DOWNLOAD_EGRESS_BYTES_PER_SECOND
+                                             // local_settings.DOWNLOAD_MIN_BYTES_PER_SECOND))
+        return max_active
+
+    def _expire_waiting(self, now: float):
+        for place_key in list(self._waiting):
+            deadlines = self._waiting[place_key]
+            while deadlines and deadlines[0] < now:
+                deadlines.popleft()
+            if not deadlines:
+                del self._waiting[place_key]
+
+    def _wait_position(self, place_key: str) -> int:
+        """
+        Round-robin position of a new waiting request of `place_key`, among all the waiting requests.
+        """
+        rank = len(self._waiting.get(place_key, ())) + 1
+        return sum(min(len(deadlines), rank) for key, deadlines in self._waiting.items() if key != place_key) + rank
+
+    def _reject(self, place_key: str, status_code: int, reason: str, now: float):
+        position = self._wait_position(place_key)
+        retry_after = min(local_settings.DOWNLOAD_MAX_RETRY_AFTER_SECONDS,
+                          math.ceil(self._average_duration * position / self.max_active()))
+        retry_after = max(1, retry_after)
+        # Kept until a bit after the client should have come back.
+        self._waiting.setdefault(place_key, deque()).append(now + retry_after + self._average_duration)
+        self._counters[reason] += 1
+        logger.info(f'Download of {place_key} rejected ({reason}), retry after {retry_after}s, '
+                    f'position {position}.')
+        raise HTTPException(status_code=status_code,
+                            detail=f'Too many downloads, retry after {retry_after} seconds.',
+                            headers={'Retry-After': str(retry_after)})
+
+    def _acquire_shared(self) -> Tuple[bool, bool]:
+        """
+        :return: (admitted, counted in the shared file)
+        """
+        try:
+            return self._shared.acquire(self.max_active()), True
+        except OSError as e:
+            # Without the shared file, at least the limits of this worker.
+            logger.error(f'Acquire shared download limits failed, detail: {e}.')
+            return self._active < self.max_active(), False
+
+    def _release_shared(self):
+        try:
+            self._shared.release()
+        except OSError as e:
+            logger.error(f'Release shared download limits failed, detail: {e}.')
+
+    def admit(self, place_key: str) -> Ticket:
+        """
+        :raise HTTPException: 429 or 503, with `Retry-After`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire_waiting(now)
+            place_active = self._place_active.get(place_key, 0)
+            if place_active >= local_settings.DOWNLOAD_PLACE_MAX_ACTIVE:
+                self._reject(place_key, status.HTTP_429_TOO_MANY_REQUESTS, 'rejected_place', now)
+            admitted, shared = self._acquire_shared()
+            if not admitted:
+                self._reject(place_key, status.HTTP_503_SERVICE_UNAVAILABLE, 'rejected_busy', now)
+
+            # Admitted, it is no longer waiting.
+            deadlines = self._waiting.get(place_key)
+            if deadlines:
+                deadlines.popleft()
+                if not deadlines:
+                    del self._waiting[place_key]
+            self._active += 1
+            self._place_active[place_key] = place_active + 1
+            if place_key not in self._place_buckets:
+                bucket = make_bucket(local_settings.DOWNLOAD_PLACE_BYTES_PER_SECOND)
+                if bucket:
+                    self._place_buckets[place_key] = bucket
+            self._counters['admitted'] += 1
+            return Ticket(self, place_key, self._place_buckets.get(place_key), shared=shared)
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            self._active -= 1
+            self._place_active[ticket.place_key] -= 1
+            if not self._place_active[ticket.place_key]:
+                del self._place_active[ticket.place_key]
+                self._place_buckets.pop(ticket.place_key, None)
+            duration = time.monotonic() - ticket.started
+            self._average_duration += 0.2 * (duration - self._average_duration)
+            self._counters['completed'] += 1
+        if ticket.shared:
+            self._release_shared()
+
+    def pace(self, ticket: Ticket, amount: int) -> float:
+        """
+        :return: Seconds to wait before sending `amount` more bytes of `ticket`.
+        """
+        with self._lock:
+            self._counters['bytes_sent'] += amount
+        delays = [ticket.place_bucket.reserve(amount)] if ticket.place_bucket else []
+        rate = local_settings.DOWNLOAD_EGRESS_BYTES_PER_SECOND
+        if rate > 0:
+            try:
+                delays.append(self._shared.reserve(amount, rate=rate, burst=rate))
+            except OSError as e:
+                logger.error(f'Reserve shared egress failed, detail: {e}.')
+        return max(delays, default=0.0)
+
+    def _shared_active(self) -> Optional[int]:
+        try:
+            return self._shared.active()
+        except OSError:
+            return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire_waiting(time.monotonic())
+            return dict(self._counters,
+                        active=self._active,
+                        host_active=self._shared_active(),
+                        max_active=self.max_active(),
+                        active_places=len(self._place_active),
+                        waiting=sum(len(deadlines) for deadlines in self._waiting.values()),
+                        waiting_places=len(self._waiting),
+                        average_duration=round(self._average_duration, 3))
+
+
+download_scheduler = DownloadScheduler()
+
+
+class ScheduledResponse(Response):
+    """
+    Sends `response` paced by the ticket's buckets, and releases the ticket when done or when the client is gone.
+    """
+    def __init__(self, response: Response, ticket: Ticket):
+        self.response = response
+        self.ticket = ticket
+        self.status_code = response.status_code
+        self.background = None
+        self.raw_headers = response.raw_headers
+
+    async def __call__(self, scope, receive, send):
+        async def paced_send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                delay = self.ticket.scheduler.pace(self.ticket, len(message['body']))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await send(message)
+
+        async def listen_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        try:
+            async with anyio.create_task_group() as task_group:
+                async def wrap(func):
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self.response, scope, receive, paced_send))
+                await wrap(listen_for_disconnect)
+        finally:
+            self.ticket.release()
+
+
+def schedule_download(response: Optional[Response], place_code: Optional[str], request) -> Optional[Response]:
+    """
+    :param response: Of `download_tools`, only the ones with a body (200, 206) take a slot.
+    :param place_code: From the download URL, the client address is used without it.
+    :raise HTTPException: 429 or 503, see `DownloadScheduler.admit`.
+    """
+    if not local_settings.DOWNLOAD_SCHEDULER_ENABLED or response is None or response.status_code not in (200, 206):
+        return response
+    place_key = f'place:{place_code}' if place_code else f'address:{request.client.host if request.client else ""}'
+    return ScheduledResponse(response, download_scheduler.admit(place_key))
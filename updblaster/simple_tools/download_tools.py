@@ -0,0 +1,323 @@
+"""
+Conditional and partial responses for package downloading: ETag, If-None-Match, Range and If-Range.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import mimetypes
+import os
+import uuid
+from email.utils import formatdate
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from fastapi import status
+from fastapi.responses import Response, StreamingResponse
+
+from updblaster.simple_tools.file_engine import hot_file_cache, MappedFileResponse, SendfileResponse
+
+# Too many ranges in one request is a well-known way of abusing servers.
+MAX_RANGES = 16
+
+# (start, end), both inclusive, same as the `Content-Range` header.
+ByteRange = Tuple[int, int]
+# reader(start, end) yields the bytes between start and end, both inclusive.
+RangeReader = Callable[[int, int], Iterator[bytes]]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def make_etag(package_hash: str) -> str:
+    """Strong ETag, the stored sha256 identifies the content exactly."""
+    return f'"{package_hash}"'
+
+
+def make_stat_etag(stat_result: os.stat_result) -> str:
+    """Weak ETag for files without a stored hash, it never satisfies `If-Range`."""
+    return f'W/"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison, as required for `If-None-Match`."""
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def if_range_matches(if_range: str, etag: str, last_modified: str) -> bool:
+    """Strong comparison, a weak ETag never matches."""
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return not etag.startswith('W/') and if_range == etag
+    return if_range == last_modified
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[ByteRange]]:
+    """
+    :param range_header: e.g.: 'bytes=0-499', 'bytes=500-', 'bytes=-500', 'bytes=0-0,-1'
+    :param file_size:
+    :return: Sorted and merged ranges, or None when the header is invalid and should be ignored.
+    :raise RangeNotSatisfiable: None of the ranges overlaps the file.
+    """
+    unit, _, range_set = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not range_set:
+        return None
+
+    specs = range_set.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        # `int` would also take signs, spaces and underscores.
+        if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else None
+                if end is not None and end < start:
+                    return None
+                if start >= file_size:
+                    continue
+                if end is None:
+                    end = file_size - 1
+            else:
+                # Suffix range, the last N bytes.
+                suffix_length = int(last)
+                if suffix_length == 0 or file_size == 0:
+                    continue
+                start = max(0, file_size - suffix_length)
+                end = file_size - 1
+        except ValueError:
+            return None
+
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable(range_header)
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def read_file_range(file_path: str) -> RangeReader:
+    def reader(start: int, end: int) -> Iterator[bytes]:
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(local_settings.UPLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+    return reader
+
+
+def guess_media_type(file_name: str) -> str:
+    return mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+
+def not_modified_response(etag: str, extra_headers: Optional[dict] = None) -> Response:
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    headers.update(extra_headers or {})
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def range_not_satisfiable_response(file_size: int) -> Response:
+    return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    headers={'Content-Range': f'bytes */{file_size}', 'Accept-Ranges': 'bytes'})
+
+
+def partial_response(reader: RangeReader,
+                     file_size: int,
+                     ranges: List[ByteRange],
+                     file_name: str,
+                     headers: dict) -> StreamingResponse:
+    """
+    206 Partial Content, a single part for one range, otherwise multipart/byteranges.
+    """
+    media_type = guess_media_type(file_name)
+    headers = dict(headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(reader(start, end), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                                 media_type=media_type, headers=headers)
+
+    boundary = uuid.uuid4().hex
+    part_heads = [(f'\r\n--{boundary}\r\n'
+                   f'Content-Type: {media_type}\r\n'
+                   f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n').encode('latin-1')
+                  for start, end in ranges]
+    tail = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    headers['Content-Length'] = str(sum(len(head) for head in part_heads) + len(tail)
+                                    + sum(end - start + 1 for start, end in ranges))
+
+    def iter_parts() -> Iterator[bytes]:
+        for head, (start, end) in zip(part_heads, ranges):
+            yield head
+            yield from reader(start, end)
+        yield tail
+
+    return StreamingResponse(iter_parts(), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=f'multipart/byteranges; boundary={boundary}', headers=headers)
+
+
+def conditional_file_response(file_path: str,
+                              file_name: str,
+                              request_headers,
+                              package_hash: Optional[str] = None,
+                              extra_headers: Optional[dict] = None) -> Response:
+    """
+    Serve a file honoring If-None-Match, Range and If-Range.
+    With a stored `package_hash`, a matching If-None-Match is answered without touching the file.
+    :param extra_headers: e.g. `Cache-Control`, added to every response.
+    :return: 304, 206, 416 or a 200 response of `file_engine`. None if the file does not exist.
+    """
+    if_none_match = request_headers.get('if-none-match')
+    if package_hash:
+        etag = make_etag(package_hash)
+        if if_none_match and etag_matches(if_none_match, etag):
+            logger.debug(f'{file_name} not modified, ETag {etag}.')
+            return not_modified_response(etag, extra_headers)
+
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+    if not package_hash:
+        etag = make_stat_etag(stat_result)
+        if if_none_match and etag_matches(if_none_match, etag):
+            return not_modified_response(etag, extra_headers)
+
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {'ETag': etag, 'Last-Modified': last_modified, 'Accept-Ranges': 'bytes'}
+    headers.update(extra_headers or {})
+
+    # 频繁下载的小文件直接从内存映射中发送，其余的文件由`SendfileResponse`发送
+    mapping = hot_file_cache.get(file_path, stat_result)
+    reader = read_bytes_range(mapping) if mapping is not None else read_file_range(file_path)
+    resp = range_response_or_none(reader=reader, file_size=stat_result.st_size,
+                                  file_name=file_name, request_headers=request_headers, headers=headers)
+    if resp is not None:
+        return resp
+
+    if mapping is not None:
+        return MappedFileResponse(mapping=mapping, file_name=file_name, headers=headers,
+                                  media_type=guess_media_type(file_name))
+    return SendfileResponse(file_path=file_path, stat_result=stat_result, file_name=file_name, headers=headers,
+                            media_type=guess_media_type(file_name))
+
+
+def range_response_or_none(reader: RangeReader,
+                           file_size: int,
+                           file_name: str,
+                           request_headers,
+                           headers: dict) -> Optional[Response]:
+    """
+    :param headers: Must contain the `ETag` and `Last-Modified` (if any) used for If-Range.
+    :return: 206 or 416 if the request asks for ranges, otherwise None and the full content should be sent.
+    """
+    range_header = request_headers.get('range')
+    if_range = request_headers.get('if-range')
+    if not range_header:
+        return None
+    if if_range and not if_range_matches(if_range, headers['ETag'], headers.get('Last-Modified', '')):
+        return None
+
+    try:
+        ranges = parse_range_header(range_header, file_size)
+    except RangeNotSatisfiable:
+        logger.info(f'Range {range_header} not satisfiable for {file_name}.')
+        return range_not_satisfiable_response(file_size)
+
+    if not ranges:
+        return None
+
+    logger.debug(f'Partial download {file_name}: {ranges}.')
+    return partial_response(reader=reader, file_size=file_size, ranges=ranges, file_name=file_name, headers=headers)
+
+
+def read_bytes_range(data) -> RangeReader:
+    """
+    :param data: bytes, or any buffer such as a `mmap`.
+    """
+    view = memoryview(data)
+
+    def reader(start: int, end: int) -> Iterator[bytes]:
+        yield bytes(view[start:end + 1])
+    return reader
+
+
+def conditional_bytes_response(data: bytes,
+                               file_name: str,
+                               request_headers,
+                               data_hash: str,
+                               extra_headers: Optional[dict] = None) -> Response:
+    """
+    Same as `conditional_file_response`, for content kept in memory, e.g. the cached manifests.
+    """
+    etag = make_etag(data_hash)
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match and etag_matches(if_none_match, etag):
+        return not_modified_response(etag, extra_headers)
+
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    headers.update(extra_headers or {})
+
+    resp = range_response_or_none(reader=read_bytes_range(data), file_size=len(data), file_name=file_name,
+                                  request_headers=request_headers, headers=headers)
+    if resp is not None:
+        return resp
+
+    headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return Response(content=data, media_type=guess_media_type(file_name), headers=headers)
+
+
+def conditional_reader_response(reader: RangeReader,
+                                file_size: int,
+                                file_name: str,
+                                request_headers,
+                                data_hash: str,
+                                extra_headers: Optional[dict] = None) -> Response:
+    """
+    Same as `conditional_file_response`, for content streamed by a reader, e.g. a package rebuilt from chunks.
+    """
+    etag = make_etag(data_hash)
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match and etag_matches(if_none_match, etag):
+        return not_modified_response(etag, extra_headers)
+
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    headers.update(extra_headers or {})
+
+    resp = range_response_or_none(reader=reader, file_size=file_size, file_name=file_name,
+                                  request_headers=request_headers, headers=headers)
+    if resp is not None:
+        return resp
+
+    headers['Content-Length'] = str(file_size)
+    headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return StreamingResponse(reader(0, file_size - 1) if file_size else iter(()),
+                             media_type=guess_media_type(file_name), headers=headers)
@@ -0,0 +1,190 @@
+"""
+In-memory eligibility index: which packages could be updated to which places.
+
+The index is loaded once from the `package_place_rules` and `package_rollouts` tables, and then updated only
+when a package is created, published, rolled out or removed, so the `/updblaster/` hot path answers eligibility
+with a dict and a set lookup.
+The other workers reload the whole index on their next use, see `coherence.py`.
+"""
+from updblaster.logger import logger
+from updblaster.simple_tools.coherence import shared_generations
+
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from updblaster.simple_tools.rollout import RolloutState
+
+
+def parse_places(places_str: Optional[str]) -> FrozenSet[int]:
+    """
+    :param places_str: e.g.: '1,2,3', '' or None
+    :return: e.g.: frozenset({1, 2, 3})
+    """
+    place_ids = set()
+    if not places_str:
+        return frozenset(place_ids)
+
+    for place_id in places_str.split(','):
+        place_id = place_id.strip()
+        if place_id.isdigit():
+            place_ids.add(int(place_id))
+        elif place_id:
+            logger.warning(f'Ignored invalid place id {place_id!r} in {places_str!r}.')
+    return frozenset(place_ids)
+
+
+def compile_package_rules(valid_places: Optional[str], invalid_places: Optional[str]) -> Tuple[FrozenSet[int],
+                                                                                              FrozenSet[int]]:
+    """
+    :return: (allow set, deny set)
+    """
+    return parse_places(valid_places), parse_places(invalid_places)
+
+
+class EligibilityIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        # package id -> (allow set, deny set)
+        self._rules: Dict[int, Tuple[FrozenSet[int], FrozenSet[int]]] = {}
+        # place id -> enabled package ids
+        self._place_packages: Dict[int, Set[int]] = {}
+        # package id -> `rollout.RolloutState`, only the packages being rolled out
+        self._rollouts: Dict[int, 'RolloutState'] = {}
+        # Bumped by every update and invalidation, even while not loaded, a load started before it is stale.
+        self._generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def ensure_loaded(self, loader: Callable[[], Iterable[Tuple[int, int, bool]]],
+                      rollout_loader: Callable[[], Iterable[Tuple[int, 'RolloutState']]] = tuple,
+                      generation: Optional[int] = None) -> bool:
+        """
+        :param loader: Returns all (package_id, place_id, allowed) rules,
+                       only called on the first use or after `invalidate`.
+        :param rollout_loader: Returns (package_id, rollout state) of the packages being rolled out, the same.
+        :param generation: `generation` taken before querying the rules, the load is discarded if it changed.
+        :return: False if the load was discarded, the rules must be queried again.
+        """
+        if self._loaded:
+            return True
+        with self._lock:
+            if self._loaded:
+                return True
+            if generation is not None and generation != self._generation:
+                logger.info(f'Eligibility index load discarded, the rules changed while querying them.')
+                return False
+            self._rules.clear()
+            self._place_packages.clear()
+            self._rollouts = dict(rollout_loader())
+            allows: Dict[int, Set[int]] = {}
+            denies: Dict[int, Set[int]] = {}
+            for package_id, place_id, allowed in loader():
+                (allows if allowed else denies).setdefault(package_id, set()).add(place_id)
+            for package_id in allows.keys() | denies.keys():
+                self._set_rules(package_id,
+                                allow=frozenset(allows.get(package_id, ())),
+                                deny=frozenset(denies.get(package_id, ())))
+            self._loaded = True
+        logger.info(f'Eligibility index loaded with {len(self._rules)} packages.')
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+            self._rules.clear()
+            self._place_packages.clear()
+            self._rollouts.clear()
+
+    def _set_rules(self, package_id: int, allow: FrozenSet[int], deny: FrozenSet[int]):
+        self._rules[package_id] = (allow, deny)
+        for place_id in allow - deny:
+            self._place_packages.setdefault(place_id, set()).add(package_id)
+
+    def _set_rollout(self, package_id: int, rollout: Optional['RolloutState']):
+        if rollout is None or rollout.completed:
+            self._rollouts.pop(package_id, None)
+        else:
+            self._rollouts[package_id] = rollout
+
+    def _discard_package(self, package_id: int):
+        rules = self._rules.pop(package_id, None)
+        if not rules:
+            return
+        allow, deny = rules
+        for place_id in allow - deny:
+            package_ids = self._place_packages.get(place_id)
+            if package_ids is not None:
+                package_ids.discard(package_id)
+                if not package_ids:
+                    del self._place_packages[place_id]
+
+    def update_package(self, package, rollout: Optional['RolloutState'] = None):
+        """
+        After a package is created or published, its rules and rollout are replaced together.
+        :param rollout: None when the package is not being rolled out.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._loaded:
+                self._discard_package(package.id)
+                self._set_rules(package.id, *compile_package_rules(package.valid_places, package.invalid_places))
+                self._set_rollout(package.id, rollout)
+        shared_generations.publish('eligibility')
+        logger.debug(f'Eligibility index updated package {package.id}.')
+
+    def remove_package(self, package_id: int):
+        with self._lock:
+            self._generation += 1
+            if self._loaded:
+                self._discard_package(package_id)
+                self._rollouts.pop(package_id, None)
+        shared_generations.publish('eligibility')
+        logger.debug(f'Eligibility index removed package {package_id}.')
+
+    def update_rollout(self, package_id: int, rollout: Optional['RolloutState']):
+        """
+        :param rollout: None when the package is no longer being rolled out.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._loaded:
+                self._set_rollout(package_id, rollout)
+        shared_generations.publish('eligibility')
+        logger.debug(f'Eligibility index updated the rollout of package {package_id}.')
+
+    def remove_place(self, place_id: int):
+        with self._lock:
+            self._generation += 1
+            if self._loaded:
+                self._place_packages.pop(place_id, None)
+                for package_id, (allow, deny) in self._rules.items():
+                    if place_id in allow or place_id in deny:
+                        self._rules[package_id] = (allow - {place_id}, deny - {place_id})
+        shared_generations.publish('eligibility')
+        logger.debug(f'Eligibility index removed place {place_id}.')
+
+    def is_enabled(self, package_id: int, place_id: int, place_code: str) -> bool:
+        if package_id not in self._place_packages.get(place_id, ()):
+            return False
+        rollout = self._rollouts.get(package_id)
+        return rollout is None or rollout.reaches(place_id, place_code)
+
+    def enabled_packages(self, place_id: int) -> FrozenSet[int]:
+        """By the allow/deny rules only, before the rollouts."""
+        return frozenset(self._place_packages.get(place_id, ()))
+
+    def package_rules(self, package_id: int) -> Optional[Tuple[FrozenSet[int], FrozenSet[int]]]:
+        return self._rules.get(package_id)
+
+
+eligibility_index = EligibilityIndex()
+shared_generations.register('eligibility', eligibility_index.invalidate)
@@ -0,0 +1,210 @@
+"""
+Download engine: how the bytes of a file get to the socket, once `download_tools` decided what to send.
+
+- Small files requested again and again (patches, chunks, legacy manifests) are memory mapped and kept
+  in a bounded LRU cache, see `HotFileCache`. A cached file is served without opening or reading it,
+  and the mapping shares the page cache with the other workers. Every request `stat`s the file,
+  a file replaced or removed on disk is dropped from the cache.
+- Other files are sent with `SendfileResponse`:
+    - with nginx in front and `X_ACCEL_REDIRECT_LOCATION` set, nginx sends the file itself (sendfile);
+    - with an ASGI server offering the `http.response.zerocopysend` extension, the server calls `os.sendfile`;
+    - otherwise the file is read with `os.pread` in large chunks in the threadpool.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi.responses import Response
+
+ZEROCOPY_EXTENSION = 'http.response.zerocopysend'
+# How many not yet admitted files have their requests counted, see `HOT_FILE_ADMIT_HITS`.
+MAX_COUNTED_FILES = 16384
+
+
+def stat_key(stat_result: os.stat_result) -> Tuple[int, int, int, int]:
+    return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+class HotFileCache:
+    def __init__(self,
+                 max_bytes: int = local_settings.HOT_FILE_CACHE_BYTES,
+                 max_file_size: int = local_settings.HOT_FILE_MAX_SIZE,
+                 admit_hits: int = local_settings.HOT_FILE_ADMIT_HITS):
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._max_file_size = max_file_size
+        self._admit_hits = admit_hits
+        # file path -> (stat key, mapping)
+        self._entries: 'OrderedDict[str, Tuple[tuple, mmap.mmap]]' = OrderedDict()
+        self._bytes = 0
+        # file path -> requests not served from the cache yet, bounded as well.
+        self._requests: 'OrderedDict[str, int]' = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def _drop(self, file_path: str):
+        _, mapping = self._entries.pop(file_path)
+        self._bytes -= len(mapping)
+        # Not closed here, a response may still be sending from it, the mapping is released with its last reference.
+
+    def get(self, file_path: str, stat_result: os.stat_result) -> Optional[mmap.mmap]:
+        """
+        :param stat_result: Of `file_path`, taken by the caller for this request.
+        :return: The whole file mapped, None if it is not (yet) worth caching.
+        """
+        key = stat_key(stat_result)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None:
+                if entry[0] == key:
+                    self._entries.move_to_end(file_path)
+                    self._hits += 1
+                    return entry[1]
+                self._drop(file_path)
+                logger.debug(f'Hot file {file_path} changed on disk, dropped.')
+            self._misses += 1
+
+            if not 0 < stat_result.st_size <= self._max_file_size:
+                return None
+            requests = self._requests.pop(file_path, 0) + 1
+            if requests < self._admit_hits:
+                self._requests[file_path] = requests
+                while len(self._requests) > MAX_COUNTED_FILES:
+                    self._requests.popitem(last=False)
+                return None
+
+        mapping = self._map(file_path, key)
+        if mapping is None:
+            return None
+        with self._lock:
+            if file_path in self._entries:
+                self._drop(file_path)
+            self._entries[file_path] = (key, mapping)
+            self._bytes += len(mapping)
+            while self._bytes > self._max_bytes and len(self._entries) > 1:
+                evicted_path = next(iter(self._entries))
+                self._drop(evicted_path)
+                logger.debug(f'Hot file cache evicted {evicted_path}.')
+        return mapping
+
+    @staticmethod
+    def _map(file_path: str, key: tuple) -> Optional[mmap.mmap]:
+        try:
+            with open(file_path, 'rb') as f:
+                # The file may have been replaced since the caller's `stat`.
+                if stat_key(os.fstat(f.fileno())) != key:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Map hot file {file_path} failed, detail: {e}.')
+            return None
+
+    def invalidate(self):
+        with self._lock:
+            for file_path in list(self._entries):
+                self._drop(file_path)
+            self._requests.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries), 'bytes': self._bytes}
+
+
+hot_file_cache = HotFileCache()
+
+
+def content_disposition(file_name: str) -> str:
+    quoted = quote(file_name)
+    if quoted != file_name:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{file_name}"'
+
+
+class MappedFileResponse(Response):
+    """
+    200 with the whole content of a `HotFileCache` mapping, sent by slices without copying.
+    """
+    def __init__(self, mapping: mmap.mmap, file_name: str, headers: Dict[str, str], media_type: str):
+        self.mapping = mapping
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        headers = dict(headers, **{'Content-Length': str(len(mapping)),
+                                   'Content-Disposition': content_disposition(file_name)})
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        view = memoryview(self.mapping)
+        chunk_size = local_settings.FILE_SEND_CHUNK_SIZE
+        for offset in range(0, len(view), chunk_size):
+            await send({'type': 'http.response.body',
+                        'body': view[offset:offset + chunk_size],
+                        'more_body': offset + chunk_size < len(view)})
+
+
+class SendfileResponse(Response):
+    """
+    200 with the whole content of a file, see the module docstring for how it is sent.
+    """
+    def __init__(self, file_path: str, stat_result: os.stat_result, file_name: str, headers: Dict[str, str],
+                 media_type: str):
+        self.file_path = file_path
+        self.file_size = stat_result.st_size
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        headers = dict(headers, **{'Content-Disposition': content_disposition(file_name)})
+        accel_path = self.accel_redirect_path(file_path)
+        if accel_path:
+            # nginx takes the length and the body from the internal location.
+            headers['X-Accel-Redirect'] = accel_path
+            self.file_size = 0
+        else:
+            headers['Content-Length'] = str(self.file_size)
+        self.init_headers(headers)
+
+    @staticmethod
+    def accel_redirect_path(file_path: str) -> Optional[str]:
+        location = local_settings.X_ACCEL_REDIRECT_LOCATION
+        if not location:
+            return None
+        relative_path = os.path.relpath(file_path, local_settings.PACKAGES_FOLDER)
+        if relative_path.startswith('..'):
+            return None
+        return f'{location.rstrip("/")}/{quote(relative_path)}'
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if not self.file_size:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        file = await anyio.to_thread.run_sync(open, self.file_path, 'rb')
+        try:
+            if ZEROCOPY_EXTENSION in scope.get('extensions', {}):
+                await send({'type': ZEROCOPY_EXTENSION, 'file': file, 'count': self.file_size, 'more_body': False})
+                return
+
+            fd = file.fileno()
+            chunk_size = local_settings.FILE_SEND_CHUNK_SIZE
+            offset = 0
+            while offset < self.file_size:
+                data = await anyio.to_thread.run_sync(os.pread, fd, min(chunk_size, self.file_size - offset), offset)
+                if not data:
+                    # Truncated while sending, the client sees a short body and retries with Range.
+                    logger.warning(f'{self.file_path} truncated at {offset} while sending.')
+                    break
+                offset += len(data)
+                await send({'type': 'http.response.body', 'body': data, 'more_body': offset < self.file_size})
+            if offset < self.file_size:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            file.close()
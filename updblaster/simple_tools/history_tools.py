@@ -0,0 +1,204 @@
+"""
+Write-behind accounting of the downloads and polls into the `history` table, one row per (package, version, place).
+
+- Recording an event only increments counters in memory, aggregated per (package, version, place), nothing is
+  written per request. `HistoryBuffer.flush` writes all of them in one transaction every
+  `HISTORY_FLUSH_INTERVAL_SECONDS`, and once more on shutdown.
+- Downloads addressed by hash (`/packages/downloads/<package_hash>/...`, patches) are recorded with the hash,
+  which is resolved to (package, version) when flushed.
+- The buffer is bounded to `HISTORY_BUFFER_MAX_KEYS` keys, the events of new keys are dropped while it is full.
+- A download counts once: a 200, or a 206 starting at byte 0. Downloads without `place_code` are recorded for
+  the place '', it is left out of the place counts.
+- The packagelist itself is recorded as a package, with the packagelist version.
+
+Buffers are per worker, every worker flushes its own, `crud.upsert_history_counts` adds them up in the database.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# (package_name, package_version, package_hash, place_code), name and version are None when only the hash is known.
+BufferKey = Tuple[Optional[str], Optional[str], Optional[str], str]
+# (package_name, package_version, place_code)
+HistoryKey = Tuple[str, str, str]
+
+
+class HistoryCounts:
+    __slots__ = ('downloads', 'polls', 'last_download', 'last_poll')
+
+    def __init__(self):
+        self.downloads = 0
+        self.polls = 0
+        self.last_download: Optional[float] = None  # time.time()
+        self.last_poll: Optional[float] = None
+
+    def add(self, download: bool, now: float):
+        if download:
+            self.downloads += 1
+            self.last_download = now
+        else:
+            self.polls += 1
+            self.last_poll = now
+
+    def merge(self, other: 'HistoryCounts'):
+        self.downloads += other.downloads
+        self.polls += other.polls
+        self.last_download = max(filter(None, (self.last_download, other.last_download)), default=None)
+        self.last_poll = max(filter(None, (self.last_poll, other.last_poll)), default=None)
+
+
+def counts_as_download(status_code: int, range_header: Optional[str]) -> bool:
+    """
+    Resumed and parallel ranged downloads count once, by their first range.
+    """
+    if status_code == 200:
+        return True
+    return status_code == 206 and (range_header or '').replace(' ', '').lower().startswith('bytes=0-')
+
+
+def to_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+
+class HistoryBuffer:
+    def __init__(self, max_keys: int = local_settings.HISTORY_BUFFER_MAX_KEYS):
+        self._lock = threading.Lock()
+        # Only one flush at a time, the periodic one and the one on shutdown may overlap.
+        self._flush_lock = threading.Lock()
+        self._max_keys = max_keys
+        self._counts: Dict[BufferKey, HistoryCounts] = {}
+        self._stats = {'recorded': 0, 'dropped': 0, 'flushes': 0, 'failed_flushes': 0, 'flushed_rows': 0}
+
+    def _record(self, key: BufferKey, download: bool):
+        if not local_settings.HISTORY_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                if len(self._counts) >= self._max_keys:
+                    self._stats['dropped'] += 1
+                    return
+                counts = self._counts[key] = HistoryCounts()
+            counts.add(download=download, now=now)
+            self._stats['recorded'] += 1
+
+    def record_download(self, place_code: Optional[str], package_name: Optional[str] = None,
+                        package_version: Optional[str] = None, package_hash: Optional[str] = None):
+        """
+        :param package_hash: Instead of `package_name` and `package_version`, resolved when flushed.
+        """
+        if package_name is None:
+            self._record((None, None, package_hash, place_code or ''), download=True)
+        else:
+            self._record((package_name, package_version, None, place_code or ''), download=True)
+
+    def record_poll(self, place_code: str, package_name: str, package_version: str):
+        self._record((package_name, package_version, None, place_code), download=False)
+
+    def _restore(self, counts: Dict[BufferKey, HistoryCounts]):
+        with self._lock:
+            for key, item in counts.items():
+                if key in self._counts:
+                    self._counts[key].merge(item)
+                elif len(self._counts) < self._max_keys:
+                    self._counts[key] = item
+                else:
+                    self._stats['dropped'] += item.downloads + item.polls
+
+    def flush(self, writer: Callable[[Dict[BufferKey, HistoryCounts]], int]) -> int:
+        """
+        :param writer: Writes the taken counters, returns the number of rows written.
+                       When it raises, the counters are put back for the next flush.
+        :return: Number of rows written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, {}
+            if not counts:
+                return 0
+            try:
+                rows = writer(counts)
+            except Exception as e:
+                self._restore(counts)
+                with self._lock:
+                    self._stats['failed_flushes'] += 1
+                logger.error(f'Flush download history failed, {len(counts)} keys kept, detail: {e}.')
+                return 0
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['flushed_rows'] += rows
+            logger.debug(f'Flushed download history, {len(counts)} keys into {rows} rows.')
+            return rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, buffered=len(self._counts))
+
+
+history_buffer = HistoryBuffer()
+
+
+def resolve_keys(counts: Dict[BufferKey, HistoryCounts],
+                 versions: Dict[str, Tuple[str, str]]) -> Dict[HistoryKey, HistoryCounts]:
+    """
+    :param versions: package hash -> (package_name, package_version), the hashes not found are dropped.
+    """
+    resolved: Dict[HistoryKey, HistoryCounts] = {}
+    for (package_name, package_version, package_hash, place_code), item in counts.items():
+        if package_name is None:
+            if package_hash not in versions:
+                logger.debug(f'Download history of unknown hash {package_hash} dropped.')
+                continue
+            package_name, package_version = versions[package_hash]
+        key = (package_name, package_version, place_code)
+        if key in resolved:
+            resolved[key].merge(item)
+        else:
+            resolved[key] = item
+    return resolved
+
+
+def version_sort_key(package_version: str):
+    # 版本约定为自然数，倒序排列时其余的排在之后
+    return (1, int(package_version), '') if package_version.isdigit() else (0, 0, package_version)
+
+
+def adoption_rollups(histories: Iterable) -> List[dict]:
+    """
+    :param histories: `History` rows of one package.
+    :return: Per version, newest first:
+        - places: places which downloaded or polled the version
+        - current_places: places whose latest download or poll is of the version
+    """
+    versions: Dict[str, dict] = {}
+    places: Dict[str, set] = {}  # version -> place codes
+    latest: Dict[str, Tuple[datetime, str]] = {}  # place code -> (last seen, version)
+    for db_history in histories:
+        rollup = versions.setdefault(db_history.package_version, {'package_version': db_history.package_version,
+                                                                   'places': 0,
+                                                                   'current_places': 0,
+                                                                   'download_count': 0,
+                                                                   'poll_count': 0,
+                                                                   'last_download': None})
+        rollup['download_count'] += int(db_history.download_count or 0)
+        rollup['poll_count'] += db_history.poll_count or 0
+        if db_history.last_download and (rollup['last_download'] is None
+                                         or db_history.last_download > rollup['last_download']):
+            rollup['last_download'] = db_history.last_download
+        if not db_history.place_code:
+            continue
+        places.setdefault(db_history.package_version, set()).add(db_history.place_code)
+        seen = max(filter(None, (db_history.last_download, db_history.last_poll)), default=None)
+        if seen and (db_history.place_code not in latest or seen > latest[db_history.place_code][0]):
+            latest[db_history.place_code] = (seen, db_history.package_version)
+
+    for package_version, place_codes in places.items():
+        versions[package_version]['places'] = len(place_codes)
+    for _, package_version in latest.values():
+        versions[package_version]['current_places'] += 1
+    return sorted(versions.values(), key=lambda rollup: version_sort_key(rollup['package_version']), reverse=True)
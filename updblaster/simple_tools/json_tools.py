@@ -0,0 +1,48 @@
+"""
+JSON encoding for the client responses.
+
+The client payloads only change when a package is published, so they are encoded once and served as raw bytes,
+see `RawJSONResponse`. `orjson` is used when installed (`pip install orjson`), otherwise the standard library,
+both give the same bytes as `JSONResponse`. Compressed variants are served by `encoded_json_response`.
+"""
+import json
+from typing import Mapping
+
+from fastapi.responses import Response
+
+from updblaster.simple_tools.compress_tools import EncodedBody, negotiate
+
+try:
+    import orjson
+except ImportError:  # Optional
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    """
+    Compact UTF-8 JSON, as rendered by `JSONResponse`.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+class RawJSONResponse(Response):
+    """
+    Serves already encoded JSON bytes, see `dumps`.
+    """
+    media_type = 'application/json'
+
+
+def encoded_json_response(encoded: EncodedBody, request_headers: Mapping[str, str]) -> RawJSONResponse:
+    """
+    :param encoded: See `compress_tools.encode_variants`.
+    :param request_headers: The variant is picked by `Accept-Encoding`.
+    """
+    body, content_encoding = negotiate(encoded, request_headers.get('accept-encoding'))
+    headers = {}
+    if encoded.variants:
+        headers['Vary'] = 'Accept-Encoding'
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    return RawJSONResponse(content=body, headers=headers)
@@ -0,0 +1,132 @@
+"""
+In-process read-through cache of the lookups on the client hot path:
+place by `place_code`, package by `package_name`, patches of a package and the latest packagelist,
+plus the encoded client payloads derived from packages and patches.
+
+These tables only change through the admin endpoints, whose crud functions invalidate the namespace they wrote,
+the other workers drop the same namespace on their next request, see `coherence.py`.
+Entries also expire after `LOOKUP_CACHE_TTL_SECONDS`, and the number of entries is bounded.
+Cached values are pydantic snapshots (or None for "not found"), never ORM instances bound to a session.
+Concurrent misses of the same key share one load, see `single_flight.py`.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+from updblaster.simple_tools.coherence import shared_generations
+from updblaster.simple_tools.single_flight import AsyncSingleFlight
+
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+PLACES = 'places'
+PACKAGES = 'packages'
+PATCHES = 'patches'
+PACKAGELISTS = 'packagelists'
+PAYLOADS = 'payloads'
+NAMESPACES = (PLACES, PACKAGES, PATCHES, PACKAGELISTS, PAYLOADS)
+# Namespaces built from other namespaces, invalidated together with them.
+DERIVED = {PACKAGES: (PAYLOADS,), PATCHES: (PAYLOADS,)}
+# Namespaces written by the crud functions, each has a slot in `coherence.SLOTS`.
+SOURCE_NAMESPACES = (PLACES, PACKAGES, PATCHES, PACKAGELISTS)
+
+MISSING = object()
+
+
+class LookupCache:
+    def __init__(self,
+                 max_size: int = local_settings.LOOKUP_CACHE_SIZE,
+                 ttl: float = local_settings.LOOKUP_CACHE_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._ttl = ttl
+        # (namespace, key) -> (expires at, value)
+        self._entries: 'OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]' = OrderedDict()
+        # Bumped by every invalidation, a load started before it must not be cached.
+        self._generations: Dict[str, int] = {namespace: 0 for namespace in NAMESPACES}
+        self._counters: Dict[str, Dict[str, int]] = {namespace: {'hits': 0, 'misses': 0, 'invalidations': 0}
+                                                     for namespace in NAMESPACES}
+        self._loads = AsyncSingleFlight()
+
+    def get(self, namespace: str, key: Hashable) -> Any:
+        """
+        :return: The cached value, `MISSING` if not cached or expired.
+        """
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end((namespace, key))
+                self._counters[namespace]['hits'] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[(namespace, key)]
+            self._counters[namespace]['misses'] += 1
+            return MISSING
+
+    def generation(self, namespace: str) -> int:
+        return self._generations[namespace]
+
+    def put(self, namespace: str, key: Hashable, value: Any, generation: int):
+        """
+        :param generation: `generation(namespace)` taken before loading the value.
+        """
+        with self._lock:
+            if self._generations[namespace] != generation:
+                return
+            self._entries[(namespace, key)] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    async def get_or_load(self, namespace: str, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(namespace, key)
+        if value is not MISSING:
+            return value
+        generation = self.generation(namespace)
+
+        async def load():
+            loaded = await loader()
+            self.put(namespace, key, loaded, generation)
+            return loaded
+        # A load started before an invalidation is not shared with the requests coming after it.
+        return await self._loads.do((namespace, key, generation), load)
+
+    async def shared(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Share a load putting several entries at once, e.g. a join query.
+        :param key: Must include the generations taken before loading.
+        """
+        return await self._loads.do(key, loader)
+
+    def invalidate(self, *namespaces: str, publish: bool = True):
+        """
+        :param namespaces: Empty to invalidate everything.
+        :param publish: Also make the other workers invalidate them.
+        """
+        published = namespaces or SOURCE_NAMESPACES
+        namespaces = tuple(dict.fromkeys(
+            published + tuple(derived for namespace in published for derived in DERIVED.get(namespace, ()))))
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] += 1
+                self._counters[namespace]['invalidations'] += 1
+            for namespace, key in [entry_key for entry_key in self._entries if entry_key[0] in namespaces]:
+                del self._entries[(namespace, key)]
+        if publish:
+            shared_generations.publish(*published)
+        logger.debug(f'Lookup cache invalidated {namespaces}.')
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = {namespace: 0 for namespace in NAMESPACES}
+            for namespace, _ in self._entries:
+                sizes[namespace] += 1
+            stats = {namespace: dict(self._counters[namespace], size=sizes[namespace]) for namespace in NAMESPACES}
+        stats['loads'] = self._loads.stats()
+        return stats
+
+
+lookup_cache = LookupCache()
+for _namespace in SOURCE_NAMESPACES:
+    shared_generations.register(_namespace, partial(lookup_cache.invalidate, _namespace, publish=False))
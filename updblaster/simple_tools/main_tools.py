@@ -1,12 +1,21 @@
 from updblaster import schemas
 from updblaster.logger import logger
 from updblaster import local_settings
+from updblaster.simple_tools.eligibility import compile_package_rules
+from updblaster.simple_tools.rollout import rollout_reaches
 
 import hashlib
+import io
 import json
 import os
+import shutil
+import tempfile
+import time
 import zipfile
-from typing import List
+from typing import AsyncIterator, List, Optional, Set, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
 
 
 def get_package_hash(file_path: str) -> str:
@@ -17,7 +26,7 @@ def get_package_hash(file_path: str) -> str:
     sha256 = hashlib.sha256()
     with open(file_path, 'rb') as f:
         while True:
-            data = f.read(1024)
+            data = f.read(local_settings.UPLOAD_CHUNK_SIZE)
             if not data:
                 break
             sha256.update(data)
@@ -26,37 +35,83 @@ def get_package_hash(file_path: str) -> str:
     return sha256.hexdigest()
 
 
-def check_update_enabled(package: schemas.Package, place: schemas.Place) -> bool:
+async def save_stream_to_temp(stream: AsyncIterator[bytes], folder: str) -> Tuple[str, int, str]:
     """
-    Check out whether this package could be updated to the place.
-    :param package:
-    :param place:
-    :return: Boolean
+    Stream the data into a temp file under `folder`, hashing and counting while writing.
+    Only one chunk is held in memory at a time, and the file is never read back for the hash.
+    :param stream: e.g. `request.stream()`, the raw request body is then written to disk only once.
+    :param folder: Should be the same file system with the final path, so that `os.replace` is atomic.
+    :return: (temp file path, package length, package hash by hexdigest)
+    """
+    sha256 = hashlib.sha256()
+    package_length = 0
+    fd, temp_path = tempfile.mkstemp(prefix=local_settings.UPLOAD_TEMP_PREFIX, dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for data in stream:
+                if not data:
+                    continue
+                sha256.update(data)
+                package_length += len(data)
+                await run_in_threadpool(f.write, data)
+    except BaseException:
+        discard_temp_file(temp_path)
+        raise
+
+    return temp_path, package_length, sha256.hexdigest()
+
+
+async def save_upload_file_to_temp(upload_file: UploadFile, folder: str) -> Tuple[str, int, str]:
+    """
+    The same as `save_stream_to_temp`, for a multipart upload.
+    Starlette has spooled the multipart file already (to disk when larger than 1 MiB) before the route runs,
+    so the data is written twice, the raw body routes (`POST /packages/raw/`, upload sessions) avoid that.
+    :param upload_file:
+    :param folder: Should be the same file system with the final path, so that `os.replace` is atomic.
+    :return: (temp file path, package length, package hash by hexdigest)
+    """
+    async def read_chunks():
+        while True:
+            data = await upload_file.read(local_settings.UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    return await save_stream_to_temp(read_chunks(), folder=folder)
+
+
+def publish_temp_file(temp_path: str, file_path: str):
+    """
+    Atomically move the temp file into place, downloaders will never see a half written package.
     """
-    vp_str: str = package.valid_places  # e.g.: '1,2,3'
-    if not vp_str:
-        logger.debug(f'Valid places are: {vp_str}')
-        valid_list = []  # e.g.: ['1', '2', '3'] or None
-    else:
-        valid_list = vp_str.split(',')  # e.g.: ['1', '2', '3']
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.replace(temp_path, file_path)
+    logger.debug(f'Published {temp_path} to {file_path}.')
 
-    invp_str: str = package.invalid_places  # e.g.: '2,3'
-    # package.invalid_places是可选参数，数据库中是可以为NULL的
-    if not invp_str:
-        logger.debug(f'Invalid places are: {invp_str}')
-        invalid_list = []  # e.g.: ['3', '4'] or None
-    else:
-        invalid_list = invp_str.split(',')  # e.g.: ['3', '4']
 
-    # set去重，并取在白名单(valid_list)中但不在黑名单(invalid_list)中的值
-    enabled_places = list(set(valid_list).difference(set(invalid_list)))  # e.g.: ['1', '2']
-    logger.debug(f'Enabled places are: {enabled_places}.')
+def discard_temp_file(temp_path: str):
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f'Remove temp file {temp_path} failed. Error message: {e}')
 
-    if str(place.id) in enabled_places:
-        return True
 
-    else:
-        return False
+def check_update_enabled(package: schemas.Package, place: schemas.Place,
+                         rollout: Optional[schemas.PackageRollout] = None) -> bool:
+    """
+    Check out whether this package could be updated to the place.
+    The `/updblaster/` hot path uses `eligibility.eligibility_index` instead, which parses only on changes.
+    :param package:
+    :param place:
+    :param rollout: The rollout of the package if it is being rolled out, see `rollout.py`.
+    :return: Boolean
+    """
+    # 取在白名单(valid_places)中但不在黑名单(invalid_places)中的值，分批发布中还须已开放到该place
+    allow, deny = compile_package_rules(package.valid_places, package.invalid_places)
+    return place.id in allow and place.id not in deny and rollout_reaches(rollout, place_id=place.id,
+                                                                         place_code=place.place_code)
 
 
 def assemble_package_dict(pname: str,
@@ -66,7 +121,8 @@ def assemble_package_dict(pname: str,
                           pdownurl: str,
                           pcmd: str,
                           pdel: str,
-                          ppath: str) -> dict:
+                          ppath: str,
+                          ppatches: Optional[List[dict]] = None) -> dict:
     resp_dict = {"package_name": pname,
                  "package_version": pversion,
                  "package_length": plength,
@@ -75,9 +131,80 @@ def assemble_package_dict(pname: str,
                  "package_path": ppath,
                  "package_run_cmd": pcmd,
                  "package_del_cmd": pdel}
+    if ppatches:
+        # 旧版本的客户端可以只下载补丁，见`delta_tools.py`
+        resp_dict["package_patches"] = ppatches
     return resp_dict
 
 
+def assemble_patch_dict(from_version: str, from_hash: str, patch_name: str, plength: str, phash: str) -> dict:
+    return {"from_version": from_version,
+            "from_hash": from_hash,
+            "patch_down_url": f'{local_settings.BASE_URL}/packages/downloads/patches/{patch_name}',
+            "patch_length": plength,
+            "patch_hash": phash}
+
+
+def package_file_name(package_down_url: str) -> str:
+    """
+    e.g.: http://127.0.0.1:21080/packages/downloads/<package_hash>/happymj.zip -> happymj.zip
+    """
+    return package_down_url.rsplit('/', 1)[-1]
+
+
+def is_sha256_hex(value: str) -> bool:
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def package_object_path(package_hash: str, file_name: str) -> str:
+    """
+    每个版本的包文件按package_hash保存在各自的目录中，新版本不会覆盖正在被下载的旧版本
+    e.g.: <PACKAGES_FOLDER>/objects/<package_hash>/happymj.zip
+    """
+    return f'{local_settings.OBJECTS_FOLDER}/{package_hash}/{file_name}'
+
+
+def package_object_down_url(package_hash: str, file_name: str) -> str:
+    """
+    e.g.: http://127.0.0.1:21080/packages/downloads/<package_hash>/happymj.zip
+    """
+    return f'{local_settings.BASE_URL}/packages/downloads/{package_hash}/{file_name}'
+
+
+def package_file_path(package_down_url: str, package_hash: str) -> str:
+    """
+    The package file of a package row, either hash-addressed or at the legacy `PACKAGES_FOLDER/<file_name>`.
+    """
+    file_name = package_file_name(package_down_url)
+    if package_down_url == package_object_down_url(package_hash, file_name):
+        return package_object_path(package_hash, file_name)
+    return f'{local_settings.PACKAGES_FOLDER}/{file_name}'
+
+
+def remove_unreferenced_objects(keep_package_hashes: Set[str]) -> int:
+    """
+    Remove package files whose hash is not in `keep_package_hashes`,
+    unless younger than `STORAGE_GC_GRACE_SECONDS`.
+    :return: Removed package files.
+    """
+    if not os.path.isdir(local_settings.OBJECTS_FOLDER):
+        return 0
+
+    removed = 0
+    deadline = time.time() - local_settings.STORAGE_GC_GRACE_SECONDS
+    for package_hash in os.listdir(local_settings.OBJECTS_FOLDER):
+        folder = f'{local_settings.OBJECTS_FOLDER}/{package_hash}'
+        try:
+            if package_hash in keep_package_hashes or os.path.getmtime(folder) >= deadline:
+                continue
+            removed += len(os.listdir(folder))
+            shutil.rmtree(folder)
+        except OSError as e:
+            logger.error(f'Remove package files in {folder} failed, detail: {e}.')
+    logger.info(f'Removed {removed} unreferenced package files.')
+    return removed
+
+
 def assemble_newpackagelist_dict(newpackagelist: schemas.PackagesList,
                                  packages: List[schemas.Package]) -> dict:
     data_list = []
@@ -104,31 +231,54 @@ def assemble_newpackagelist_dict(newpackagelist: schemas.PackagesList,
     return newpackagelist_dict
 
 
-def generate_zipped_json_file_then_resp(newpackagelist_dict: dict):
-    json_file_path = f'{local_settings.PACKAGES_FOLDER}/{local_settings.JSON_FILE_NAME}'
-    try:
-        # Create the json file.
-        with open(json_file_path, 'w') as f:
-            f.write(json.dumps(newpackagelist_dict, indent=4))  # 注意indent=4
-    except IOError as e:
-        logger.error(f'Write {json_file_path} failed. Error message: {e}')
-        return None
-
-    zip_file_path = f'{local_settings.PACKAGES_FOLDER}/{local_settings.ZIP_FILE_NAME}'
+def write_file_atomically(file_path: str, data: bytes):
+    """
+    Write to a temp file in the same folder then `os.replace`, readers never see a half written file.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=local_settings.UPLOAD_TEMP_PREFIX, dir=os.path.dirname(file_path))
     try:
-        # Create the zip file.
-        with zipfile.ZipFile(zip_file_path, 'w') as zf:
-            zf.write(json_file_path, f'{local_settings.JSON_FILE_NAME}')
-    except IOError as e:
-        logger.error(f'Write {zip_file_path} failed. Error message: {e}')
-        return None
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        discard_temp_file(temp_path)
+        raise
 
-    # Assemble the special newpackagelist_dict
-    # 以下2行代码不涉及性能问题，因为只计算newpackagelist.zip文件的size和hash，文件很小，所以几乎无性能问题
-    packagelist_length = os.path.getsize(zip_file_path)  # returned a integer.
-    packagelist_hash = get_package_hash(zip_file_path)  # returned a string.
 
-    packagelist_down_url = f'{local_settings.BASE_URL}/packages/downloads/{local_settings.ZIP_FILE_NAME}'
+def build_zipped_json(newpackagelist_dict: dict) -> Tuple[bytes, bytes]:
+    """
+    Build newpackagelist.json and newpackagelist.zip in memory.
+    The zip entry has a fixed timestamp and compression level, so the same dict always gives the same bytes
+    and hash, no matter which worker builds it.
+    :return: (json bytes, zip bytes)
+    """
+    json_bytes = json.dumps(newpackagelist_dict, indent=4).encode()  # 注意indent=4
+
+    zip_info = zipfile.ZipInfo(local_settings.JSON_FILE_NAME, date_time=(1980, 1, 1, 0, 0, 0))
+    zip_info.external_attr = 0o644 << 16
+    # `writestr` takes the compression of the `ZipInfo`, whose default is `ZIP_STORED`.
+    zip_info.compress_type = zipfile.ZIP_DEFLATED
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        zf.writestr(zip_info, json_bytes, compresslevel=local_settings.MANIFEST_ZIP_COMPRESS_LEVEL)
+
+    return json_bytes, buffer.getvalue()
+
+
+def generate_zipped_json_then_resp(newpackagelist_dict: dict, packagelist_down_folder: str) -> Tuple[dict, bytes]:
+    """
+    Build the zipped manifest in memory, nothing is written to disk.
+    :param newpackagelist_dict:
+    :param packagelist_down_folder: The zip bytes will be served at `<folder>/<hash[:16]>/newpackagelist.zip`,
+                                    so the URL changes whenever the content does.
+    :return: (resp_dict, zip bytes)
+    """
+    _, zip_bytes = build_zipped_json(newpackagelist_dict)
+
+    # Assemble the special newpackagelist_dict
+    packagelist_length = len(zip_bytes)  # returned a integer.
+    packagelist_hash = hashlib.sha256(zip_bytes).hexdigest()  # returned a string.
+    packagelist_down_url = f'{packagelist_down_folder}/{packagelist_hash[:16]}/{local_settings.ZIP_FILE_NAME}'
 
     resp_dict = assemble_package_dict(pname=newpackagelist_dict.get('packagelist_name'),
                                       pversion=newpackagelist_dict.get('packagelist_version'),
@@ -139,5 +289,5 @@ def generate_zipped_json_file_then_resp(newpackagelist_dict: dict):
                                       pcmd='',
                                       pdel='')
 
-    return resp_dict
+    return resp_dict, zip_bytes
 
@@ -0,0 +1,96 @@
+"""
+In-memory cache of the per-place packagelist manifests, keyed by (`packagelist_version`, place id).
+
+A manifest only changes when the packagelist version is bumped, so the json/zip bytes and their hash
+are built once per place and version, and every poll in between is answered from memory.
+The number of cached manifests is bounded, the least recently used ones are evicted first.
+Concurrent misses of the same key share one build, different keys are built in parallel.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+from updblaster.simple_tools.coherence import shared_generations
+from updblaster.simple_tools.single_flight import SingleFlight
+from updblaster.simple_tools.compress_tools import EncodedBody
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, NamedTuple, Optional
+
+
+class ManifestEntry(NamedTuple):
+    resp_dict: Optional[dict]  # None if no package is enabled for the place.
+    zip_bytes: bytes
+    resp_body: Optional[EncodedBody] = None  # `resp_dict` encoded and compressed, see `compress_tools`.
+
+
+class ManifestCache:
+    def __init__(self, max_size: int = local_settings.MANIFEST_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._builds = SingleFlight()
+        self._max_size = max_size
+        self._entries: 'OrderedDict[Hashable, ManifestEntry]' = OrderedDict()
+        self._hits = 0
+        self._misses = 0  # Counted when a manifest is built, not by every `get` that finds nothing.
+
+    def get(self, key: Hashable) -> Optional[ManifestEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: ManifestEntry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                logger.debug(f'Manifest cache evicted {evicted_key}.')
+
+    def get_or_build(self, key: Hashable, builder: Callable[[], Optional[ManifestEntry]]) -> Optional[ManifestEntry]:
+        """
+        :param key: (packagelist_version, place id)
+        :param builder: Builds the manifest entry, None on failure.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        def build() -> Optional[ManifestEntry]:
+            # Another thread may have built it just before this flight started.
+            built = self.get(key)
+            if built is not None:
+                return built
+
+            with self._lock:
+                self._misses += 1
+            built = builder()
+            if built is not None:
+                self.put(key, built)
+                logger.info(f'Manifest {key} built and cached.')
+            return built
+        return self._builds.do(key, build)
+
+    def invalidate(self, publish: bool = True):
+        """
+        :param publish: Also make the other workers invalidate their manifest caches.
+        """
+        with self._lock:
+            self._entries.clear()
+        if publish:
+            shared_generations.publish('manifests')
+        logger.debug(f'Manifest cache invalidated.')
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries)}
+        stats['builds'] = self._builds.stats()
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+
+manifest_cache = ManifestCache()
+shared_generations.register('manifests', lambda: manifest_cache.invalidate(publish=False))
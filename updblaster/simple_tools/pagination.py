@@ -0,0 +1,47 @@
+"""
+Keyset pagination of the listings by their indexed `id` column, see `GET /places/`, `/packages/` and `/npl/`.
+
+A page is `WHERE id > <last id> ORDER BY id LIMIT n`, so it costs the same however deep it is, unlike
+`OFFSET skip`. The continuation token of the next page is returned in the `X-Next-Cursor` header, only when
+there is a next page. Tokens are opaque to the clients, and bound to their listing.
+"""
+import base64
+from typing import List, Optional
+
+from fastapi import HTTPException, Response, status
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def encode_cursor(listing: str, last_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{listing}:{last_id}'.encode()).decode('ascii').rstrip('=')
+
+
+def decode_cursor(listing: str, cursor: Optional[str]) -> Optional[int]:
+    """
+    :return: The last id of the previous page, None without cursor.
+    :raise HTTPException: 400 if the cursor is not one of `listing`.
+    """
+    if cursor is None:
+        return None
+    try:
+        token = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        token_listing, _, last_id = token.partition(':')
+        if token_listing == listing and last_id.isdigit():
+            return int(last_id)
+    except ValueError:
+        # binascii.Error, UnicodeDecodeError, or non-ASCII characters in the cursor.
+        pass
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f'Invalid cursor {cursor}.')
+
+
+def paginate(listing: str, rows: List, limit: int, response: Response) -> List:
+    """
+    :param rows: Up to `limit + 1` rows by id, the extra one only tells that there is a next page.
+    :return: The rows of the page, the `X-Next-Cursor` header is set on `response` if there is a next page.
+    """
+    page = rows[:limit]
+    if len(rows) > limit and page:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(listing, page[-1].id)
+    return page
@@ -0,0 +1,125 @@
+"""
+Files used by the delta patches.
+
+Every published version of a package is kept as a patch base under `PATCH_BASES_FOLDER/<package_id>/`:
+    <package_hash>          Hard link of the published file, so it survives when the package file is replaced.
+    <package_hash>.json     The package version and when it was retained.
+Generated patches are stored flat under `PATCHES_FOLDER`.
+With the chunk store enabled, the chunk manifest of `<package_hash>` is the base and no file is linked,
+a base file is only rebuilt temporarily while generating patches.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+from updblaster.simple_tools import main_tools, chunk_store
+
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Iterator, List
+
+
+def base_folder(package_id: int) -> str:
+    return f'{local_settings.PATCH_BASES_FOLDER}/{package_id}'
+
+
+def base_path(package_id: int, package_hash: str) -> str:
+    return f'{base_folder(package_id)}/{package_hash}'
+
+
+def patch_name(package_id: int, from_hash: str, to_hash: str) -> str:
+    return f'{package_id}-{from_hash[:16]}-{to_hash[:16]}.patch'
+
+
+def patch_path(name: str) -> str:
+    return f'{local_settings.PATCHES_FOLDER}/{name}'
+
+
+def retain_base(package_id: int, package_version: str, package_hash: str, file_path: str):
+    """
+    Keep the published file as a base of future patches. Costs no disk space on the same file system.
+    """
+    folder = base_folder(package_id)
+    os.makedirs(folder, exist_ok=True)
+    path = base_path(package_id, package_hash)
+    in_chunk_store = local_settings.CHUNK_STORE_ENABLED and chunk_store.has_manifest(package_hash)
+    if not in_chunk_store and not os.path.exists(path):
+        temp_path = f'{path}{local_settings.UPLOAD_TEMP_PREFIX}{os.getpid()}'
+        try:
+            os.link(file_path, temp_path)
+        except OSError:
+            shutil.copyfile(file_path, temp_path)
+        os.replace(temp_path, path)
+
+    main_tools.write_file_atomically(f'{path}.json', json.dumps({'package_version': package_version,
+                                                                 'package_hash': package_hash,
+                                                                 'retained': time.time()}).encode())
+    logger.debug(f'Retained version {package_version} of package {package_id} as a patch base.')
+
+
+def list_bases(package_id: int) -> List[dict]:
+    """
+    :return: Newest first, each with `package_version`, `package_hash`, `retained` and `path`.
+    """
+    folder = base_folder(package_id)
+    if not os.path.isdir(folder):
+        return []
+
+    bases = []
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(f'{folder}/{name}') as f:
+                base = json.loads(f.read())
+        except (OSError, ValueError):
+            continue
+        base['path'] = base_path(package_id, base['package_hash'])
+        if os.path.exists(base['path']) or chunk_store.has_manifest(base['package_hash']):
+            bases.append(base)
+    return sorted(bases, key=lambda base: base['retained'], reverse=True)
+
+
+@contextmanager
+def materialized_base(package_id: int, package_hash: str) -> Iterator[str]:
+    """
+    :return: Path of the base file, rebuilt from the chunk store into a temp file if needed.
+    :raise FileNotFoundError: Neither the base file nor its chunk manifest exists.
+    """
+    path = base_path(package_id, package_hash)
+    if os.path.exists(path):
+        yield path
+        return
+
+    os.makedirs(base_folder(package_id), exist_ok=True)
+    temp_path = f'{path}{local_settings.UPLOAD_TEMP_PREFIX}{os.getpid()}'
+    try:
+        chunk_store.materialize(package_hash, temp_path)
+        yield temp_path
+    finally:
+        main_tools.discard_temp_file(temp_path)
+
+
+def prune_bases(package_id: int, keep: int) -> List[str]:
+    """
+    :return: Hashes of the removed bases.
+    """
+    removed = []
+    for base in list_bases(package_id)[keep:]:
+        for path in (base['path'], f'{base["path"]}.json'):
+            main_tools.discard_temp_file(path)
+        removed.append(base['package_hash'])
+    if removed:
+        logger.debug(f'Pruned patch bases of package {package_id}: {removed}.')
+    return removed
+
+
+def remove_patch_files(patch_names: List[str]):
+    for name in patch_names:
+        main_tools.discard_temp_file(patch_path(name))
+
+
+def remove_package_files(package_id: int, patch_names: List[str]):
+    remove_patch_files(patch_names)
+    shutil.rmtree(base_folder(package_id), ignore_errors=True)
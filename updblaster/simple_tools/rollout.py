@@ -0,0 +1,60 @@
+"""
+Staged rollout of a published package, so the places do not all start downloading it at once.
+
+- Every place is assigned to a position in [0, 1) by hashing its `place_code`, and so to one of the `waves` waves.
+  The position does not depend on the package nor on the number of waves: the same places go first in every
+  rollout, and a place reached at 10% is still reached at 20%.
+- A package being rolled out is enabled for a place, on top of its allow/deny rules, only when the place is in
+  one of the first `opened_waves` waves, or was already enabled before the publish (`exempt_places`).
+  Percentage mode is 100 waves, `opened_waves` being the percentage.
+- Waves open every `wave_interval_seconds`, or manually when it is None. A halted rollout opens no more waves,
+  the places already reached keep the package.
+"""
+import hashlib
+from functools import lru_cache
+from typing import FrozenSet, NamedTuple, Optional
+
+from updblaster.simple_tools.eligibility import parse_places
+
+
+@lru_cache(maxsize=65536)
+def place_position(place_code: str) -> float:
+    digest = hashlib.sha256(place_code.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def place_wave(place_code: str, waves: int) -> int:
+    """
+    :return: 0 to waves - 1
+    """
+    return int(place_position(place_code) * waves)
+
+
+class RolloutState(NamedTuple):
+    waves: int
+    opened_waves: int
+    exempt_places: FrozenSet[int]
+
+    @property
+    def completed(self) -> bool:
+        return self.opened_waves >= self.waves
+
+    def reaches(self, place_id: int, place_code: str) -> bool:
+        return self.completed or place_id in self.exempt_places or place_wave(place_code, self.waves) < self.opened_waves
+
+
+def rollout_state(waves: int, opened_waves: int, exempt_places: Optional[str]) -> RolloutState:
+    """
+    :param exempt_places: e.g.: '1,2,3', as stored in `package_rollouts`.
+    """
+    return RolloutState(waves=waves, opened_waves=opened_waves, exempt_places=parse_places(exempt_places))
+
+
+def rollout_reaches(db_rollout, place_id: int, place_code: str) -> bool:
+    """
+    :param db_rollout: A `PackageRollout` row, None if the package is not being rolled out.
+    """
+    if db_rollout is None:
+        return True
+    return rollout_state(db_rollout.waves, db_rollout.opened_waves, db_rollout.exempt_places).reaches(place_id,
+                                                                                                     place_code)
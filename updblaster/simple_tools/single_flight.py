@@ -0,0 +1,104 @@
+"""
+Request coalescing: concurrent calls with the same key share one in-flight computation.
+
+Right after a version bump many places poll at once, and would all miss the caches together.
+With single-flight the first caller (the leader) computes, the others wait for its result,
+so MySQL sees one query and the manifest is built once, instead of once per waiting request.
+Nothing is cached here, once the computation finishes the next call with the same key runs it again.
+"""
+from updblaster.logger import logger
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class AsyncSingleFlight:
+    """
+    For coroutines of one event loop.
+    """
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self._shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            self._shared += 1
+            try:
+                # `shield`, a cancelled follower must not cancel the flight of the others.
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                # The leader was cancelled (e.g. its client went away), take over.
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # Retrieved here, so a flight without followers does not log "exception was never retrieved".
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._flights), 'shared': self._shared}
+
+
+class SingleFlight:
+    """
+    For threads, e.g. the sync routes running in the threadpool.
+    """
+    class _Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, 'SingleFlight._Flight'] = {}
+        self._shared = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = self._Flight()
+            else:
+                self._shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            logger.debug(f'Single-flight {key} failed, detail: {e}.')
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._flights), 'shared': self._shared}
@@ -0,0 +1,379 @@
+"""
+Resumable, chunked upload sessions.
+
+A session is a folder under `UPLOAD_SESSIONS_FOLDER`, shared by all workers:
+    <session_id>/session.json       Metadata of the package to be created.
+    <session_id>/<index>.part       Data of a received chunk.
+    <session_id>/<index>.json       Length and sha256 of the chunk, written after the `.part`, marks it as received.
+    <session_id>/finalize.lock      `flock`ed by the finalize request, released by the kernel if its worker dies.
+Chunks may arrive in any order and in parallel, they are hashed while being written. A chunk is written under a
+shared lock of `finalize.lock`, so no chunk can be replaced after the finalize verified the hash of the whole file.
+
+The sha256 of the whole file cannot be derived from the chunk hashes, so every worker also keeps a running sha256
+of the session's chunks in order, see `RunningHash`: a chunk arriving in order is fed to it while being written,
+the chunks received before their turn are read back once their turn comes, while their data is still in the page
+cache. Finalize then only hashes the chunks the running hash has not covered yet, all of them at worst when the
+chunks went to another worker, and concatenates the parts with `copy_file_range`, without reading them again.
+"""
+from updblaster.logger import logger
+from updblaster import local_settings
+from updblaster.simple_tools import main_tools
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+SESSION_FILE_NAME = 'session.json'
+FINALIZE_LOCK_NAME = 'finalize.lock'
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadSessionError(Exception):
+    """Raised for client mistakes, e.g. a chunk with wrong length or hash."""
+    pass
+
+
+class UploadSessionBusy(Exception):
+    """Raised for a chunk sent while the session is being finalized."""
+    pass
+
+
+def _session_folder(session_id: str) -> str:
+    return f'{local_settings.UPLOAD_SESSIONS_FOLDER}/{session_id}'
+
+
+class RunningHash:
+    """
+    sha256 of the first `next_index` chunks of a session, as hashed by this worker.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.length = 0
+        self.sha256 = hashlib.sha256()
+        # sha256 of every chunk fed, a chunk re-sent with other data since then invalidates the running hash.
+        self.chunk_hashes: List[str] = []
+
+    def feed(self, sha256, length: int, chunk_hash: str):
+        self.sha256 = sha256
+        self.next_index += 1
+        self.length += length
+        self.chunk_hashes.append(chunk_hash)
+
+
+_running_hashes: Dict[str, RunningHash] = {}
+_running_hashes_lock = threading.Lock()
+
+
+def _running_hash(session_id: str) -> RunningHash:
+    with _running_hashes_lock:
+        running = _running_hashes.get(session_id)
+        if running is None:
+            running = _running_hashes[session_id] = RunningHash()
+        return running
+
+
+def _load_chunk(session: dict, index: int) -> Optional[dict]:
+    try:
+        with open(f'{_session_folder(session["session_id"])}/{index}.json') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _catch_up(session: dict, running: RunningHash):
+    """
+    Feed the chunks received after the running hash, in order, from their `.part`, under `running.lock`.
+    """
+    session_folder = _session_folder(session['session_id'])
+    while running.next_index < session['total_chunks']:
+        # The `.json` is read before the `.part`: if the chunk is replaced meanwhile, the recorded hash is the old
+        # one, and `_verified_running_hash` rejects the running hash.
+        chunk = _load_chunk(session, running.next_index)
+        if chunk is None:
+            return
+        sha256 = running.sha256.copy()
+        length = 0
+        with open(f'{session_folder}/{running.next_index}.part', 'rb') as part:
+            while True:
+                data = part.read(local_settings.UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                length += len(data)
+        running.feed(sha256, length, chunk['sha256'])
+
+
+def _advance_running_hash(session: dict, chunk: dict, sha256):
+    """
+    :param sha256: The running hash fed with `chunk` while it was written, None if it was not its turn.
+    """
+    running = _running_hash(session['session_id'])
+    with running.lock:
+        if sha256 is not None and running.next_index == chunk['index']:
+            running.feed(sha256, chunk['length'], chunk['sha256'])
+        _catch_up(session, running)
+
+
+def _verified_running_hash(session: dict) -> Optional[RunningHash]:
+    """
+    :return: The running hash of the whole file, None if a chunk was replaced since it was fed.
+    """
+    running = _running_hash(session['session_id'])
+    with running.lock:
+        _catch_up(session, running)
+        if running.next_index < session['total_chunks']:
+            return None
+        for index, chunk_hash in enumerate(running.chunk_hashes):
+            chunk = _load_chunk(session, index)
+            if chunk is None or chunk['sha256'] != chunk_hash:
+                logger.info(f'Upload session {session["session_id"]} chunk {index} replaced, hashing again.')
+                with _running_hashes_lock:
+                    _running_hashes.pop(session['session_id'], None)
+                return None
+        return running
+
+
+def _write_json_atomically(file_path: str, data: dict):
+    folder = os.path.dirname(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix=local_settings.UPLOAD_TEMP_PREFIX, dir=folder)
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(temp_path, file_path)
+
+
+def create_session(meta: dict) -> dict:
+    """
+    :param meta: Package attributes plus `file_name`, `file_length`, `package_hash` and `chunk_size`.
+    :return: Session dict.
+    """
+    purge_expired_sessions()
+
+    session = dict(meta)
+    session['session_id'] = uuid.uuid4().hex
+    session['total_chunks'] = max(1, -(-session['file_length'] // session['chunk_size']))  # ceil
+    session['created'] = time.time()
+
+    folder = _session_folder(session['session_id'])
+    os.makedirs(folder)
+    _write_json_atomically(f'{folder}/{SESSION_FILE_NAME}', session)
+    logger.debug(f'CREATE upload session {session["session_id"]} for {session["file_name"]}.')
+    return session
+
+
+def load_session(session_id: str) -> Optional[dict]:
+    if not SESSION_ID_PATTERN.match(session_id):
+        return None
+    try:
+        with open(f'{_session_folder(session_id)}/{SESSION_FILE_NAME}') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def remove_session(session_id: str):
+    shutil.rmtree(_session_folder(session_id), ignore_errors=True)
+    with _running_hashes_lock:
+        _running_hashes.pop(session_id, None)
+    logger.debug(f'DELETE upload session {session_id}.')
+
+
+def purge_expired_sessions():
+    if not os.path.isdir(local_settings.UPLOAD_SESSIONS_FOLDER):
+        os.makedirs(local_settings.UPLOAD_SESSIONS_FOLDER, exist_ok=True)
+        return
+
+    deadline = time.time() - local_settings.UPLOAD_SESSION_EXPIRE_SECONDS
+    for session_id in os.listdir(local_settings.UPLOAD_SESSIONS_FOLDER):
+        try:
+            if os.path.getmtime(_session_folder(session_id)) < deadline:
+                remove_session(session_id)
+                logger.info(f'Upload session {session_id} expired and purged.')
+        except OSError:
+            continue
+    # Running hashes of the sessions finalized or purged by the other workers.
+    with _running_hashes_lock:
+        for session_id in [session_id for session_id in _running_hashes
+                           if not os.path.isdir(_session_folder(session_id))]:
+            del _running_hashes[session_id]
+
+
+def expected_chunk_length(session: dict, index: int) -> int:
+    if index < session['total_chunks'] - 1:
+        return session['chunk_size']
+    return session['file_length'] - session['chunk_size'] * (session['total_chunks'] - 1)
+
+
+def received_chunks(session: dict) -> List[int]:
+    indexes = []
+    for name in os.listdir(_session_folder(session['session_id'])):
+        stem, ext = os.path.splitext(name)
+        if ext == '.json' and stem.isdigit():
+            indexes.append(int(stem))
+    return sorted(indexes)
+
+
+def missing_chunks(session: dict) -> List[int]:
+    return sorted(set(range(session['total_chunks'])).difference(received_chunks(session)))
+
+
+async def save_chunk(session: dict, index: int, stream: AsyncIterator[bytes],
+                     chunk_hash: Optional[str] = None) -> dict:
+    """
+    Write one chunk, hashing it on the way. Re-sending a chunk simply replaces it.
+    :param session:
+    :param index: 0 based chunk number.
+    :param stream: Request body.
+    :param chunk_hash: Optional sha256 of the chunk given by client, verified before the chunk is accepted.
+    :return: Chunk dict with `index`, `length` and `sha256`.
+    :raise UploadSessionBusy: The session is being finalized.
+    """
+    if not 0 <= index < session['total_chunks']:
+        raise UploadSessionError(f'Chunk index {index} out of range 0 - {session["total_chunks"] - 1}.')
+
+    expected_length = expected_chunk_length(session, index)
+    folder = _session_folder(session['session_id'])
+    lock_fd = _acquire_lock(session, fcntl.LOCK_SH)
+    if lock_fd is None:
+        raise UploadSessionBusy(f'Upload session {session["session_id"]} is being finalized.')
+    try:
+        return await _save_chunk(session, index, stream, chunk_hash, expected_length, folder)
+    finally:
+        release_finalize_lock(lock_fd)
+
+
+async def _save_chunk(session: dict, index: int, stream: AsyncIterator[bytes], chunk_hash: Optional[str],
+                      expected_length: int, folder: str) -> dict:
+    sha256 = hashlib.sha256()
+    chunk_length = 0
+    # In order, the chunk is fed to a copy of the running hash too, kept only if the chunk is accepted.
+    running = _running_hash(session['session_id'])
+    running_sha256 = running.sha256.copy() if running.next_index == index else None
+
+    fd, temp_path = tempfile.mkstemp(prefix=local_settings.UPLOAD_TEMP_PREFIX, dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for data in stream:
+                chunk_length += len(data)
+                if chunk_length > expected_length:
+                    raise UploadSessionError(f'Chunk {index} is larger than {expected_length} bytes.')
+                sha256.update(data)
+                if running_sha256 is not None:
+                    running_sha256.update(data)
+                await run_in_threadpool(f.write, data)
+
+        if chunk_length != expected_length:
+            raise UploadSessionError(f'Chunk {index} has {chunk_length} bytes, expected {expected_length}.')
+        if chunk_hash and chunk_hash.lower() != sha256.hexdigest():
+            raise UploadSessionError(f'Chunk {index} hash mismatched.')
+
+        os.replace(temp_path, f'{folder}/{index}.part')
+    except BaseException:
+        main_tools.discard_temp_file(temp_path)
+        raise
+
+    chunk = {'index': index, 'length': chunk_length, 'sha256': sha256.hexdigest()}
+    _write_json_atomically(f'{folder}/{index}.json', chunk)
+    await run_in_threadpool(_advance_running_hash, session, chunk, running_sha256)
+    logger.debug(f'Upload session {session["session_id"]} received chunk {index}.')
+    return chunk
+
+
+def _acquire_lock(session: dict, operation: int) -> Optional[int]:
+    """
+    :param operation: `fcntl.LOCK_EX` to finalize, `fcntl.LOCK_SH` to write a chunk.
+    :return: The locked file descriptor, None if the lock is held in a conflicting mode.
+    """
+    fd = os.open(f'{_session_folder(session["session_id"])}/{FINALIZE_LOCK_NAME}', os.O_CREAT | os.O_WRONLY)
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def acquire_finalize_lock(session: dict) -> Optional[int]:
+    """
+    Only one finalize request of a session could run at the same time, and no chunk could be written meanwhile.
+    :return: The locked file descriptor, None if another finalize holds the lock or a chunk is being written.
+    """
+    return _acquire_lock(session, fcntl.LOCK_EX)
+
+
+def release_finalize_lock(fd: int):
+    os.close(fd)
+
+
+def _append_file(src_path: str, dst_fd: int):
+    """
+    Copy inside the kernel when possible, without reading the data into user space.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    with open(src_path, 'rb') as src:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = 0
+            if copy_file_range is not None:
+                try:
+                    copied = copy_file_range(src.fileno(), dst_fd, min(remaining, 1 << 30))
+                except OSError:
+                    # e.g. EXDEV or not supported by the file system, both offsets are unchanged.
+                    copy_file_range = None
+            if not copied:
+                data = os.read(src.fileno(), local_settings.UPLOAD_CHUNK_SIZE)
+                if not data:
+                    raise IOError(f'{src_path} is truncated.')
+                copied = os.write(dst_fd, data)
+                if copied < len(data):
+                    os.lseek(src.fileno(), copied - len(data), os.SEEK_CUR)
+            remaining -= copied
+
+
+def assemble_chunks(session: dict, folder: str) -> Tuple[str, int, str]:
+    """
+    Concatenate all chunks into a temp file under `folder`.
+    The whole file hash is the running hash, see `RunningHash`, the chunks are only hashed again if a chunk was
+    replaced since it was hashed.
+    :return: (temp file path, package length, package hash by hexdigest)
+    """
+    session_folder = _session_folder(session['session_id'])
+    running = _verified_running_hash(session)
+
+    fd, temp_path = tempfile.mkstemp(prefix=local_settings.UPLOAD_TEMP_PREFIX, dir=folder)
+    try:
+        if running is not None:
+            try:
+                for index in range(session['total_chunks']):
+                    _append_file(f'{session_folder}/{index}.part', fd)
+            finally:
+                os.close(fd)
+            return temp_path, running.length, running.sha256.hexdigest()
+
+        sha256 = hashlib.sha256()
+        package_length = 0
+        with os.fdopen(fd, 'wb') as f:
+            for index in range(session['total_chunks']):
+                with open(f'{session_folder}/{index}.part', 'rb') as part:
+                    while True:
+                        data = part.read(local_settings.UPLOAD_CHUNK_SIZE)
+                        if not data:
+                            break
+                        sha256.update(data)
+                        package_length += len(data)
+                        f.write(data)
+    except BaseException:
+        main_tools.discard_temp_file(temp_path)
+        raise
+
+    return temp_path, package_length, sha256.hexdigest()
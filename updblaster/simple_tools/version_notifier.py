@@ -0,0 +1,59 @@
+"""
+Wakes up the subscribers waiting for a new packagelist version, see `/npl/watch/` and `/npl/events/`.
+
+Subscribers wait on an `asyncio.Event` of the worker's event loop, an idle subscriber costs a suspended
+coroutine and nothing else. The event is fired by the version bump of this worker, or by the generation watcher
+when another worker bumped the `packagelists` slot, see `coherence.py`.
+"""
+from updblaster.logger import logger
+from updblaster.simple_tools.coherence import shared_generations
+
+import asyncio
+from typing import Optional
+
+
+class VersionNotifier:
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+        self._generation = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Called on startup, from the event loop serving the requests."""
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def notify(self):
+        """Thread safe, may be called from the sync routes running in the threadpool."""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._fire)
+
+    def _fire(self):
+        self._generation += 1
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+        logger.debug(f'Packagelist subscribers notified, generation {self._generation}.')
+
+    async def wait(self, generation: int, timeout: float) -> bool:
+        """
+        :param generation: `generation` taken before checking the packagelist version.
+        :return: False on timeout.
+        """
+        if self._event is None:
+            await asyncio.sleep(timeout)
+            return False
+        if self._generation != generation:
+            return True
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+packagelist_notifier = VersionNotifier()
+shared_generations.register('packagelists', packagelist_notifier.notify)